@@ -26,6 +26,11 @@ def rna(obj, steps):
     else:
         obj['steps'] = _steps
 
+def _substeps(obj, step):
+    # --steps的yaml可以是步骤列表, 也可以是{步骤: [子步骤]}
+    if isinstance(obj['steps'], dict):
+        return obj['steps'].get(step)
+    return None
 
 @rna.command(help="extract cell barcode and umi.")
 @click.option('--fq1', 'fq1', required=True, type=click.Path(), multiple=True, help='read1 fq file, can specify multiple times.')
@@ -40,6 +45,24 @@ def rna(obj, steps):
 @click.option('--misB', 'B', nargs=2, default=(1, 0), type=click.Tuple([int, int]), show_default=True, help='err and indel')
 @click.option('--misL', 'L', nargs=2, default=(1, 0), type=click.Tuple([int, int]), show_default=True, help='err and indel')
 @click.option('--core', default=4, show_default=True, help='core')
+@click.option('--batch', is_flag=True, default=False, show_default=True, help='parse reads chunk by chunk with numpy.')
+@click.option('--shm', is_flag=True, default=False, show_default=True, help='pass chunks to workers through shared memory.')
+@click.option('--compress', default='bgzf', show_default=True, type=click.Choice(['bgzf', 'gzip', 'xopen']),
+              help='bgzf/gzip: workers compress their own chunks; xopen: compress in the main process.')
+@click.option('--compresslevel', default=6, show_default=True, type=click.IntRange(0, 9), help='compress level of step1 output.')
+@click.option('--lanes', default=2, show_default=True, type=click.IntRange(1), help='number of fq1/fq2 pairs decompressed concurrently.')
+@click.option('--read_threads', default=None, type=click.IntRange(0), help='decompress threads of each fq file, 0: in process.')
+@click.option('--outformat', default='fastq', show_default=True, type=click.Choice(['fastq', 'bam']),
+              help='step1 output, bam: unaligned bam with CB/CR/UB/UR tags.')
+@click.option('--resume', is_flag=True, default=False, show_default=True,
+              help='skip the chunks saved in the step1 checkpoint, not for --compress xopen.')
+@click.option('--autotune', is_flag=True, default=False, show_default=True,
+              help='tune chunk size and busy workers of step1 while running.')
+@click.option('--max-mem', 'max_mem', default=None, help='memory ceiling of step1 (e.g. 16G), implies --autotune.')
+@click.option('--unordered', is_flag=True, default=False, show_default=True,
+              help='write step1 chunks as they finish, read order is not kept and --resume is not possible.')
+@click.option('--reorder_window', default=None, type=click.IntRange(1),
+              help='chunks read ahead of the last written one in ordered mode, default: 2 * core.')
 @click.option('--chemistry', help='eg: SO01V3')
 @click.pass_obj
 def step1(obj, **kwargs):
@@ -61,20 +84,62 @@ def step1(obj, **kwargs):
 @click.option('--core', default=4, show_default=True, help='')
 @click.option('--region', default='exon', show_default=True, help='exon or transcript')
 @click.option("--sc5p",is_flag=True,default=False,show_default=True,help="if set, the single cell data is considered as 5' data.")
+@click.option('--rnaseq_qc', default='native', show_default=True, type=click.Choice(['native', 'qualimap']),
+              help='exonic/intronic/intergenic stats of step2, native: built-in classifier.')
+@click.option('--sort_mode', default='pipe', show_default=True, type=click.Choice(['file', 'pipe', 'star']),
+              help='coordinate sort of step2, file: sort Aligned.out.bam; pipe: STAR | samtools sort; star: STAR sorts.')
+@click.option('--sort_ram', default=None, help='--limitBAMsortRAM of STAR for --sort_mode star (e.g. 32G).')
+@click.option('--group_mode', default='collate', show_default=True, type=click.Choice(['sort', 'collate']),
+              help='group reads for step3, sort: samtools sort -n; collate: split into barcode shards.')
+@click.option('--collate_shards', default=64, show_default=True, type=click.IntRange(1), help='number of barcode shards.')
+@click.option('--assign_mode', default='featurecounts', show_default=True, type=click.Choice(['featurecounts', 'native']),
+              help='gene assignment of step2, native: built-in, writes the collated shards for step3 directly.')
 
 @click.pass_obj
 def step2(obj, **kwargs):
     from .step2 import align
     kwargs['logger'] = obj['logger']
-    align(**kwargs)
+    align(steps=_substeps(obj, 'step2'), **kwargs)
+
+@rna.command(help="align samples against a genome loaded once into shared memory.")
+@click.option('--sample', 'samples', required=True, nargs=2, multiple=True, type=click.Tuple([str, click.Path()]),
+              help='samplename and fq (step1 output), can specify multiple times.')
+@click.option('--genomeDir', 'genomeDir', required=True, type=click.Path(), help='')
+@click.option('--gtf', required=True, type=click.Path(), help='')
+@click.option('--outdir', default='./', show_default=True, type=click.Path(), help='output dir, samples are in outdir/samplename, with the step1 summary in it.')
+@click.option('--star_path', 'star_path', default='STAR', help='')
+@click.option('--samtools_path', 'samtools_path', default='samtools', help='')
+@click.option('--core', default=4, show_default=True, help='')
+@click.option('--region', default='exon', show_default=True, help='exon or transcript')
+@click.option("--sc5p",is_flag=True,default=False,show_default=True,help="if set, the single cell data is considered as 5' data.")
+@click.option('--rnaseq_qc', default='native', show_default=True, type=click.Choice(['native', 'qualimap']),
+              help='exonic/intronic/intergenic stats of step2, native: built-in classifier.')
+@click.option('--sort_mode', default='pipe', show_default=True, type=click.Choice(['file', 'pipe', 'star']),
+              help='coordinate sort of step2, file: sort Aligned.out.bam; pipe: STAR | samtools sort; star: STAR sorts.')
+@click.option('--sort_ram', default=None, help='--limitBAMsortRAM of STAR, required for --sort_mode star.')
+@click.option('--group_mode', default='collate', show_default=True, type=click.Choice(['sort', 'collate']),
+              help='group reads for step3, sort: samtools sort -n; collate: split into barcode shards.')
+@click.option('--collate_shards', default=64, show_default=True, type=click.IntRange(1), help='number of barcode shards.')
+@click.option('--assign_mode', default='featurecounts', show_default=True, type=click.Choice(['featurecounts', 'native']),
+              help='gene assignment of step2, native: built-in, writes the collated shards for step3 directly.')
+@click.pass_obj
+def step2batch(obj, **kwargs):
+    from .step2 import align_batch
+    kwargs['logger'] = obj['logger']
+    align_batch(steps=_substeps(obj, 'step2'), **kwargs)
 
 # def count(bam, outdir, samplename, gtf, logger, expectNum=3000, **kwargs):
 @rna.command(help="quantifies.")
-@click.option('--bam', required=True, help='')
+@click.option('--bam', required=True, help='bam sorted by name, or the dir of collated shards.')
 @click.option('--outdir', default='./', show_default=True, type=click.Path(), help='')
+@click.option('--core', default=4, show_default=True, help='processes counting barcode shards.')
 @click.option('--samplename', required=True, help='')
 @click.option('--gtf', required=True, type=click.Path(), help='')
 @click.option('--expectNum', 'expectNum', default=3000, show_default=True, help='')
+@click.option('--umi_method', default='greedy', show_default=True, type=click.Choice(['greedy', 'directional']),
+              help='umi correction, greedy: merge into the first 1-mismatch umi with more reads; directional: only if it has >= 2n-1 reads.')
+@click.option('--umi_detail', default='plain', show_default=True, type=click.Choice(['plain', 'gzip', 'none']),
+              help='umi correction detail of step3: umi.xls, umi.xls.gz or not written.')
 #@click.option('--forceCell', 'forceCell',  help='number of force cells')
 @click.pass_obj
 def step3(obj, **kwargs):
@@ -123,8 +188,40 @@ def report(obj, **kwargs):
 @click.option('--misB', 'B', nargs=2, default=(1, 0), type=click.Tuple([int, int]), show_default=True, help='')
 @click.option('--misL', 'L', nargs=2, default=(1, 0), type=click.Tuple([int, int]), show_default=True, help='')
 @click.option('--core', default=4, show_default=True, help='')
+@click.option('--batch', is_flag=True, default=False, show_default=True, help='parse reads chunk by chunk with numpy.')
+@click.option('--shm', is_flag=True, default=False, show_default=True, help='pass chunks to workers through shared memory.')
+@click.option('--compress', default='bgzf', show_default=True, type=click.Choice(['bgzf', 'gzip', 'xopen']),
+              help='bgzf/gzip: workers compress their own chunks; xopen: compress in the main process.')
+@click.option('--compresslevel', default=6, show_default=True, type=click.IntRange(0, 9), help='compress level of step1 output.')
+@click.option('--lanes', default=2, show_default=True, type=click.IntRange(1), help='number of fq1/fq2 pairs decompressed concurrently.')
+@click.option('--read_threads', default=None, type=click.IntRange(0), help='decompress threads of each fq file, 0: in process.')
+@click.option('--outformat', default='fastq', show_default=True, type=click.Choice(['fastq', 'bam']),
+              help='step1 output, bam: unaligned bam with CB/CR/UB/UR tags.')
+@click.option('--resume', is_flag=True, default=False, show_default=True,
+              help='skip the chunks saved in the step1 checkpoint, not for --compress xopen.')
+@click.option('--autotune', is_flag=True, default=False, show_default=True,
+              help='tune chunk size and busy workers of step1 while running.')
+@click.option('--max-mem', 'max_mem', default=None, help='memory ceiling of step1 (e.g. 16G), implies --autotune.')
+@click.option('--unordered', is_flag=True, default=False, show_default=True,
+              help='write step1 chunks as they finish, read order is not kept and --resume is not possible.')
+@click.option('--reorder_window', default=None, type=click.IntRange(1),
+              help='chunks read ahead of the last written one in ordered mode, default: 2 * core.')
+@click.option('--stream', is_flag=True, default=False, show_default=True,
+              help='feed step1 reads to STAR through a named pipe, fastq output only.')
+@click.option('--stream_keep', is_flag=True, default=False, show_default=True,
+              help='with --stream, also save step1 reads to a compressed fastq.')
 @click.option('--region', default='exon', show_default=True, help='exon or transcript')
 @click.option("--sc5p",is_flag=True,default=False,show_default=True,help="if set, the single cell data is considered as 5' data.")
+@click.option('--rnaseq_qc', default='native', show_default=True, type=click.Choice(['native', 'qualimap']),
+              help='exonic/intronic/intergenic stats of step2, native: built-in classifier.')
+@click.option('--sort_mode', default='pipe', show_default=True, type=click.Choice(['file', 'pipe', 'star']),
+              help='coordinate sort of step2, file: sort Aligned.out.bam; pipe: STAR | samtools sort; star: STAR sorts.')
+@click.option('--sort_ram', default=None, help='--limitBAMsortRAM of STAR for --sort_mode star (e.g. 32G).')
+@click.option('--group_mode', default='collate', show_default=True, type=click.Choice(['sort', 'collate']),
+              help='group reads for step3, sort: samtools sort -n; collate: split into barcode shards.')
+@click.option('--collate_shards', default=64, show_default=True, type=click.IntRange(1), help='number of barcode shards.')
+@click.option('--assign_mode', default='featurecounts', show_default=True, type=click.Choice(['featurecounts', 'native']),
+              help='gene assignment of step2, native: built-in, writes the collated shards for step3 directly.')
 @click.option('--genomeDir', 'genomeDir', required=True, type=click.Path(), help='')
 @click.option('--gtf', required=True, type=click.Path(), help='')
 @click.option('--star_path', 'star_path', default='STAR', help='')
@@ -132,6 +229,10 @@ def report(obj, **kwargs):
 @click.option('--rscript_path', 'rscript_path', default='Rscript', help='')
 @click.option('--chemistry', help='eg: SO01V3')
 @click.option('--expectNum', 'expectNum', default=3000, show_default=True, help='')
+@click.option('--umi_method', default='greedy', show_default=True, type=click.Choice(['greedy', 'directional']),
+              help='umi correction, greedy: merge into the first 1-mismatch umi with more reads; directional: only if it has >= 2n-1 reads.')
+@click.option('--umi_detail', default='plain', show_default=True, type=click.Choice(['plain', 'gzip', 'none']),
+              help='umi correction detail of step3: umi.xls, umi.xls.gz or not written.')
 #@click.option('--forceCell', 'forceCell', help='number of force cells')
 def run(obj, **kwargs):
     if kwargs['chemistry']:
@@ -139,16 +240,30 @@ def run(obj, **kwargs):
 
     kwargs['logger'] = obj['logger']
     kwargs['outdir'] = os.path.join(kwargs['outdir'], kwargs['samplename'])
-    if 'step1' in obj['steps']:
+    stream = kwargs['stream'] and 'step1' in obj['steps'] and 'step2' in obj['steps']
+    if stream:
+        # step1和STAR同时运行
+        from .stream import barcode_to_STAR
+        barcode_to_STAR(**kwargs)
+    elif 'step1' in obj['steps']:
         from .step1 import barcode 
         barcode(**kwargs)
-    fq = os.path.join(kwargs['outdir'], 'step1', f'{kwargs["samplename"]}_2.fq.gz')
+    ext = 'bam' if kwargs['outformat'] == 'bam' else 'fq.gz'
+    fq = os.path.join(kwargs['outdir'], 'step1', f'{kwargs["samplename"]}_2.{ext}')
     kwargs['fq'] = fq
 
     if 'step2' in obj['steps']:
         from .step2 import align
-        align(flags=_steps['step2'], **kwargs)
-    bam = os.path.join(kwargs['outdir'], 'step2', 'featureCounts',  f'{kwargs["samplename"]}_SortedByName.bam')
+        steps = _substeps(obj, 'step2')
+        if steps is None:
+            steps = _steps['step2']
+        if stream:
+            steps = [_ for _ in steps if _ != 'STAR']
+        align(steps=steps, **kwargs)
+    if kwargs['group_mode'] == 'collate' or kwargs['assign_mode'] == 'native':
+        bam = os.path.join(kwargs['outdir'], 'step2', 'featureCounts',  f'{kwargs["samplename"]}_collated')
+    else:
+        bam = os.path.join(kwargs['outdir'], 'step2', 'featureCounts',  f'{kwargs["samplename"]}_SortedByName.bam')
     kwargs['bam'] = bam
 
     if 'step3' in obj['steps']:
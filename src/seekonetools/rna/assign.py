@@ -0,0 +1,65 @@
+import os
+from bisect import bisect_right
+from multiprocessing import Pool
+import pysam
+from ..utils.annotation import GeneIndex
+from .collate import read_record, shard_bounds
+
+_index = None
+
+
+def assign_contig(bam, contig, chunk, outdir, shards=64, reverse=False, frac_overlap=0.5):
+    '''
+    assign the alignments of one contig to genes like featureCounts -M -O --fracOverlap,
+    and write (barcode, umi, qname, XT, mapq) to outdir/shard_{i}.{chunk}.tsv.
+    a gene is assigned when its features on the expected strand cover at least
+    frac_overlap of the aligned bases, XT lists all assigned genes separated by ','.
+    '''
+    bounds = shard_bounds(shards)
+    fhs = {}
+    n = 0
+    with pysam.AlignmentFile(bam) as fh:
+        for r in fh.fetch(contig):
+            if r.is_unmapped:
+                continue
+            strand = '-' if r.is_reverse != reverse else '+'
+            blocks = r.get_blocks()
+            min_bases = max(1, frac_overlap * sum(e - s for s, e in blocks))
+            bases = _index.exon_bases(contig, strand, blocks)
+            XT = ','.join(sorted(_index.genes[g] for g, b in bases.items() if b >= min_bases))
+            record = read_record(r, XT)
+            i = bisect_right(bounds, record[0])
+            if i not in fhs:
+                fhs[i] = open(os.path.join(outdir, f'shard_{i:04d}.{chunk:05d}.tsv'), 'w')
+            fhs[i].write('\t'.join(map(str, record)) + '\n')
+            n += 1
+    for _ in fhs.values():
+        _.close()
+    return n
+
+def _assign(args):
+    return assign_contig(*args)
+
+def assign(bam, gtf, outdir, region='exon', SC5P=False, core=4, shards=64, frac_overlap=0.5, genomeDir=None):
+    '''
+    gene assignment of a coordinate sorted and indexed bam, one contig per process.
+    the shards in outdir are read by step3 (collate.collated_records) in place of a name sorted bam.
+    return outdir.
+    '''
+    global _index
+    os.makedirs(outdir, exist_ok=True)
+    for name in os.listdir(outdir):
+        if name.startswith('shard_'):
+            os.remove(os.path.join(outdir, name))
+    if not os.path.exists(f'{bam}.bai'):
+        pysam.index('-@', str(core), bam)
+    _index = GeneIndex.from_gtf(gtf, feature=region, genomeDir=genomeDir)
+    with pysam.AlignmentFile(bam) as fh:
+        # chunk编号按bam中contig的顺序, step3按此顺序读取
+        contigs = sorted(enumerate(zip(fh.references, fh.lengths)), key=lambda x: -x[1][1])
+    args = [(bam, contig, chunk, outdir, shards, SC5P, frac_overlap) for chunk, (contig, _) in contigs]
+    # 子进程fork时继承_index
+    with Pool(core) as pool:
+        pool.map(_assign, args, chunksize=1)
+    _index = None
+    return outdir
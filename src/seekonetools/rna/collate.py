@@ -0,0 +1,228 @@
+import os
+import re
+import zlib
+import heapq
+import struct
+import tempfile
+from bisect import bisect_right
+from itertools import product, groupby, islice
+import pysam
+
+_DIGITS = re.compile(r'\d+')
+# read_shard在内存中排序的最大记录数
+SORT_CHUNK = 1 << 19
+BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+# SAM规范的QNAME
+_QNAME = re.compile(rb'[!-?A-~]{1,254}')
+
+
+def name_key(qname: str) -> str:
+    '''
+    sort key of read names in the same order as samtools sort -n (strnum_cmp):
+    digit runs are compared by value, other characters one by one.
+    '''
+    def _num(m):
+        digits = m.group().lstrip('0')
+        return '0' + chr(0x100 + len(digits)) + digits
+    return _DIGITS.sub(_num, qname)
+
+def read_record(r, XT: str) -> tuple:
+    '''
+    (barcode, umi, qname, XT, mapq) of an alignment, XT is '' for unassigned reads.
+    barcode and umi are read from CB/UB tags, or from read names (barcode_umi_...) of untagged bams.
+    '''
+    if r.has_tag('CB'):
+        return r.get_tag('CB'), r.get_tag('UB'), r.query_name, XT, r.mapping_quality
+    barcode, umi = r.query_name.split('_')[:2]
+    return barcode, umi, r.query_name, XT, r.mapping_quality
+
+def bam_records(reads):
+    for r in reads:
+        yield read_record(r, r.get_tag('XT') if r.has_tag('XT') else '')
+
+def shard_bounds(shards: int) -> list:
+    # 按barcode前缀均分, 分片之间保持barcode的字典序
+    k = 0
+    while 4 ** k < shards:
+        k += 1
+    prefixes = [''.join(_) for _ in product('ACGT', repeat=k)]
+    return [prefixes[i * len(prefixes) // shards] for i in range(1, shards)]
+
+def collate(bam: str, outdir: str, shards: int=64) -> str:
+    '''
+    split the alignments of bam into shards by barcode in one pass, instead of sorting by name.
+    shard i holds a range of barcodes, so reading the shards in order gives sorted barcodes.
+    return outdir.
+    '''
+    os.makedirs(outdir, exist_ok=True)
+    bounds = shard_bounds(shards)
+    fhs = [open(os.path.join(outdir, f'shard_{i:04d}.tsv'), 'w') for i in range(shards)]
+    with pysam.AlignmentFile(bam, 'rb') as sam_file:
+        for record in bam_records(sam_file):
+            fhs[bisect_right(bounds, record[0])].write('\t'.join(map(str, record)) + '\n')
+    for fh in fhs:
+        fh.close()
+    return outdir
+
+def _read_records(paths: list):
+    for path in paths:
+        with open(path) as fh:
+            for line in fh:
+                barcode, umi, qname, XT, mapq = line.rstrip('\n').split('\t')
+                yield barcode, umi, qname, XT, int(mapq)
+
+def _sort_key(record: tuple) -> tuple:
+    return record[0], name_key(record[2])
+
+def read_shard(paths: list, chunk: int=SORT_CHUNK):
+    '''
+    records of a shard (one or more files in bam order), grouped by barcode and then
+    by read name like samtools sort -t CB -n. alignments of a read keep their order in the bam.
+    shards of more than `chunk` records are sorted in chunks written next to the shard and merged.
+    '''
+    records = _read_records(paths)
+    block = sorted(islice(records, chunk), key=_sort_key)
+    if len(block) < chunk:
+        yield from block
+        return
+    # 外部排序: 各块排序后写出, 再按顺序归并(heapq.merge与sort一样是稳定的)
+    with tempfile.TemporaryDirectory(prefix='sort_', dir=os.path.dirname(paths[0])) as tmpdir:
+        files = []
+        while block:
+            files.append(os.path.join(tmpdir, f'{len(files):05d}.tsv'))
+            with open(files[-1], 'w') as fh:
+                for record in block:
+                    fh.write('\t'.join(map(str, record)) + '\n')
+            block = sorted(islice(records, chunk), key=_sort_key)
+        yield from heapq.merge(*[_read_records([_]) for _ in files], key=_sort_key)
+
+def collated_shards(collate_dir: str) -> list:
+    # shard_{i}.tsv, 或按chunk写出的shard_{i}.{chunk}.tsv
+    names = sorted(_ for _ in os.listdir(collate_dir) if _.startswith('shard_'))
+    return [[os.path.join(collate_dir, name) for name in g]
+            for _, g in groupby(names, key=lambda x: x.split('.')[0])]
+
+def collated_records(collate_dir: str):
+    for paths in collated_shards(collate_dir):
+        yield from read_shard(paths)
+
+def _bgzf_block(raw, coffset: int):
+    # (解压后的数据, 下一个block的位置), 不是有效的BGZF block时返回None
+    raw.seek(coffset)
+    header = raw.read(18)
+    if len(header) < 18 or header[:4] != BGZF_MAGIC or header[10:16] != b'\x06\x00BC\x02\x00':
+        return None
+    bsize = struct.unpack_from('<H', header, 16)[0] + 1
+    body = raw.read(bsize - 18)
+    if len(body) != bsize - 18 or len(body) < 8:
+        return None
+    crc, isize = struct.unpack_from('<II', body, len(body) - 8)
+    try:
+        data = zlib.decompress(body[:-8], -15)
+    except zlib.error:
+        return None
+    if len(data) != isize or zlib.crc32(data) != crc:
+        return None
+    return data, coffset + bsize
+
+def _next_block(raw, offset: int):
+    # offset之后第一个BGZF block的位置, block不超过64KB
+    raw.seek(offset)
+    window = raw.read(1 << 17)
+    p = window.find(BGZF_MAGIC)
+    while p >= 0:
+        if _bgzf_block(raw, offset + p) is not None:
+            return offset + p
+        p = window.find(BGZF_MAGIC, p + 1)
+    return None
+
+def _is_record(buf: bytes, p: int, n_ref: int, chain: int=3) -> bool:
+    # 从p开始连续chain条记录的字段都合理时, 认为p是记录的起点
+    for i in range(chain):
+        if p + 36 > len(buf):
+            return i > 0
+        block_size, ref, pos, l_name, _, _, n_cigar, _, l_seq, next_ref, next_pos = struct.unpack_from('<iiiBBHHHiii', buf, p)
+        if not (-1 <= ref < n_ref and -1 <= next_ref < n_ref and pos >= -1 and next_pos >= -1):
+            return False
+        if l_name < 2 or l_seq < 0 or 32 + l_name + 4 * n_cigar + (l_seq + 1) // 2 + l_seq > block_size:
+            return False
+        name = buf[p + 36:p + 35 + l_name]
+        if buf[p + 35 + l_name:p + 36 + l_name] not in (b'\x00', b'') or not _QNAME.fullmatch(name):
+            return False
+        p += 4 + block_size
+    return True
+
+def _next_record(raw, offset: int, n_ref: int):
+    '''
+    virtual offset of the first alignment starting in the first bgzf block after byte offset,
+    found by checking the fields of a few consecutive records (like the split guesser of Hadoop-BAM).
+    None at the end of the bam.
+    '''
+    coffset = _next_block(raw, offset)
+    while coffset is not None:
+        blocks, c = [], coffset
+        while len(blocks) < 3:
+            block = _bgzf_block(raw, c)
+            if block is None:
+                break
+            blocks.append((c, block[0]))
+            c = block[1]
+        # 空block为文件结尾
+        if not blocks or not blocks[0][1]:
+            return None
+        buf = b''.join(data for _, data in blocks)
+        for p in range(len(blocks[0][1])):
+            if _is_record(buf, p, n_ref):
+                return (coffset << 16) | p
+        coffset = blocks[1][0] if len(blocks) > 1 else None
+    return None
+
+def read_barcode(r) -> str:
+    return r.get_tag('CB') if r.has_tag('CB') else r.query_name.split('_', 1)[0]
+
+def bam_parts(bam: str, parts: int, threads: int=1) -> list:
+    '''
+    split a bam grouped by barcode into about `parts` ranges of whole barcode groups,
+    without reading the whole bam: the file is cut at even compressed offsets, each cut
+    moves to the next record (see _next_record) and then to the next barcode.
+    return [(start, end)] virtual offsets of the first record of a range and of the next range (None: eof).
+    '''
+    size = os.path.getsize(bam)
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as fh, open(bam, 'rb') as raw:
+        cuts = [fh.tell()]
+        for i in range(1, parts):
+            offset = _next_record(raw, i * size // parts, fh.nreferences)
+            if offset is None:
+                break
+            if offset <= cuts[-1]:
+                continue
+            # 跳过起点所在的barcode
+            fh.seek(offset)
+            first = None
+            while True:
+                offset = fh.tell()
+                try:
+                    r = next(fh)
+                except StopIteration:
+                    offset = None
+                    break
+                barcode = read_barcode(r)
+                if first is None:
+                    first = barcode
+                elif barcode != first:
+                    break
+            if offset is None:
+                break
+            if offset > cuts[-1]:
+                cuts.append(offset)
+    return list(zip(cuts, cuts[1:] + [None]))
+
+def bam_range(bam: str, start: int, end: int=None, threads: int=1):
+    # 读取[start, end)之间的记录
+    with pysam.AlignmentFile(bam, 'rb', threads=threads) as fh:
+        fh.seek(start)
+        while end is None or fh.tell() < end:
+            try:
+                yield next(fh)
+            except StopIteration:
+                break
@@ -1,6 +1,7 @@
 import re
 from functools import partial, lru_cache
 from xopen import xopen
+from .whitelist import load_index
 
 
 def generate_mismatch_sequence(sequence: str, bases: str='ATCG') -> dict:
@@ -59,6 +60,20 @@ def correct_seq(seq: str, perfect: dict, indel: dict=None, mis: dict=None,
     # print(code, shift, seq)
     return code, shift, seq
 
+def correct_seq_index(seq: str, index, seqafter: str=None, linker: str=None) -> tuple:
+    # 同correct_seq, 查询预编译的白名单索引(whitelist.WhitelistIndex)
+    code, target = index.lookup(seq)
+    if code == 1:
+        return 1, 0, seq
+    elif code == 3:
+        return 3, 0, target
+    elif code == 2:
+        if (not linker) or linker.startswith(seq[-1] + seqafter):
+            return 2, -1, target
+    elif code == -1:
+        return -1, 0, seq
+    return 0, 0, seq
+
 
 def prepare_funcs(structure: str, _barcode: list=None, _linker: list=None,
                     B: tuple=(0, 0), L:tuple=(0, 0)) -> tuple:
@@ -80,17 +95,17 @@ def prepare_funcs(structure: str, _barcode: list=None, _linker: list=None,
     for _, (code, n) in enumerate(r1_structure):
         if code == 'B':
             if do_correct['B']:
-                tmp = build_dict(barcode.get(barcode_idx, barcode[0]), *B)
+                index = load_index(barcode.get(barcode_idx, barcode[0]), *B)
                 if r1_structure[_+1][0] == 'L' and do_correct['L']:
                     funcs.append(
-                        partial(correct_seq, linker=linker.get(linker_idx, linker[0]),
-                            **tmp
+                        partial(correct_seq_index, linker=linker.get(linker_idx, linker[0]),
+                            index=index
                         )
                     )
                 else:
                     funcs.append(
-                        partial(correct_seq,
-                            **tmp
+                        partial(correct_seq_index,
+                            index=index
                         )
                     )
             else:
@@ -98,10 +113,10 @@ def prepare_funcs(structure: str, _barcode: list=None, _linker: list=None,
             barcode_idx += 1
         elif code == 'L':
             if do_correct['L']:
-                tmp = build_dict(linker.get(linker_idx, linker[0]), *L)
+                index = load_index(linker.get(linker_idx, linker[0]), *L)
                 funcs.append(
-                    partial(correct_seq,
-                        **tmp
+                    partial(correct_seq_index,
+                        index=index
                     )
                 )
             else:
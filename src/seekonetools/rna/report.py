@@ -6,6 +6,7 @@ import lzstring
 import scipy.io as io
 import plotly.express as px
 import plotly.graph_objects as go
+from ..utils.perf import step
 
 template_dir = os.path.join(os.path.dirname(__file__), 'template')
 data = {}
@@ -240,6 +241,7 @@ def png2base64(f):
     with open(f, 'rb') as fh:
         return base64.b64encode(fh.read()).decode()
 
+@step('report')
 def report(samplename, outdir, **kwargs):
     import json
     from jinja2 import Environment, FileSystemLoader
@@ -294,7 +296,7 @@ def report(samplename, outdir, **kwargs):
     assert os.path.exists(reduction_xls), f'{reduction_xls} not found!'
     reduction_data(reduction_xls)
 
-    count_xls = os.path.join(outdir, 'step3', 'counts.xls')
+    count_xls = os.path.join(outdir, 'step3', 'counts')
     barcodes_tsv = os.path.join(outdir, 'step3', 'filtered_feature_bc_matrix', 'barcodes.tsv.gz')
     #barcode_rank_data(count_xls, barcodes_tsv)
     cells_gz = os.path.join(outdir, 'step3/filtered_feature_bc_matrix/barcodes.tsv.gz')
@@ -0,0 +1,94 @@
+import os
+from collections import defaultdict
+from multiprocessing import Pool
+import pysam
+from ..utils.annotation import GeneIndex
+
+_index = None
+
+ALIGNMENT_KEYS = [
+    'reads aligned', 'total alignments', 'secondary alignments', 'non-unique alignments',
+    'aligned to genes', 'ambiguous alignments', 'no feature assigned', 'not aligned'
+]
+ORIGIN_KEYS = ['exonic', 'intronic', 'intergenic', 'overlapping exon']
+
+
+def classify_contig(bam, contig, reverse=False):
+    '''
+    count the reads of one contig like qualimap rnaseq.
+    only primary alignments with NH == 1 are assigned: to a gene when their blocks overlap exons
+    of exactly one gene on the expected strand, exonic if they overlap exons (overlapping exon
+    when some bases are outside the exons), intronic if they overlap a gene, otherwise intergenic.
+    '''
+    counts = defaultdict(int)
+    with pysam.AlignmentFile(bam) as fh:
+        for read in fh.fetch(contig):
+            if read.is_unmapped or read.is_supplementary:
+                continue
+            counts['total alignments'] += 1
+            nh = read.get_tag('NH') if read.has_tag('NH') else 1
+            if nh > 1:
+                counts['non-unique alignments'] += 1
+            if read.is_secondary:
+                counts['secondary alignments'] += 1
+                continue
+            counts['reads aligned'] += 1
+            if nh > 1:
+                continue
+            strand = '-' if read.is_reverse != reverse else '+'
+            blocks = read.get_blocks()
+            genes = _index.exon_genes(contig, strand, blocks)
+            if len(genes) == 1:
+                counts['aligned to genes'] += 1
+            elif genes:
+                counts['ambiguous alignments'] += 1
+            else:
+                counts['no feature assigned'] += 1
+            if genes:
+                counts['exonic'] += 1
+                if not _index.in_exons(contig, strand, blocks):
+                    counts['overlapping exon'] += 1
+            elif _index.span_genes(contig, strand, blocks):
+                counts['intronic'] += 1
+            else:
+                counts['intergenic'] += 1
+    return counts
+
+def _classify(args):
+    return classify_contig(*args)
+
+def write_results(counts, bam, gtf, outfile):
+    # 与qualimap的rnaseq_qc_results.txt格式一致, step2.mapping_summary可直接读取
+    origin = sum(counts[k] for k in ORIGIN_KEYS[:3]) or 1
+    with open(outfile, 'w') as fh:
+        fh.write('RNA-Seq QC report\n-----------------------------------\n\n')
+        fh.write(f'>>>>>>> Input\n\n    bam file = {bam}\n    gff file = {gtf}\n\n\n')
+        fh.write('>>>>>>> Reads alignment\n\n')
+        for k in ALIGNMENT_KEYS:
+            fh.write(f'    {k} = {counts[k]:,}\n')
+        fh.write('\n\n>>>>>>> Reads genomic origin\n\n')
+        for k in ORIGIN_KEYS:
+            fh.write(f'    {k} = {counts[k]:,} ({counts[k] / origin:.2%})\n')
+    return outfile
+
+def rnaseq_qc(bam, gtf, outdir, SC5P=False, core=4, genomeDir=None):
+    '''
+    exonic/intronic/intergenic summary of a coordinate sorted bam, sharded by contig.
+    return the path of rnaseq_qc_results.txt.
+    '''
+    global _index
+    if not os.path.exists(f'{bam}.bai'):
+        pysam.index('-@', str(core), bam)
+    _index = GeneIndex.from_gtf(gtf, genomeDir=genomeDir)
+    with pysam.AlignmentFile(bam) as fh:
+        contigs = sorted(zip(fh.references, fh.lengths), key=lambda x: -x[1])
+        unmapped = fh.unmapped
+    counts = defaultdict(int)
+    counts['not aligned'] = unmapped
+    # 子进程fork时继承_index
+    with Pool(core) as pool:
+        for _counts in pool.imap_unordered(_classify, [(bam, c, SC5P) for c, _ in contigs]):
+            for k, v in _counts.items():
+                counts[k] += v
+    _index = None
+    return write_results(counts, bam, gtf, os.path.join(outdir, 'rnaseq_qc_results.txt'))
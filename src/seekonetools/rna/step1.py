@@ -3,9 +3,15 @@ import json
 from functools import partial
 from collections import defaultdict, Counter
 import dnaio
+import numpy as np
 from cutadapt import adapters
-from ..utils.pipeline import Pipeline
+from ..utils.pipeline import Pipeline, parse_size
+from ..utils.fastq import (as_array, parse_chunk, pad_matrix, gather,
+                           pack_matrix, gather_ranges, base_matrix, qual_matrix,
+                           scan_polya, maybe_polya, GC_BASES, POLYA_ALIGN, POLYA_NONE)
+from ..utils.bam import encode_unaligned, encode_unaligned_batch, unaligned_header
 from .helper import prepare_funcs
+from ..utils.perf import step
 from ..utils._version import __version__
 
 
@@ -18,22 +24,40 @@ class Stat:
             self.data = d
         else:
             for k, v in d.items():
-                self.data[k] += v
+                if isinstance(v, np.ndarray):
+                    self.data[k] = self._add(self.data[k], v)
+                else:
+                    self.data[k] += v
+
+    @staticmethod
+    def _add(a, b):
+        # position x base/phred计数矩阵, 行数不同时补0
+        if a.shape[0] < b.shape[0]:
+            a, b = b, a
+        a = a.copy()
+        a[:b.shape[0]] += b
+        return a
 
     @staticmethod
-    def _sort_gc(d):
-        idx_max = max([k[0] for k in d])
+    def _max_position(m):
+        rows = np.flatnonzero(m.any(axis=1))
+        return int(rows[-1]) if rows.shape[0] else 0
+
+    @classmethod
+    def _sort_gc(cls, m):
+        idx_max = cls._max_position(m)
         return {
-            b: [d.get((i, b), 0) for i in range(idx_max)] for b in 'ATCGN'
+            b: m[:idx_max, j].tolist() for j, b in enumerate(GC_BASES)
         }
 
-    @staticmethod
-    def _sort_q(d, phred=33):
-        idx_max = max([k[0] for k in d])
-        q_max = max([ord(k[1])-phred for k in d])
+    @classmethod
+    def _sort_q(cls, m):
+        idx_max = cls._max_position(m)
+        cols = np.flatnonzero(m.any(axis=0))
+        q_max = int(cols[-1]) if cols.shape[0] else -1
         return {
-            i: [d.get((i, chr(q+phred)), 0) for q in range(q_max+1)] for i in range(idx_max)
-        }      
+            i: m[i, :q_max+1].tolist() for i in range(idx_max)
+        }
 
     def save(self, path='summary.json'):
         tmp = {'__version__': __version__}
@@ -48,13 +72,10 @@ class Stat:
             json.dump(tmp, fh, indent=4)
 
 def process_barcode(fq1, fq2, fq_out, shift, shift_pattern,
-                r1_structure, funcs,  minlen=50):
-    Barcode_GC_Counter = Counter()
-    UMI_GC_Counter = Counter()
-    R2_GC_Counter = Counter()
-    Barcode_Q_Counter = Counter()
-    UMI_Q_Counter = Counter()
-    R2_Q_Counter = Counter()
+                r1_structure, funcs,  minlen=50, outformat='fastq'):
+    # 逐条收集, chunk结束时统一计数
+    barcode_seqs, umi_seqs, r2_seqs = [], [], []
+    barcode_quals, umi_quals, r2_quals = [], [], []
     stat_Dict = defaultdict(int)
 
     start_pos = 0
@@ -63,7 +84,8 @@ def process_barcode(fq1, fq2, fq_out, shift, shift_pattern,
     shift_pos = 0
     polyA_filter = adapters.BackAdapter(sequence='AAAAAAAAAAAAAAA')
 
-    outfh = dnaio.open(fq_out, fileformat='fastq', mode='w')
+    if outformat == 'fastq':
+        outfh = dnaio.open(fq_out, fileformat='fastq', mode='w')
     fh = dnaio.open(file1=fq1, file2=fq2, fileformat='fastq', mode='r')
     for r1, r2 in fh:
         stat_Dict['total'] += 1
@@ -117,7 +139,7 @@ def process_barcode(fq1, fq2, fq_out, shift, shift_pattern,
         umi_base = new_seqs['U'][0]
 
         # filter polyA
-        match = polyA_filter.match_to(r2.sequence)
+        match = polyA_filter.match_to(r2.sequence) if maybe_polya(r2.sequence) else None
         if match:
             r2 = match.trimmed(r2)
             _len = len(r2)
@@ -127,36 +149,206 @@ def process_barcode(fq1, fq2, fq_out, shift, shift_pattern,
             else:
                 stat_Dict['trimmed'] += 1
 
-        # barcode_umi_:oldpart:_readID
-        __barcode = ':'.join( ['' if n==o else o for n, o in zip(new_seqs['B'], old_seqs['B'])] )
-        r2.name = '_'.join([barcode_base, umi_base, __barcode, r2.name])
-        outfh.write(r2)
-
-        Barcode_GC_Counter.update(enumerate(barcode_base))
-        UMI_GC_Counter.update(enumerate(umi_base))
-        R2_GC_Counter.update(enumerate(r2.sequence))
-        Barcode_Q_Counter.update(enumerate(seq_quals['B']))
-        UMI_Q_Counter.update(enumerate(seq_quals['U']))
-        R2_Q_Counter.update(enumerate(r2.qualities))
-
-    outfh.close()
+        if outformat == 'bam':
+            # 未比对的bam, barcode和umi写入tag
+            tags = [('CB', barcode_base), ('CR', ''.join(old_seqs['B'])), ('UB', umi_base), ('UR', umi_base)]
+            fq_out.write(encode_unaligned(r2.name.split()[0], r2.sequence, r2.qualities, tags))
+        else:
+            # barcode_umi_:oldpart:_readID
+            __barcode = ':'.join( ['' if n==o else o for n, o in zip(new_seqs['B'], old_seqs['B'])] )
+            r2.name = '_'.join([barcode_base, umi_base, __barcode, r2.name])
+            outfh.write(r2)
+
+        barcode_seqs.append(barcode_base)
+        umi_seqs.append(umi_base)
+        r2_seqs.append(r2.sequence)
+        barcode_quals.append(seq_quals['B'])
+        umi_quals.append(seq_quals['U'])
+        r2_quals.append(r2.qualities)
+
+    if outformat == 'fastq':
+        outfh.close()
     fh.close()
+
+    def counts(seqs, func):
+        buf = np.frombuffer(''.join(seqs).encode(), dtype=np.uint8)
+        return func(buf, np.array([len(_) for _ in seqs], dtype=np.int64))
+
+    return {
+            'stat': Counter(stat_Dict),
+            'barcode_gc': counts(barcode_seqs, base_matrix),
+            'umi_gc': counts(umi_seqs, base_matrix),
+            'r2_gc': counts(r2_seqs, base_matrix),
+            'barcode_q': counts(barcode_quals, qual_matrix),
+            'umi_q': counts(umi_quals, qual_matrix),
+            'r2_q': counts(r2_quals, qual_matrix)
+        }
+
+def process_barcode_batch(fq1, fq2, fq_out, shift, shift_pattern,
+                r1_structure, funcs,  minlen=50, outformat='fastq'):
+    # 整个chunk转为numpy数组处理, 输出和stat与process_barcode一致
+    buf1 = as_array(fq1)
+    buf2 = as_array(fq2)
+    rec1 = parse_chunk(buf1)
+    rec2 = parse_chunk(buf2)
+    seq_start, seq_len = rec1['sequence']
+    qual_start = rec1['qualities'][0]
+    total = seq_start.shape[0]
+    if rec2['sequence'][0].shape[0] != total:
+        raise ValueError('Reads are improperly paired. There are more reads in one file than in the other.')
+    seqs = pad_matrix(buf1, seq_start, seq_len)
+
+    start = np.zeros(total, dtype=np.int64)
+    alive = np.ones(total, dtype=bool)
+    if shift:
+        # 等价于sequence[:7].find(shift_pattern)
+        pattern = np.frombuffer(shift_pattern.encode(), dtype=np.uint8)
+        m = pattern.shape[0]
+        shift_pos = np.full(total, -1, dtype=np.int64)
+        for j in range(7 - m, -1, -1):
+            if j + m > seqs.shape[1]:
+                continue
+            hit = (seqs[:, j:j + m] == pattern).all(axis=1) & (j + m <= np.minimum(seq_len, 7))
+            shift_pos[hit] = j
+        alive = shift_pos >= 0
+        start = np.where(alive, shift_pos + 1, 0)
+    anchored = alive.copy()
+
+    fail = np.full(total, -1, dtype=np.int64)
+    segments = []
+    for i, ((code, n), func) in enumerate(zip(r1_structure, funcs)):
+        end = start + n
+        seg_len = np.clip(np.minimum(end, seq_len) - start, 0, None)
+        seg = {'code': code, 'start': start, 'len': seg_len, 'index': None}
+        if func:
+            # 处理需要做纠错的code
+            index = func.keywords['index']
+            linker = func.keywords.get('linker')
+            keys = pack_matrix(gather(seqs, start, n), seg_len)
+            correct_code, rows = index.lookup_packed(keys)
+            if linker:
+                for j in np.flatnonzero(alive & (correct_code == 2)):
+                    a = seq_start[j]
+                    last = chr(buf1[a + start[j] + seg_len[j] - 1])
+                    after = buf1[a + min(end[j], seq_len[j]):a + min(end[j] + 3, seq_len[j])].tobytes().decode()
+                    if not linker.startswith(last + after):
+                        correct_code[j] = 0
+            bad = alive & (correct_code < 1)
+            fail[bad] = i
+            alive &= ~bad
+            seg.update(index=index, correct_code=correct_code, rows=rows)
+            start = end - (correct_code == 2)
+        else:
+            start = end
+        segments.append(seg)
+
+    # polyA过滤, 整个chunk扫描, 只有无法直接判断的read才调用cutadapt
+    name2_start, name2_len = rec2['name']
+    seq2_start, seq2_len = rec2['sequence']
+    qual2_start = rec2['qualities'][0]
+    rstart = scan_polya(buf2, seq2_start, seq2_len)
+    polyA_filter = adapters.BackAdapter(sequence='AAAAAAAAAAAAAAA')
+    raw2 = buf2.tobytes()
+    for j in np.flatnonzero(alive & (rstart == POLYA_ALIGN)):
+        match = polyA_filter.match_to(raw2[seq2_start[j]:seq2_start[j] + seq2_len[j]].decode())
+        rstart[j] = match.rstart if match else POLYA_NONE
+    too_short = alive & (rstart >= 0) & (rstart < minlen)
+    trimmed = alive & (rstart >= minlen)
+    trim_len = np.where(trimmed, rstart, seq2_len)
+    out = np.flatnonzero(alive & ~too_short)
+
+    # stat, key的顺序与逐条处理时首次出现的顺序一致
+    events = [(0, 0, 'total', total)]
+    if not anchored.all():
+        events.append((np.argmin(anchored), 1, 'no_anchor', int((~anchored).sum())))
+    fail_codes = np.array([seg['code'] for seg in segments] + [''])[fail]
+    for code in set(fail_codes[fail >= 0]):
+        idx = np.flatnonzero(fail_codes == code)
+        events.append((idx[0], 1, str(code), idx.shape[0]))
+    for key, mask, phase in (('valid', alive, 1), ('trimmed', trimmed, 2), ('too_short', too_short, 2)):
+        if mask.any():
+            events.append((np.argmax(mask), phase, key, int(mask.sum())))
+    stat_Dict = {k: v for _, _, k, v in sorted(events)}
+
+    # 各部分在src中的位置, 按read拼接输出
+    consts = np.frombuffer(b'@_:\n+', dtype=np.uint8)
+    parts = [buf1, buf2]
+    new_B, old_B, raw_B, qual_B, umi, qual_U = [], [], [], [], [], []
+    for seg in segments:
+        st = seq_start[out] + seg['start'][out]
+        ln = seg['len'][out]
+        if seg['code'] == 'B':
+            raw_B.append((st, ln))
+            qual_B.append((qual_start[out] + seg['start'][out], ln))
+            if seg['index'] is not None:
+                wl = np.asarray(seg['index'].whitelist[seg['rows'][out]])
+                width = wl.dtype.itemsize
+                offset = sum(p.shape[0] for p in parts)
+                parts.append(wl.view(np.uint8))
+                new_B.append((offset + np.arange(out.shape[0]) * width, np.char.str_len(wl)))
+                old_B.append((st, np.where(seg['correct_code'][out] == 1, 0, ln)))
+            else:
+                new_B.append((st, ln))
+                old_B.append((st, np.zeros_like(ln)))
+        elif seg['code'] == 'U':
+            umi.append((st, ln))
+            qual_U.append((qual_start[out] + seg['start'][out], ln))
+    offset = sum(p.shape[0] for p in parts)
+    parts.append(consts)
+    src = np.concatenate(parts)
+    at, underline, colon, newline, plus = [(np.full(out.shape[0], offset + k), np.ones(out.shape[0], dtype=np.int64)) for k in range(5)]
+    base2 = buf1.shape[0]
+    name2 = (base2 + name2_start[out], name2_len[out])
+    seq2 = (base2 + seq2_start[out], trim_len[out])
+    qual2 = (base2 + qual2_start[out], trim_len[out])
+
+    if outformat == 'bam':
+        # read名称只保留第一个空白之前的部分
+        ws = np.flatnonzero((buf2 == 32) | (buf2 == 9))
+        idx = np.searchsorted(ws, name2_start[out])
+        first = np.append(ws, buf2.shape[0])[idx]
+        name = (name2[0], np.minimum(first - name2_start[out], name2[1]))
+        tags = [('CB', new_B), ('CR', raw_B), ('UB', umi[:1]), ('UR', umi[:1])]
+        fq_out.write(encode_unaligned_batch(src, name, seq2, qual2, tags))
+    else:
+        # barcode_umi_:oldpart:_readID
+        pieces = [at] + new_B + [underline, umi[0], underline]
+        for k, p in enumerate(old_B):
+            if k:
+                pieces.append(colon)
+            pieces.append(p)
+        pieces += [underline, name2, newline, seq2, newline, plus, newline, qual2, newline]
+        starts = np.stack([p[0] for p in pieces], axis=1)
+        lengths = np.stack([p[1] for p in pieces], axis=1)
+        fq_out.write(gather_ranges(src, starts, lengths))
+
+    def counts(ranges, func):
+        if not ranges:
+            return func(np.zeros(0, dtype=np.uint8), np.zeros(out.shape[0], dtype=np.int64))
+        starts = np.stack([p[0] for p in ranges], axis=1)
+        lengths = np.stack([p[1] for p in ranges], axis=1)
+        return func(gather_ranges(src, starts, lengths), lengths.sum(axis=1))
+
     return {
             'stat': Counter(stat_Dict),
-            'barcode_gc':Barcode_GC_Counter,
-            'umi_gc': UMI_GC_Counter,
-            'r2_gc': R2_GC_Counter,
-            'barcode_q': Barcode_Q_Counter,
-            'umi_q': UMI_Q_Counter,
-            'r2_q': R2_Q_Counter
+            'barcode_gc': counts(new_B, base_matrix),
+            'umi_gc': counts(umi[:1], base_matrix),
+            'r2_gc': counts([seq2], base_matrix),
+            'barcode_q': counts(qual_B, qual_matrix),
+            'umi_q': counts(qual_U, qual_matrix),
+            'r2_q': counts([qual2], qual_matrix)
         }
 
 
+@step('barcode')
 def barcode(fq1:list, fq2:list, samplename: str, outdir:str,
             barcode:list=[], shift:str=True, shift_pattern:str='A',
             structure:str='B8L15B8L15B8U12T15', linker: list=[],
             B:tuple=(1,0), L:tuple=(1,0), core:int=4, logger:object=None,
-            **kwargs):
+            batch:bool=False, shm:bool=False, compress:str='bgzf', compresslevel:int=6,
+            lanes:int=2, read_threads:int=None, outformat:str='fastq', resume:bool=False,
+            autotune:bool=False, max_mem:str=None, unordered:bool=False, reorder_window:int=None,
+            fqout:str=None, opener=None, tee:str=None, **kwargs):
 
     logger.info('cellbarcode started!')
     outdir1 = os.path.join(outdir, 'step1')
@@ -173,21 +365,60 @@ def barcode(fq1:list, fq2:list, samplename: str, outdir:str,
 
     # start worker processes
     worker_func = partial(
-                    process_barcode,
+                    process_barcode_batch if batch else process_barcode,
                     shift=shift,
                     shift_pattern=shift_pattern,
                     r1_structure=r1_structure,
-                    funcs=funcs
+                    funcs=funcs,
+                    outformat=outformat
                     )
     logger.info('test func')
+    if outformat == 'bam':
+        # bam必须是bgzf格式
+        compress = 'bgzf'
+        header = unaligned_header(__version__)
+        outfile = os.path.join(outdir1, f'{samplename}_2.bam')
+    else:
+        header = None
+        outfile = os.path.join(outdir1, f'{samplename}_2.fq.gz')
+    if fqout:
+        # 输出未压缩的fastq到fqout(如命名管道), 由opener打开, tee为压缩的副本
+        if outformat != 'fastq':
+            raise ValueError('only fastq output can be streamed')
+        outfile, compress = fqout, 'xopen'
+    if fqout or compress == 'xopen':
+        # xopen压缩的输出无法按chunk截断
+        manifest, checkpoint = None, None
+    else:
+        manifest = os.path.join(outdir1, f'{samplename}_manifest.jsonl')
+        # 乱序输出不能断点续跑
+        checkpoint = None if unordered else os.path.join(outdir1, f'{samplename}_checkpoint.pkl')
     stat = Stat()
     pipeline = Pipeline(
         func = worker_func,
         fq1 = fq1,
         fq2 = fq2,
-        fqout1=os.path.join(outdir1, f'{samplename}_2.fq.gz'),
+        fqout1=outfile,
         stat=stat,
         core=core,
+        transport='shm' if shm else 'pipe',
+        compress=None if compress == 'xopen' else compress,
+        compresslevel=compresslevel,
+        lanes=lanes,
+        read_threads=read_threads,
+        header=header,
+        manifest=manifest,
+        checkpoint=checkpoint,
+        resume=resume,
+        autotune=autotune or bool(max_mem),
+        max_mem=parse_size(max_mem) if max_mem else None,
+        ordered=not unordered,
+        window=reorder_window,
+        opener=opener,
+        tee=tee,
     )
     pipeline.run()
+    if pipeline.tuner:
+        stat.data['pipeline'] = pipeline.tuner.settings
     pipeline.stat.save(os.path.join(outdir, f'{samplename}_summary.json'))
+    return outfile
@@ -1,29 +1,103 @@
 import os
 import json
+import shutil
 from collections import defaultdict
-from subprocess import run
+from subprocess import PIPE, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import pysam
+from xopen import xopen
+from ..utils.pipeline import parse_size
+from ..utils.perf import run, popen, wait as wait_proc, step
 
 
-def run_STAR(fq, genomeDir, prefix, core=4, star_path='STAR'):
+def STAR_args(fq, genomeDir, prefix, core=4, star_path='STAR', samtools_path='samtools',
+              sort_mode='file', sort_ram=None, genome_load=None):
+    '''
+    sort_mode: file/pipe, unsorted bam to Aligned.out.bam/stdout; star, STAR sorts by coordinate.
+    genome_load: --genomeLoad of STAR, e.g. LoadAndKeep to use a genome in shared memory.
+    '''
     args = [
         star_path, '--runThreadN', core, '--limitOutSJcollapsed', 5000000,
-        '--genomeDir', genomeDir, '--readFilesIn', fq, '--readFilesCommand',
-        'zcat', '--outFileNamePrefix', prefix, '--outSAMtype', 'BAM',
-        'Unsorted'
+        '--genomeDir', genomeDir, '--readFilesIn', fq, '--outFileNamePrefix', prefix,
+        '--outSAMtype', 'BAM', 'SortedByCoordinate' if sort_mode == 'star' else 'Unsorted'
     ]
-    args = [str(_) for _ in args]
+    if sort_mode == 'pipe':
+        # 管道中的bam不压缩
+        args += ['--outStd', 'BAM_Unsorted', '--outBAMcompression', 0]
+    elif sort_mode == 'star' and sort_ram:
+        args += ['--limitBAMsortRAM', parse_size(sort_ram)]
+    if genome_load:
+        if sort_mode == 'star' and not sort_ram:
+            raise ValueError('--sort_ram is required to sort in STAR with a shared genome')
+        args += ['--genomeLoad', genome_load]
+    if fq.endswith('.bam'):
+        # step1输出的未比对bam, 保留barcode和umi的tag, 需要STAR 2.7.7a以上
+        args += ['--readFilesType', 'SAM', 'SE', '--readFilesCommand', samtools_path, 'view',
+                 '--readFilesSAMattrKeep', 'CB', 'CR', 'UB', 'UR']
+    elif fq.endswith('.gz'):
+        args += ['--readFilesCommand', 'zcat']
+    return [str(_) for _ in args]
+
+def run_STAR(fq, genomeDir, prefix, core=4, star_path='STAR', samtools_path='samtools', genome_load=None):
+    args = STAR_args(fq, genomeDir, prefix, core, star_path, samtools_path, genome_load=genome_load)
     # logger.info(' '.join(args))
     call_info = run(args, check=False)
     return f'{prefix}Aligned.out.bam', f'{prefix}Log.final.out'
 
-def run_bamsort(inbam, outbam, byname=False, clean=True, core=4, samtools_path='samtools'):
+def run_STAR_sorted(fq, genomeDir, prefix, outbam, core=4, star_path='STAR', samtools_path='samtools',
+                    sort_mode='pipe', sort_ram=None, genome_load=None):
+    '''
+    align and sort by coordinate without writing the unsorted bam.
+    pipe: STAR stdout | samtools sort, star: STAR --outSAMtype BAM SortedByCoordinate.
+    in pipe mode samtools sort gets a quarter of core (1 to 4 threads) and STAR the rest.
+    '''
+    if sort_mode == 'star':
+        args = STAR_args(fq, genomeDir, prefix, core, star_path, samtools_path, sort_mode, sort_ram, genome_load)
+        run(args, check=True)
+        os.replace(f'{prefix}Aligned.sortedByCoord.out.bam', outbam)
+    else:
+        # 两个进程同时运行, 共用core个线程
+        sort_core = min(4, max(1, core // 4))
+        star_core = max(1, core - sort_core)
+        args = STAR_args(fq, genomeDir, prefix, star_core, star_path, samtools_path, sort_mode, sort_ram, genome_load)
+        sort_args = [str(_) for _ in [samtools_path, 'sort', '-O', 'BAM', '-@', sort_core, '-o', outbam, '-']]
+        star = popen(args, stdout=PIPE)
+        samtools = popen(sort_args, name='samtools sort', stdin=star.stdout)
+        # samtools退出时STAR能收到SIGPIPE
+        star.stdout.close()
+        wait_proc(samtools)
+        if samtools.returncode != 0:
+            star.kill()
+        wait_proc(star)
+        for proc, _args in ((star, args), (samtools, sort_args)):
+            if proc.returncode != 0:
+                raise CalledProcessError(proc.returncode, _args)
+    return outbam, f'{prefix}Log.final.out'
+
+def load_genome(genomeDir, prefix, star_path='STAR', remove=False):
+    '''
+    load the genome of genomeDir into shared memory (STAR --genomeLoad LoadAndExit),
+    or remove it from shared memory.
+    '''
+    args = [star_path, '--genomeDir', genomeDir, '--outFileNamePrefix', prefix,
+            '--genomeLoad', 'Remove' if remove else 'LoadAndExit']
+    run(args, check=True)
+
+def start_STAR(fq, genomeDir, prefix, core=4, star_path='STAR', samtools_path='samtools'):
+    # 后台启动STAR, fq可以是命名管道
+    return popen(STAR_args(fq, genomeDir, prefix, core, star_path, samtools_path))
+
+def run_bamsort(inbam, outbam, byname=False, clean=True, core=4, samtools_path='samtools', tag=None):
     args = [
         samtools_path, 'sort', '-O', 'BAM', '-@',  core, '-o', outbam, inbam
     ]
     if byname:
         args.insert(2, '-n')
+    if tag:
+        # 先按tag排序, 再按name/位置
+        args[2:2] = ['-t', tag]
     args = [str(_) for _ in args]
-    call_info = run(args, check=True)
+    call_info = run(args, check=True, name='samtools sort')
     if call_info.returncode == 0 & clean:
         os.remove(inbam)
     return outbam
@@ -36,23 +110,23 @@ def run_qualimap(bam, gtf, outdir, SC5P, s="f"):
     }
     if SC5P:
         s="r"
-    # gtf.gz?
+    # qualimap不能读取gtf.gz
     if gtf.endswith('.gz'):
         gtf_file = os.path.join(outdir, 'tmp.gtf')
-        args = [
-            'gzip', '-dc', gtf, '>', gtf_file
-        ]
-        assert not os.system(' '.join(args)), f"failed to unzip {gtf}!!!"
+        with xopen(gtf, 'rb') as fh, open(gtf_file, 'wb') as fhout:
+            shutil.copyfileobj(fh, fhout)
     else:
         gtf_file = gtf
     args = [
         'qualimap', 'rnaseq', '-outformat', 'PDF', '-outdir', outdir, '-bam',
-        bam, '-gtf', gtf, '-p', strand[s], '--java-mem-size=8G'
+        bam, '-gtf', gtf_file, '-p', strand[s], '--java-mem-size=8G'
     ]
     my_env = os.environ.copy()
     if 'DISPLAY' in my_env:
         del my_env['DISPLAY']
     run(args, check=False, env=my_env)
+    if gtf_file != gtf:
+        os.remove(gtf_file)
     return os.path.join(outdir, 'rnaseq_qc_results.txt')
 
 def mapping_summary(STARLog, RnaSeqMetrics):
@@ -108,6 +182,49 @@ def run_featureCounts(bam, gtf, samplename, outdir, region, SC5P, core=4, **kwar
         outdir, f'{samplename}_SortedByCoordinate.bam.featureCounts.bam')
     return featureCounts_bam
 
+def run_tasks(tasks, core=4, steps=None):
+    '''
+    run a task graph, tasks: {name: (func, deps, cores)}, func is called with the number of cores.
+    a task starts when its deps are done and enough of the core budget is free,
+    cores=None takes all free cores. tasks not in steps are skipped (their outputs must exist).
+    '''
+    done, running = set(), {}
+    free = core
+    with ThreadPoolExecutor(max_workers=len(tasks)) as pool:
+        while len(done) < len(tasks):
+            started = True
+            while started:
+                started = False
+                busy = {name for name, _ in running.values()}
+                for name, (func, deps, cores) in tasks.items():
+                    if name in done or name in busy or not set(deps) <= done:
+                        continue
+                    if steps is not None and name not in steps:
+                        logger.info(f'{name} skiped!')
+                        done.add(name)
+                        started = True
+                        continue
+                    n = min(cores, core) if cores else free
+                    if n < 1 or n > free:
+                        continue
+                    free -= n
+                    logger.info(f'{name} started!')
+                    running[pool.submit(func, n)] = (name, n)
+                    busy.add(name)
+            if len(done) == len(tasks):
+                break
+            if not running:
+                raise RuntimeError(f'step2 tasks can not start: {set(tasks) - done}')
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name, n = running.pop(future)
+                # 出错时等待其他任务结束后抛出
+                future.result()
+                free += n
+                done.add(name)
+                logger.info(f'{name} done!')
+
+@step('align')
 def align(fq,
           genomeDir,
           gtf,
@@ -119,8 +236,25 @@ def align(fq,
           logger=None,
           star_path='STAR',
           samtools_path='samtools',
+          rnaseq_qc='native',
+          sort_mode='pipe',
+          sort_ram=None,
+          group_mode='collate',
+          collate_shards=64,
+          assign_mode='featurecounts',
+          genome_load=None,
           **kwargs):
-    if ('steps' not in kwargs) or (not kwargs['steps']):
+    '''
+    STAR -> SortByPos -> RnaSeqQC
+                      -> FeatureCounts -> SortByName
+    RnaSeqQC (native or qualimap) runs alongside featureCounts and the name sort.
+    sort_mode: file, sort Aligned.out.bam after STAR; pipe/star, see run_STAR_sorted.
+    group_mode: sort, SortByName sorts the featureCounts bam by name;
+                collate, it splits the bam into barcode shards ({samplename}_collated) for step3.
+    assign_mode: featurecounts, FeatureCounts writes a bam with XT tags;
+                 native, it writes the collated shards directly (see assign.assign) and SortByName does nothing.
+    '''
+    if not kwargs.get('steps'):
         kwargs['steps'] = ['STAR', 'SortByPos', 'FeatureCounts', 'SortByName']
 
     globals()['logger'] = logger
@@ -129,35 +263,83 @@ def align(fq,
     STAR_dir = os.path.join(basedir, 'STAR')
     os.makedirs(STAR_dir, exist_ok=True)
     prefix = os.path.join(STAR_dir, samplename + '_')
+    featureCounts_dir = os.path.join(basedir, 'featureCounts')
+    os.makedirs(featureCounts_dir, exist_ok=True)
 
-    if 'STAR' not in kwargs['steps']:
-        logger.info('STAR skiped!')
-    else:
-        logger.info('STAR started!')
-        bam, STARLog = run_STAR(fq=fq,
-                                core=core,
-                                genomeDir=genomeDir,
-                                prefix=prefix,
-                                star_path=star_path)
-        logger.info('STAR done!')
-    bam, STARLog =f'{prefix}Aligned.out.bam', f'{prefix}Log.final.out'
-    # sort by pos
-    if 'SortByPos' not in kwargs['steps']:
-        logger.info('SortByPos skiped!')
-    else:
-        logger.info('SortByPos started!')
-        bam = run_bamsort(
-                    bam,
-                    f'{prefix}SortedByCoordinate.bam',
-                    core=core,
-                    samtools_path=samtools_path)
-        logger.info('SortByPos done!')
-    bam = f'{prefix}SortedByCoordinate.bam'
-
-    logger.info('run_qualimap started!')
-    RnaSeqMetrics = run_qualimap(bam=bam, gtf=gtf, outdir=STAR_dir, SC5P=sc5p)
-    logger.info('run_qualimap done!')
+    STARLog = f'{prefix}Log.final.out'
+    sorted_bam = f'{prefix}SortedByCoordinate.bam'
+    featureCounts_bam = os.path.join(featureCounts_dir, f'{samplename}_SortedByCoordinate.bam.featureCounts.bam')
+
+    # STAR和SortByPos都运行时才能在STAR中排序
+    inline = sort_mode != 'file' and 'STAR' in kwargs['steps'] and 'SortByPos' in kwargs['steps']
+
+    def _STAR(n):
+        if inline:
+            run_STAR_sorted(fq=fq, genomeDir=genomeDir, prefix=prefix, outbam=sorted_bam, core=n,
+                            star_path=star_path, samtools_path=samtools_path,
+                            sort_mode=sort_mode, sort_ram=sort_ram, genome_load=genome_load)
+        else:
+            run_STAR(fq=fq, core=n, genomeDir=genomeDir, prefix=prefix,
+                     star_path=star_path, samtools_path=samtools_path, genome_load=genome_load)
+
+    def _SortByPos(n):
+        if not inline:
+            run_bamsort(f'{prefix}Aligned.out.bam', sorted_bam, core=n, samtools_path=samtools_path)
+
+    def _RnaSeqQC(n):
+        if rnaseq_qc == 'qualimap':
+            RnaSeqMetrics = run_qualimap(bam=sorted_bam, gtf=gtf, outdir=STAR_dir, SC5P=sc5p)
+        else:
+            from .rnaseq_qc import rnaseq_qc as run_rnaseq_qc
+            RnaSeqMetrics = run_rnaseq_qc(bam=sorted_bam, gtf=gtf, outdir=STAR_dir, SC5P=sc5p, core=n,
+                                          genomeDir=genomeDir)
+        write_summary(samplename, outdir, genomeDir, STARLog, RnaSeqMetrics)
+
+    collate_dir = os.path.join(featureCounts_dir, f'{samplename}_collated')
+
+    def _IndexBam(n):
+        if rnaseq_qc != 'native' and assign_mode != 'native':
+            return
+        bai = f'{sorted_bam}.bai'
+        if not os.path.exists(bai) or os.path.getmtime(bai) < os.path.getmtime(sorted_bam):
+            pysam.index('-@', str(n), sorted_bam)
+
+    def _FeatureCounts(n):
+        if assign_mode == 'native':
+            from .assign import assign
+            assign(sorted_bam, gtf, collate_dir, region=region, SC5P=sc5p, core=n, shards=collate_shards,
+                   genomeDir=genomeDir)
+            return
+        run_featureCounts(bam=sorted_bam, samplename=samplename, outdir=featureCounts_dir,
+                          gtf=gtf, region=region, SC5P=sc5p, core=n)
 
+    def _SortByName(n):
+        if assign_mode == 'native':
+            return
+        if group_mode == 'collate':
+            from .collate import collate
+            collate(featureCounts_bam, collate_dir, collate_shards)
+            os.remove(featureCounts_bam)
+            return
+        run_bamsort(featureCounts_bam, os.path.join(featureCounts_dir, f'{samplename}_SortedByName.bam'),
+                    core=n, byname=True, samtools_path=samtools_path,
+                    tag='CB' if fq.endswith('.bam') else None)
+
+    # qualimap(java)只用1个核, 内置的qc用一半, 其余的核给featureCounts和samtools
+    # 内置的qc和基因注释按contig读取, 需要bam索引
+    tasks = {
+        'STAR': (_STAR, [], None),
+        'SortByPos': (_SortByPos, ['STAR'], None),
+        'IndexBam': (_IndexBam, ['SortByPos'], None),
+        'RnaSeqQC': (_RnaSeqQC, ['IndexBam'], 1 if rnaseq_qc == 'qualimap' else max(core // 2, 1)),
+        'FeatureCounts': (_FeatureCounts, ['IndexBam'], None),
+        'SortByName': (_SortByName, ['FeatureCounts'], None),
+    }
+    # qc和汇总不能跳过
+    run_tasks(tasks, core=core, steps=list(kwargs['steps']) + ['IndexBam', 'RnaSeqQC'])
+
+
+def write_summary(samplename, outdir, genomeDir, STARLog, RnaSeqMetrics):
     with open(os.path.join(outdir, f'{samplename}_summary.json')) as fh:
         refpath=os.path.dirname(genomeDir.rstrip("/"))
         reffile=os.path.join(refpath,'reference.json')
@@ -193,31 +375,38 @@ def align(fq,
         json.dump(summary, fh, indent=4)
 
 
-    featureCounts_dir = os.path.join(basedir, 'featureCounts')
-    # FeatureCounts
-    if 'FeatureCounts' not in kwargs['steps']:
-        logger.info('run_featureCounts done!')
-    else:
-        os.makedirs(featureCounts_dir, exist_ok=True)
-        logger.info('run_featureCounts started!')
-        bam = run_featureCounts(bam=bam,
-                                samplename=samplename,
-                                outdir=featureCounts_dir,
-                                gtf=gtf,
-                                region=region,
-                                SC5P=sc5p,
-                                core=core)
-        logger.info('run_featureCounts done!')
-    bam = os.path.join(featureCounts_dir, f'{samplename}_SortedByCoordinate.bam.featureCounts.bam')
-    # sort by name
-    if 'SortByName' not in kwargs['steps']:
-        logger.info('SortByName skiped!')
-    else:
-        logger.info('SortByName started!')
-        bam = run_bamsort(
-                    bam,
-                    os.path.join(featureCounts_dir, f'{samplename}_SortedByName.bam'),
-                    core=core,
-                    byname=True,
-                    samtools_path=samtools_path)
-        logger.info('SortByName done!')
+def align_batch(samples, outdir, genomeDir, logger=None, star_path='STAR', **kwargs):
+    '''
+    align samples [(samplename, fq)] one by one against a genome loaded once into shared memory.
+    each sample is written to outdir/samplename like rna run, the genome is removed at the end.
+    outdir/samplename/samplename_summary.json of step1 must exist for every sample.
+    '''
+    # 加载基因组之前检查step1的summary, write_summary需要读取
+    missing = [f for f in (os.path.join(outdir, n, f'{n}_summary.json') for n, _ in samples)
+               if not os.path.exists(f)]
+    if missing:
+        raise FileNotFoundError(f'step1 summary not found: {", ".join(missing)}')
+    os.makedirs(outdir, exist_ok=True)
+    prefix = os.path.join(outdir, 'genomeLoad_')
+    logger.info('load genome started!')
+    load_genome(genomeDir, prefix, star_path)
+    logger.info('load genome done!')
+    failed = []
+    try:
+        for samplename, fq in samples:
+            logger.info(f'{samplename} started!')
+            try:
+                align(fq=fq, genomeDir=genomeDir, samplename=samplename,
+                      outdir=os.path.join(outdir, samplename), logger=logger,
+                      star_path=star_path, genome_load='LoadAndKeep', **kwargs)
+            except Exception as e:
+                # 继续比对其他样本
+                logger.error(f'{samplename} failed: {e!r}')
+                failed.append(samplename)
+                continue
+            logger.info(f'{samplename} done!')
+    finally:
+        load_genome(genomeDir, prefix, star_path, remove=True)
+        logger.info('remove genome done!')
+    if failed:
+        raise RuntimeError(f'failed samples: {", ".join(failed)}')
@@ -3,15 +3,26 @@ import re
 import gzip
 import json
 from collections import defaultdict
+import shutil
 from itertools import groupby
-from subprocess import run
+from multiprocessing import Pool
 import numpy as np
 import pandas as pd
 import pysam
-from scipy.sparse import coo_matrix
-from scipy.io import mmwrite
+from .collate import bam_records, collated_records, collated_shards, read_shard, bam_parts, bam_range
+from .umi import merge_targets
+from ..utils.annotation import load_annotation
+from ..utils.perf import run, step
+from ..utils.table import TableWriter, Table
+from ..utils.mtx import write_mtx
 
-def read_gtf(gtf):
+DETAIL_COLUMNS = [('cellID', 'str'), ('geneID', 'str'), ('UMI', 'str'), ('Num', 'u4')]
+COUNTS_COLUMNS = [('cellID', 'str'), ('geneID', 'str'), ('UMINum', 'u4'), ('ReadsNum', 'u4')]
+
+def read_gtf(gtf, genomeDir=None):
+    data = load_annotation(gtf, genomeDir, keys=('table_id', 'table_name'))
+    if data is not None:
+        return [list(_) for _ in zip(data['table_id'].tolist(), data['table_name'].tolist())]
     gene_table = []
     mt_regex = re.compile('^(MT|mt|Mt)-')
     if gtf.endswith('gz'):
@@ -45,98 +56,153 @@ def read_gtf(gtf):
                     gene_table.append([ gene_id, gene_name ])
     return gene_table
 
-def hamming_distance(s1, s2):
-    return len([(i, j) for i, j in zip(s1, s2) if i != j])
-
-def umi_correct(geneid_umi_dict, bc, umi_correct_detail_fh):
+def umi_correct(geneid_umi_dict, bc, umi_correct_detail_fh, umi_method='greedy'):
+    '''
+    merge the umis of each gene from the lowest count, see umi.merge_targets.
+    umi_correct_detail_fh: None to skip the detail.
+    '''
     counts_dict = defaultdict(lambda: [0, 0])
     # with open(umi_correct_detail, 'w') as fh:
     #     fh.write('gene_id\traw_umi\tumi\n')
     for gene_id, umi_dict in geneid_umi_dict.items():
         sorted_umis = sorted(umi_dict.keys(), key=lambda x: umi_dict[x], reverse=True)
-        while len(sorted_umis) > 1:
-            umi_s = sorted_umis.pop()
-            for umi in sorted_umis:
-                if hamming_distance(umi_s, umi) == 1:
-                    umi_dict[umi] += umi_dict[umi_s]
+        if len(sorted_umis) > 1:
+            targets = merge_targets(sorted_umis, [umi_dict[_] for _ in sorted_umis], umi_method)
+            for k in range(len(sorted_umis) - 1, 0, -1):
+                if targets[k] < 0:
+                    continue
+                umi_s, umi = sorted_umis[k], sorted_umis[targets[k]]
+                umi_dict[umi] += umi_dict[umi_s]
+                if umi_correct_detail_fh:
                     umi_correct_detail_fh.write(f'{bc}\t{gene_id}\t{umi_s}:{umi_dict[umi_s]}\t{umi}:{umi_dict[umi]}\n')
-                    del umi_dict[umi_s]
-                    break
+                del umi_dict[umi_s]
         counts_dict[gene_id][0] = len(umi_dict.keys())
         counts_dict[gene_id][1] = sum(umi_dict.values())
     return counts_dict, geneid_umi_dict
 
-def umi_count(reads_group, umi_correct_detail_fh):
+def umi_count(reads_group, umi_correct_detail_fh, barcode, umi_method='greedy'):
+    '''
+    reads_group: (barcode, umi, qname, XT, mapq) records of one barcode, alignments of a read are adjacent.
+    '''
     assigned_dict = defaultdict(lambda: defaultdict(int))
-    for barcode_umi, g in groupby(reads_group, key=lambda x: x.qname):
-        _, umi = barcode_umi.split('_')[:2]
-        #print(_,umi)
+    for _, g in groupby(reads_group, key=lambda x: x[2]):
+        g = list(g)
+        umi = g[0][1]
         if umi == umi[0]*len(umi):   # poly
             continue
         tmp_dict = defaultdict(int)
         n = 0
         for r in g:
             n += 1
-            if r.has_tag('XT'):
-                XT =r.get_tag('XT').split('XT:Z:')[-1]
-                #print(XT)
+            XT = r[3]
+            if XT:
                 if ',' in XT:
                     break
-                gene_id = XT.split('XT:Z:')[-1]
-                tmp_dict[gene_id] = r.mapping_quality
+                gene_id = XT
+                tmp_dict[gene_id] = r[4]
         if len(tmp_dict) == 1:
             if tmp_dict[gene_id] == 255 or n > 1:
                 assigned_dict[gene_id][umi] += 1
-    counts_dict, geneid_umi_dict = umi_correct(assigned_dict, _, umi_correct_detail_fh)
+    counts_dict, geneid_umi_dict = umi_correct(assigned_dict, barcode, umi_correct_detail_fh, umi_method)
     return counts_dict, geneid_umi_dict
 
-def bam2table(bam, detail_file, counts_file, umi_correct_detail):
-    sam_file = pysam.AlignmentFile(bam, 'rb')
+def count_records(records, detail, counts, umi_correct_detail_fh, umi_method='greedy'):
+    # detail, counts: TableWriter
+    for barcode, g in groupby(records, key=lambda x: x[0]):
+        counts_dict, geneid_umi_dict = umi_count(g, umi_correct_detail_fh, barcode, umi_method)
+        for gene_id in geneid_umi_dict:
+            for umi in geneid_umi_dict[gene_id]:
+                detail.append(barcode, gene_id, umi, geneid_umi_dict[gene_id][umi])
+        for gene_id in counts_dict:
+            umi_num, reads_num = counts_dict[gene_id]
+            counts.append(barcode, gene_id, umi_num, reads_num)
 
-    umi_correct_detail_fh = open(umi_correct_detail, 'w')
-    with open(detail_file, 'w') as fh1, open(counts_file, 'w') as fh2:
-        fh1.write('\t'.join(['cellID', 'geneID', 'UMI', 'Num']) + '\n')
-        fh2.write('\t'.join(['cellID', 'geneID', 'UMINum', 'ReadsNum']) + '\n')
-        for barcode, g in groupby(sam_file, key=lambda x: x.qname.split('_', 1)[0]):
-            counts_dict, geneid_umi_dict = umi_count(g, umi_correct_detail_fh)
-            for gene_id in geneid_umi_dict:
-                for umi in geneid_umi_dict[gene_id]:
-                    raw_umi_count = geneid_umi_dict[gene_id][umi]
-                    fh1.write(f'{barcode}\t{gene_id}\t{umi}\t{raw_umi_count}\n')
-            for gene_id in counts_dict:
-                umi_num, reads_num = counts_dict[gene_id]
-                fh2.write(f'{barcode}\t{gene_id}\t{umi_num}\t{reads_num}\n')
-    umi_correct_detail_fh.close()
+def count_part(bam, part, prefix, umi_method='greedy', umi_detail=True, threads=1):
+    '''
+    count one part of bam2table: a list of shard files, or a (start, end) range of a bam.
+    return the detail and counts tables and the umi detail file written with prefix.
+    '''
+    if os.path.isdir(bam):
+        records = read_shard(part)
+    else:
+        records = bam_records(bam_range(bam, *part, threads=threads))
+    outfiles = [f'{prefix}.detail', f'{prefix}.counts', f'{prefix}.umi' if umi_detail else None]
+    with TableWriter(outfiles[0], DETAIL_COLUMNS) as detail, TableWriter(outfiles[1], COUNTS_COLUMNS) as counts:
+        umi_correct_detail_fh = open(outfiles[2], 'w') if umi_detail else None
+        count_records(records, detail, counts, umi_correct_detail_fh, umi_method)
+        if umi_correct_detail_fh:
+            umi_correct_detail_fh.close()
+    return outfiles
+
+def _count_part(args):
+    return count_part(*args)
+
+def bam2table(bam, detail_file, counts_file, umi_correct_detail, umi_method='greedy', core=1):
+    '''
+    bam: bam sorted by name (or by CB tag and name), or a dir of collated shards.
+    detail_file, counts_file: dirs of the columnar tables (utils.table), `utils exporttable` writes them as text.
+    umi_correct_detail: umi correction detail, gzip compressed for .gz, None to skip.
+    core > 1: count barcode shards (or barcode ranges of the bam) in processes
+    and append their outputs in order, the tables are the same as with one core.
+    '''
+    if umi_correct_detail is None:
+        umi_correct_detail_fh = None
+    elif umi_correct_detail.endswith('.gz'):
+        umi_correct_detail_fh = gzip.open(umi_correct_detail, 'wt', compresslevel=1)
+    else:
+        umi_correct_detail_fh = open(umi_correct_detail, 'w')
+    with TableWriter(detail_file, DETAIL_COLUMNS) as detail, TableWriter(counts_file, COUNTS_COLUMNS) as counts:
+        if core > 1:
+            if os.path.isdir(bam):
+                parts = collated_shards(bam)
+            else:
+                parts = bam_parts(bam, core * 4)
+            tmpdir = os.path.join(os.path.dirname(os.path.abspath(counts_file)), 'bam2table_tmp')
+            os.makedirs(tmpdir, exist_ok=True)
+            # 每个进程另用一个线程解压bam
+            args = [(bam, part, os.path.join(tmpdir, f'part_{i:05d}'), umi_method, umi_correct_detail_fh is not None, 2)
+                    for i, part in enumerate(parts)]
+            try:
+                with Pool(core) as pool:
+                    # imap保持顺序, 各部分结束后依次追加
+                    for detail_part, counts_part, umi_part in pool.imap(_count_part, args):
+                        detail.extend(detail_part)
+                        counts.extend(counts_part)
+                        shutil.rmtree(detail_part)
+                        shutil.rmtree(counts_part)
+                        if umi_part:
+                            with open(umi_part) as fh:
+                                shutil.copyfileobj(fh, umi_correct_detail_fh)
+                            os.remove(umi_part)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+        else:
+            if os.path.isdir(bam):
+                records = collated_records(bam)
+            else:
+                records = bam_records(pysam.AlignmentFile(bam, 'rb'))
+            count_records(records, detail, counts, umi_correct_detail_fh, umi_method)
+    if umi_correct_detail_fh:
+        umi_correct_detail_fh.close()
 
 
-def write_raw_matrix(counts_file, raw_matrix_dir, gtf):
-    name_df = pd.DataFrame(read_gtf(gtf), columns=['geneID', 'Symbol'])
+def write_raw_matrix(counts_file, raw_matrix_dir, gtf, genomeDir=None, core=4):
+    name_df = pd.DataFrame(read_gtf(gtf, genomeDir), columns=['geneID', 'Symbol'])
 
     gene_dict = name_df.reset_index().set_index('geneID')['index'].to_dict()
     #print(gene_dict)
     #print(name_df)
-    row, col, data = [], [], []
-    barcodes = []
-    n = 0
-    with open(counts_file) as fh:
-        fh.readline()
-        for k, g in groupby(fh, lambda x: x.split('\t')[0]):
-            barcodes.append(k)
-            for _ in g:
-     #           print(_)
-                tmp = _.split('\t')
-                data.append(int(tmp[2]))
-                row.append(gene_dict[tmp[1]])
-                col.append(n)
-            n += 1
-    mat = coo_matrix((data, (row, col)), shape=(name_df.shape[0], n))
+    # counts中barcode按首次出现编码, 即矩阵的列; 直接写出counts的各列, 不再构建coo_matrix
+    counts = Table(counts_file)
+    barcodes = counts.values('cellID')
+    gene_rows = np.array([gene_dict[_] for _ in counts.values('geneID')], dtype=np.int32)
+    row = gene_rows[counts.column('geneID')]
 
     # comment = 'metadata_json: {"format_version": 2,  \
     #     "software_version": "3.0.1"}'
     matrix_file = os.path.join(raw_matrix_dir, 'matrix.mtx.gz')
-    with gzip.open(matrix_file, 'w') as fh:
-        mmwrite(fh, mat)
-        # mmwrite(fh, mat, comment=comment)
+    write_mtx(matrix_file, row, counts.column('cellID'), counts.column('UMINum'),
+              shape=(name_df.shape[0], len(barcodes)), core=core)
 
     name_df['type'] = 'Gene Expression'
     features_file = os.path.join(raw_matrix_dir, 'features.tsv.gz')
@@ -147,6 +213,11 @@ def write_raw_matrix(counts_file, raw_matrix_dir, gtf):
         fh.write('\n'.join(barcodes))
         fh.write('\n')
 
+def _cell_mask(table, barcodes):
+    # 属于细胞的行
+    codes = [i for i, _ in enumerate(table.values('cellID')) if _ in barcodes]
+    return np.isin(table.column('cellID'), codes)
+
 def calculate_metrics(counts_file, detail_file, filterd_barcodes_file, filterd_features_file):
     summary = defaultdict()
     summary['Estimated Number of Cells'] = 0
@@ -158,67 +229,58 @@ def calculate_metrics(counts_file, detail_file, filterd_barcodes_file, filterd_f
 
     barcodes = pd.read_csv(filterd_barcodes_file, header=None, sep='\t')
     summary['Estimated Number of Cells'] = barcodes.shape[0]
+    barcodes = set(barcodes[0])
+
+    counts = Table(counts_file)
+    umis = counts.column('UMINum')
+    summary['Sequencing Saturation'] = 1 - umis.sum(dtype=np.int64)/counts.column('ReadsNum').sum(dtype=np.int64)
 
-    df0 = pd.read_csv(counts_file,
-                        dtype={
-                            'cellID': 'category',
-                            'geneID': 'category',
-                            'UMINum': 'int32',
-                            'ReadsNum': 'int32'
-                        },
-                        sep='\t')
-    summary['Sequencing Saturation'] = 1 - df0.UMINum.sum()/df0.ReadsNum.sum()
-    
-    df0 = df0.loc[df0['cellID'].isin(barcodes[0]), :].reset_index(drop=True)
-    umi_median = int(df0.groupby(['cellID'], observed=True)['UMINum'].sum().median())
+    mask = _cell_mask(counts, barcodes)
+    cells = np.asarray(counts.column('cellID'))[mask]
+    genes = np.asarray(counts.column('geneID'))[mask]
+    present = np.unique(cells)
+    umi_median = int(np.median(np.bincount(cells, weights=umis[mask])[present]))
     summary['Median UMI Counts per Cell'] = umi_median
-    gene_total = int(df0[['geneID']].nunique())
+    gene_total = int(np.unique(genes).shape[0])
     summary['Total Genes Detected'] = gene_total
-    gene_median = int(df0.groupby(['cellID'], observed=True)['geneID'].nunique().median())
+    # 每个细胞的基因数, 按(cell, gene)去重
+    pairs = np.unique(cells.astype(np.int64) * len(counts.dict('geneID')) + genes)
+    gene_median = int(np.median(np.bincount(pairs // len(counts.dict('geneID')))[present]))
     summary['Median Genes per Cell'] = gene_median
-    
-    del df0
-
-    df = pd.read_csv(detail_file,
-                        dtype={
-                            'cellID': 'category',
-                            'geneID': 'category',
-                            'UMI': 'category',
-                            'Num': 'int32'
-                        },
-                        sep='\t')
-    mapped_reads_total = df['Num'].sum()
-
-    df = df.loc[df['cellID'].isin(barcodes[0]), :].reset_index(drop=True)
-    cell_reads_total = df['Num'].sum()
+
+    del cells, genes, pairs
+
+    detail = Table(detail_file)
+    num = detail.column('Num')
+    mapped_reads_total = num.sum(dtype=np.int64)
+
+    mask = _cell_mask(detail, barcodes)
+    rows = np.flatnonzero(mask)
+    cell_reads_total = num[mask].sum(dtype=np.int64)
     cell_reads_ratio = cell_reads_total / mapped_reads_total
     summary['Fraction Reads in Cells'] = cell_reads_ratio
-    rep = df['Num']
-    df = df.drop(['Num'], axis=1)
-    idx = df.index.repeat(rep)
-    df = df.iloc[idx].reset_index(drop=True)
-    del rep, idx
+    # detail每行是一个(cell, gene, UMI), 每条read展开为所在的行号
+    reads = np.repeat(rows.astype(np.uint32 if detail.rows < 2 ** 32 else np.int64), num[mask])
+    n_genes = len(detail.dict('geneID'))
+    pair = np.asarray(detail.column('cellID'), dtype=np.int64) * n_genes + detail.column('geneID')
 
     # shuffle
-    df = df.sample(frac=1.0).reset_index(drop=True)
+    np.random.shuffle(reads)
     percentage_sampling = []
     saturation_sampling = []
     median_sampling = []
     # downsample
-    for n, interval in enumerate(np.array_split(np.arange(df.shape[0]), 10)):
+    for n, interval in enumerate(np.array_split(np.arange(reads.shape[0]), 10)):
         idx = interval[-1]
         percentage = (n + 1) / 10
         percentage_sampling.append(percentage)
-        sampled_df = df.iloc[:idx]
-        UMIcounts = sampled_df.groupby(
-            [sampled_df['cellID'], sampled_df['geneID'], sampled_df['UMI']],
-            observed=True)['UMI'].count().reset_index(drop=True)
-        saturation = ((UMIcounts[UMIcounts > 1] - 1).sum() + 0.0) / idx * 100
+        sampled = reads[:idx]
+        # UMI计数大于1的部分: 抽到的reads数 - 不同的(cell, gene, UMI)数
+        saturation = ((idx - np.unique(sampled).shape[0]) + 0.0) / idx * 100
         saturation_sampling.append(float(saturation))
 
-        median = sampled_df.groupby(
-            [sampled_df['cellID']],
-            observed=True)['geneID'].nunique().reset_index(drop=True).median()
+        sampled_pairs = np.unique(pair[sampled])
+        median = np.median(np.unique(sampled_pairs // n_genes, return_counts=True)[1])
         median_sampling.append(int(median))
 
     return summary, {
@@ -227,21 +289,24 @@ def calculate_metrics(counts_file, detail_file, filterd_barcodes_file, filterd_f
         'median': median_sampling
     }
 
+@step('count')
 def count(bam, outdir, samplename, gtf, logger, expectNum=3000, **kwargs):
     logger.info('count started!')
     basedir = os.path.join(outdir, 'step3')
     os.makedirs(basedir, exist_ok=True)
 
-    detail_file = os.path.join(basedir, 'detail.xls')
-    counts_file = os.path.join(basedir, 'counts.xls')
-    umi_file = os.path.join(basedir, 'umi.xls')
+    detail_file = os.path.join(basedir, 'detail')
+    counts_file = os.path.join(basedir, 'counts')
+    umi_detail = kwargs.get('umi_detail', 'plain')
+    umi_file = None if umi_detail == 'none' else os.path.join(basedir, 'umi.xls.gz' if umi_detail == 'gzip' else 'umi.xls')
 
-    bam2table(bam=bam, detail_file=detail_file, counts_file=counts_file, umi_correct_detail=umi_file)
+    bam2table(bam=bam, detail_file=detail_file, counts_file=counts_file, umi_correct_detail=umi_file,
+              umi_method=kwargs.get('umi_method', 'greedy'), core=kwargs.get('core', 1))
 
     raw_matrix_dir = os.path.join(basedir, 'raw_feature_bc_matrix')
     os.makedirs(raw_matrix_dir, exist_ok=True)
     logger.info('write raw matrix started!')
-    write_raw_matrix(counts_file, raw_matrix_dir, gtf)
+    write_raw_matrix(counts_file, raw_matrix_dir, gtf, kwargs.get('genomeDir'), kwargs.get('core', 1))
 
     if kwargs['forceCell'] != None:
         Rapp = os.path.join(os.path.abspath(os.path.dirname(__file__)),
@@ -256,7 +321,7 @@ def count(bam, outdir, samplename, gtf, logger, expectNum=3000, **kwargs):
         args = [str(_) for _ in args]
     logger.info('call cell started!')
     print(' '.join(args))
-    run(args, check=False)
+    run(args, check=False, name=f'Rscript {os.path.basename(Rapp)}')
 
     filterd_barcodes_file = os.path.join(
         basedir, 'filtered_feature_bc_matrix/barcodes.tsv.gz')
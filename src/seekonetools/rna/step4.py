@@ -1,6 +1,7 @@
 import os
-from subprocess import run
+from ..utils.perf import run, step
 
+@step('do_seurat')
 def do_seurat(matrix,
               samplename,
               outdir,
@@ -22,6 +23,6 @@ def do_seurat(matrix,
         outdir1, '--dims', dims, '--minpct', minpct, '--logfc', logfc
     ]
     args = [str(_) for _ in args]
-    run(args, check=False)
+    run(args, check=False, name='Rscript do_seurat.R')
 
     logger.info('seurat done!')
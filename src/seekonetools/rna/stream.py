@@ -0,0 +1,64 @@
+import os
+import time
+import errno
+import fcntl
+from .step1 import barcode
+from .step2 import start_STAR
+from ..utils.perf import wait, step
+
+
+def open_fifo(path, proc, poll=0.1):
+    '''
+    open a named pipe for writing once proc opened it for reading.
+    raise RuntimeError if proc exits before that.
+    '''
+    while True:
+        try:
+            fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+            break
+        except OSError as e:
+            if e.errno != errno.ENXIO:
+                raise
+        if proc.poll() is not None:
+            raise RuntimeError(f'STAR exited with {proc.returncode} before reading {path}')
+        time.sleep(poll)
+    # 打开后恢复为阻塞写
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) & ~os.O_NONBLOCK)
+    return os.fdopen(fd, 'wb')
+
+@step('barcode_to_STAR')
+def barcode_to_STAR(samplename, outdir, genomeDir, core=4, logger=None, star_path='STAR',
+                    samtools_path='samtools', stream_keep=False, **kwargs):
+    '''
+    run step1 and feed its reads to STAR through a named pipe.
+    stream_keep: also save the reads to step1/{samplename}_2.fq.gz.
+    return the STAR bam and log.
+    '''
+    STAR_dir = os.path.join(outdir, 'step2', 'STAR')
+    os.makedirs(STAR_dir, exist_ok=True)
+    prefix = os.path.join(STAR_dir, samplename + '_')
+    fifo = os.path.join(STAR_dir, f'{samplename}_2.fq')
+    if os.path.exists(fifo):
+        os.remove(fifo)
+    os.mkfifo(fifo)
+    tee = os.path.join(outdir, 'step1', f'{samplename}_2.fq.gz') if stream_keep else None
+    try:
+        logger.info('STAR started!')
+        proc = start_STAR(fq=fifo, genomeDir=genomeDir, prefix=prefix, core=core,
+                          star_path=star_path, samtools_path=samtools_path)
+        try:
+            barcode(samplename=samplename, outdir=outdir, core=core, logger=logger, fqout=fifo,
+                    opener=lambda path, mode: open_fifo(path, proc), tee=tee, **kwargs)
+        except BaseException as e:
+            # STAR先退出时写管道会抛出BrokenPipeError, 否则是step1出错, 结束STAR
+            if proc.poll() is not None and proc.returncode != 0:
+                raise RuntimeError(f'STAR exited with {proc.returncode}') from e
+            proc.kill()
+            wait(proc)
+            raise
+        if wait(proc) != 0:
+            raise RuntimeError(f'STAR exited with {proc.returncode}')
+        logger.info('STAR done!')
+    finally:
+        os.remove(fifo)
+    return f'{prefix}Aligned.out.bam', f'{prefix}Log.final.out'
@@ -0,0 +1,78 @@
+import numpy as np
+
+# UMI较少时逐对比较更快
+INDEX_MIN = 32
+
+
+def hamming_distance(s1, s2):
+    return len([(i, j) for i, j in zip(s1, s2) if i != j])
+
+def _directional(counts, j, k):
+    # UMI-tools directional: count(j) >= 2 * count(k) - 1
+    return counts[j] >= 2 * counts[k] - 1
+
+def pack_umis(umis: list):
+    '''
+    pack equal length umis into uint64 codes, with as few bits per base as the bases present need.
+    return (packed, codes, bases, bits), or None if the umis can not be packed.
+    '''
+    L = len(umis[0])
+    if any(len(_) != L for _ in umis):
+        return None
+    try:
+        arr = np.frombuffer(''.join(umis).encode('ascii'), dtype=np.uint8).reshape(len(umis), L)
+    except UnicodeEncodeError:
+        return None
+    bases = np.unique(arr)
+    bits = max(1, (len(bases) - 1).bit_length())
+    if bits * L > 64:
+        return None
+    codes = np.searchsorted(bases, arr).astype(np.uint64)
+    shifts = np.arange(L, dtype=np.uint64) * np.uint64(bits)
+    packed = np.bitwise_or.reduce(codes << shifts, axis=1)
+    return packed, codes, bases, bits
+
+def _pairwise_targets(umis, counts, method):
+    targets = [-1] * len(umis)
+    for k in range(1, len(umis)):
+        for j in range(k):
+            if hamming_distance(umis[j], umis[k]) == 1:
+                if method == 'greedy' or _directional(counts, j, k):
+                    targets[k] = j
+                    break
+    return targets
+
+def _indexed_targets(packed, codes, bases, bits, counts, method):
+    n, L = codes.shape
+    order = np.argsort(packed)
+    index = packed[order]
+    rank = np.arange(n)
+    counts = np.asarray(counts)
+    best = np.full(n, n)
+    # 逐个位置替换为其他碱基, 在排序后的编码中查找1错配的UMI
+    for i in range(L):
+        shift = np.uint64(i * bits)
+        for v in range(len(bases)):
+            alt = packed ^ ((codes[:, i] ^ np.uint64(v)) << shift)
+            pos = np.minimum(np.searchsorted(index, alt), n - 1)
+            hit = (index[pos] == alt) & (codes[:, i] != v)
+            cand = np.where(hit, order[pos], n)
+            valid = cand < rank
+            if method == 'directional':
+                valid &= counts[np.minimum(cand, n - 1)] >= 2 * counts - 1
+            best = np.minimum(best, np.where(valid, cand, n))
+    return np.where(best < n, best, -1).tolist()
+
+def merge_targets(umis: list, counts: list, method: str='greedy') -> list:
+    '''
+    umis sorted by count from high to low, return the index of the umi each one is merged into (-1: kept).
+    greedy: a umi is merged into the first umi before it at hamming distance 1,
+    directional: into the first one with count >= 2 * count - 1 (raw counts).
+    the targets do not depend on the merge order: the umis before k are never merged before k.
+    '''
+    if len(umis) < INDEX_MIN:
+        return _pairwise_targets(umis, counts, method)
+    packed = pack_umis(umis)
+    if packed is None:
+        return _pairwise_targets(umis, counts, method)
+    return _indexed_targets(*packed, counts, method)
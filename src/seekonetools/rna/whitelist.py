@@ -0,0 +1,340 @@
+import os
+import shutil
+import hashlib
+import tempfile
+from functools import lru_cache
+import numpy as np
+
+INDEX_VERSION = 2
+MEMO_SIZE = 1 << 20
+# 邻居表超过该条数时改用SeedIndex
+TABLE_LIMIT = 1 << 24
+CACHE_DIR = os.environ.get(
+    'SEEKONETOOLS_CACHE',
+    os.path.join(os.path.expanduser('~'), '.cache', 'seekonetools')
+)
+
+_ENCODE = str.maketrans('ACGT', '0123')
+
+
+def pack_seq(seq: str) -> int:
+    # 2bit编码: A=0 C=1 G=2 T=3, 最高位补1以区分不同长度
+    # 含N等其他字符的序列返回-1, 不会命中任何key
+    try:
+        return int('1' + seq.translate(_ENCODE), 4)
+    except ValueError:
+        return -1
+
+def unpack_seq(key: int) -> str:
+    bases = []
+    while key > 1:
+        bases.append('ACGT'[key & 3])
+        key >>= 2
+    return ''.join(reversed(bases))
+
+def read_whitelist(seq: str) -> list:
+    # 与build_dict相同: 忽略#和空行, 文件无法读取时把seq本身当作序列
+    # 重复序列按最后一次出现排序, 行号越大越靠后(build_dict中dict.update后者覆盖前者)
+    from xopen import xopen
+    try:
+        with xopen(seq, 'r') as fh:
+            lines = [line.strip() for line in fh]
+        lines = [l for l in lines if l and not l.startswith('#')]
+        return list(reversed(dict.fromkeys(reversed(lines))))
+    except Exception:
+        return [seq]
+
+def popcount64(x: np.ndarray) -> np.ndarray:
+    x = np.ascontiguousarray(x, dtype=np.uint64)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(x.shape + (8,)).sum(axis=-1)
+
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.int64)
+
+def file_digest(path: str) -> str:
+    # 白名单文件不存在时按序列字符串本身计算(与build_dict的回退逻辑一致)
+    h = hashlib.sha1()
+    if os.path.isfile(path):
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(1024**2), b''):
+                h.update(block)
+    else:
+        h.update(path.encode())
+    return h.hexdigest()
+
+
+class _Index:
+    def __reduce__(self):
+        # 子进程中重新映射文件, 不复制数组
+        return (self.__class__, (self.path,))
+
+    def __len__(self):
+        return self.whitelist.shape[0]
+
+    def lookup(self, seq: str) -> tuple:
+        try:
+            return self._memo[seq]
+        except KeyError:
+            pass
+        res = (0, None)
+        key = pack_seq(seq)
+        if key >= 0:
+            codes, rows = self.lookup_packed(np.array([key], dtype=np.uint64))
+            if codes[0] > 0:
+                res = (int(codes[0]), self.whitelist[rows[0]].decode())
+            else:
+                res = (int(codes[0]), None)
+        if len(self._memo) >= MEMO_SIZE:
+            self._memo.clear()
+        self._memo[seq] = res
+        return res
+
+
+class WhitelistIndex(_Index):
+    '''
+    compiled whitelist correction table, memory-mapped read-only.
+
+    keys.npy     uint64  sorted packed sequences (whitelist + 1-edit neighbors)
+    codes.npy    int8    1: perfect, 2: indel, 3: mismatch
+    targets.npy  int32   row in whitelist.npy
+    whitelist.npy S      whitelist sequences
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.keys = np.load(os.path.join(path, 'keys.npy'), mmap_mode='r')
+        self.codes = np.load(os.path.join(path, 'codes.npy'), mmap_mode='r')
+        self.targets = np.load(os.path.join(path, 'targets.npy'), mmap_mode='r')
+        self.whitelist = np.load(os.path.join(path, 'whitelist.npy'), mmap_mode='r')
+        # 逐条查询的结果缓存, 每个进程独立且有上限
+        self._memo = {}
+
+    def lookup_packed(self, keys: np.ndarray) -> tuple:
+        # 批量查询, keys为pack_seq结果(uint64), 返回(code, target row), 未命中code为0
+        keys = np.asarray(keys, dtype=np.uint64)
+        codes = np.zeros(keys.shape, dtype=np.int8)
+        targets = np.full(keys.shape, -1, dtype=np.int64)
+        if self.keys.shape[0] == 0:
+            return codes, targets
+        idx = np.searchsorted(self.keys, keys)
+        idx[idx == self.keys.shape[0]] = 0
+        hit = np.asarray(self.keys[idx] == keys)
+        codes[hit] = self.codes[idx[hit]]
+        targets[hit] = self.targets[idx[hit]]
+        return codes, targets
+
+
+class SeedIndex(_Index):
+    '''
+    whitelist correction without neighbor tables, for long or very large whitelists.
+
+    barcodes of length L are split at h = L // 2. a query within 1 mismatch
+    or 1 indel of a whitelist entry shares at least one seed with it:
+        left   w[:h]     mismatch or indel at i >= h
+        right  w[h:]     mismatch at i < h
+        shift  w[h+1:]   indel at i < h, compared with q[h:L-1]
+    candidates are verified on packed keys. codes follow correct_seq:
+    1 perfect, 3 mismatch, 2 indel. when several whitelist entries qualify
+    the last one in the whitelist wins, as in build_dict and WhitelistIndex.
+    '''
+    SEEDS = ('left', 'right', 'shift')
+
+    def __init__(self, path: str):
+        self.path = path
+        _load = lambda name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')
+        self.whitelist = _load('whitelist')
+        self.packed = _load('packed')
+        self.packed_rows = _load('packed_rows')
+        self.bits = _load('bits')
+        self.seeds = {k: (_load(f'{k}_keys'), _load(f'{k}_rows')) for k in self.SEEDS}
+        meta = _load('meta')
+        self.length, self.err, self.indel = [int(_) for _ in meta]
+        self._memo = {}
+
+    @staticmethod
+    def seed_keys(bits: np.ndarray, length: int) -> dict:
+        # bits为去掉最高位标记后的2bit编码
+        h = length // 2
+        one = np.uint64(1)
+        def mask(n):
+            return (one << np.uint64(2 * n)) - one
+        return {
+            'left': (one << np.uint64(2 * h)) | (bits >> np.uint64(2 * (length - h))),
+            'right': (one << np.uint64(2 * (length - h))) | (bits & mask(length - h)),
+            'shift': (one << np.uint64(2 * (length - h - 1))) | (bits & mask(length - h - 1)),
+        }
+
+    def lookup_packed(self, keys: np.ndarray) -> tuple:
+        keys = np.asarray(keys, dtype=np.uint64)
+        codes = np.zeros(keys.shape, dtype=np.int8)
+        rows = np.full(keys.shape, -1, dtype=np.int64)
+        if not self.packed.shape[0] or not keys.shape[0]:
+            return codes, rows
+
+        idx = np.searchsorted(self.packed, keys)
+        idx[idx == self.packed.shape[0]] = 0
+        hit = np.asarray(self.packed[idx] == keys)
+        codes[hit] = 1
+        rows[hit] = self.packed_rows[idx[hit]]
+
+        L = self.length
+        sentinel = np.uint64(1) << np.uint64(2 * L)
+        todo = np.flatnonzero(~hit & (keys >= sentinel) & (keys < (sentinel << np.uint64(1))))
+        if not todo.shape[0] or not (self.err or self.indel):
+            return codes, rows
+        bits = keys[todo] ^ sentinel
+
+        # 候选: (query, whitelist row)
+        query_seeds = self.seed_keys(bits, L)
+        # q[h:L-1]
+        tail = np.uint64(2 * (L - L // 2 - 1))
+        query_seeds['shift'] = (np.uint64(1) << tail) | ((bits >> np.uint64(2)) & ((np.uint64(1) << tail) - np.uint64(1)))
+        cand_q, cand_r = [], []
+        for name in self.SEEDS:
+            if name == 'shift' and not self.indel:
+                continue
+            seed_keys, seed_rows = self.seeds[name]
+            lo = np.searchsorted(seed_keys, query_seeds[name], side='left')
+            hi = np.searchsorted(seed_keys, query_seeds[name], side='right')
+            n = hi - lo
+            q = np.repeat(np.arange(todo.shape[0]), n)
+            pos = np.arange(int(n.sum())) - np.repeat(np.cumsum(n) - n, n) + np.repeat(lo, n)
+            cand_q.append(q)
+            cand_r.append(np.asarray(seed_rows[pos], dtype=np.int64))
+        cand_q = np.concatenate(cand_q)
+        cand_r = np.concatenate(cand_r)
+        if not cand_q.shape[0]:
+            return codes, rows
+        pair = np.unique(cand_q * np.int64(len(self)) + cand_r)
+        cand_q = pair // len(self)
+        cand_r = pair % len(self)
+
+        qbits = bits[cand_q]
+        wbits = np.asarray(self.bits[cand_r])
+        x = qbits ^ wbits
+        diff = popcount64((x | (x >> np.uint64(1))) & np.uint64(0x5555555555555555))
+        is_mis = (diff == 1) if self.err else np.zeros(diff.shape, dtype=bool)
+        is_indel = np.zeros(diff.shape, dtype=bool)
+        if self.indel:
+            # q[:L-1]等于w删除第i个碱基
+            head = qbits >> np.uint64(2)
+            for i in range(L):
+                tail_n = np.uint64(2 * (L - 1 - i))
+                deleted = ((wbits >> (tail_n + np.uint64(2))) << tail_n) | (wbits & ((np.uint64(1) << tail_n) - np.uint64(1)))
+                is_indel |= deleted == head
+            is_indel &= diff > 0
+
+        n_q = todo.shape[0]
+        for flag, code in ((is_indel, 2), (is_mis, 3)):
+            # 先indel后mis, mis优先级更高可覆盖; 多个候选时取白名单中最后一条
+            last = np.full(n_q, -1, dtype=np.int64)
+            np.maximum.at(last, cand_q[flag], cand_r[flag])
+            found = last >= 0
+            codes[todo[found]] = code
+            rows[todo[found]] = last[found]
+        return codes, rows
+
+
+def compile_seed_index(seq: str, err: int, indel: int, path: str) -> str:
+    whitelist = read_whitelist(seq)
+    lengths = set(len(_) for _ in whitelist)
+    if len(lengths) != 1:
+        raise ValueError(f'whitelist sequences must have the same length: {seq}')
+    L = lengths.pop()
+    if not 2 <= L <= 31:
+        raise ValueError(f'unsupported whitelist sequence length {L}: {seq}')
+
+    packed = np.array([pack_seq(_) for _ in whitelist], dtype=np.int64)
+    if (packed < 0).any():
+        raise ValueError(f'unsupported base in whitelist: {seq}')
+    packed = packed.astype(np.uint64)
+    bits = packed ^ (np.uint64(1) << np.uint64(2 * L))
+    arrays = {'whitelist': np.array(whitelist, dtype=f'S{L}'),
+              'bits': bits,
+              'meta': np.array([L, err, indel], dtype=np.int64)}
+    order = np.argsort(packed, kind='stable')
+    arrays['packed'] = packed[order]
+    arrays['packed_rows'] = order.astype(np.int32)
+    for name, keys in SeedIndex.seed_keys(bits, L).items():
+        order = np.argsort(keys, kind='stable')
+        arrays[f'{name}_keys'] = keys[order]
+        arrays[f'{name}_rows'] = order.astype(np.int32)
+    return _save_index(arrays, path)
+
+def _save_index(arrays: dict, path: str) -> str:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmpdir = tempfile.mkdtemp(dir=os.path.dirname(path))
+    for name, arr in arrays.items():
+        np.save(os.path.join(tmpdir, f'{name}.npy'), arr)
+    try:
+        os.rename(tmpdir, path)
+    except OSError:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        # 其他进程已生成时忽略, 否则为真正的错误
+        if not os.path.isdir(path):
+            raise
+    return path
+
+def compile_index(seq: str, err: int, indel: int, path: str) -> str:
+    from .helper import build_dict
+
+    d = build_dict(seq, err, indel)
+    whitelist = list(d['perfect'])
+    rows = {s: i for i, s in enumerate(whitelist)}
+    # 邻居序列只含ACGT, 检查白名单本身即可
+    for s in whitelist:
+        if pack_seq(s) < 0:
+            raise ValueError(f'unsupported base in whitelist sequence: {s}')
+
+    # 与correct_seq的判断顺序一致: perfect > mis > indel
+    table = {}
+    for code, name in ((2, 'indel'), (3, 'mis'), (1, 'perfect')):
+        for k, v in d[name].items():
+            table[pack_seq(k)] = (code, rows[v])
+
+    keys = np.array(sorted(table), dtype=np.uint64)
+    codes = np.array([table[int(k)][0] for k in keys], dtype=np.int8)
+    targets = np.array([table[int(k)][1] for k in keys], dtype=np.int32)
+    width = max([len(s) for s in whitelist] + [1])
+    return _save_index({
+        'keys': keys,
+        'codes': codes,
+        'targets': targets,
+        'whitelist': np.array(whitelist, dtype=f'S{width}'),
+    }, path)
+
+def choose_engine(seq: str, err: int=0, indel: int=0) -> str:
+    # 邻居表大小约为 n * L * (3*err + 4*indel)
+    if not (err or indel):
+        return 'table'
+    whitelist = read_whitelist(seq)
+    size = sum(len(_) for _ in whitelist) * (3 * err + 4 * indel)
+    return 'seed' if size > TABLE_LIMIT else 'table'
+
+@lru_cache(10)
+def load_index(seq: str, err: int=0, indel: int=0, cache_dir: str=None, engine: str=None):
+    '''
+    compiled correction index of a whitelist, cached by file hash.
+    engine: table(neighbor table, WhitelistIndex) or seed(SeedIndex), default by whitelist size.
+    like build_dict, a seq that is not a readable file is used as the sequence itself.
+    raise ValueError if the sequences can not be compiled (bases other than ACGT).
+    '''
+    if not engine:
+        engine = choose_engine(seq, err, indel)
+    compile_func, cls = {
+        'table': (compile_index, WhitelistIndex),
+        'seed': (compile_seed_index, SeedIndex),
+    }[engine]
+    name = f'{file_digest(seq)}_{err}{indel}_{engine}_v{INDEX_VERSION}'
+    for d in (cache_dir, CACHE_DIR, os.path.join(tempfile.gettempdir(), 'seekonetools')):
+        if not d:
+            continue
+        path = os.path.join(d, 'whitelist', name)
+        if not os.path.isdir(path):
+            try:
+                compile_func(seq, err, indel, path)
+            except OSError:
+                continue
+            except ValueError as e:
+                source = 'whitelist file' if os.path.isfile(seq) else 'not a readable file, used as the sequence itself'
+                raise ValueError(f'can not compile whitelist {seq} ({source}): {e}') from e
+        return cls(path)
+    raise OSError(f'can not write whitelist index for {seq}')
@@ -32,6 +32,20 @@ def mkref(fa, gtf, genomeDir, runThreadN=8, star_path='STAR', star_opt=''):
     from .mkref import mkref
     mkref(fa, gtf, genomeDir, runThreadN, star_path, star_opt)
 
+@utils.command(help="compile the annotation cache of a gtf.")
+@click.option('--gtf', type=click.Path(), required=True, help="gtf file.")
+@click.option('--out', type=click.Path(), default=None, help="cache file, default: next to the gtf (genes.gtf -> genes.gtf.npz).")
+def gtfindex(gtf, out=None):
+    from .annotation import write_annotation
+    write_annotation(gtf, out)
+
+@utils.command(help="export a columnar table of step3 (e.g. step3/counts) as tsv.")
+@click.option('--table', type=click.Path(exists=True), required=True, help="table dir, e.g. step3/counts or step3/detail.")
+@click.option('--out', type=click.Path(), required=True, help="tsv file, gzip compressed for .gz, e.g. counts.xls.")
+def exporttable(table, out):
+    from .table import export_table
+    export_table(table, out)
+
 ##@utils.command(help="addtag.")
 ##def addtag():
 ##    pass
@@ -0,0 +1,322 @@
+import os
+import re
+import hashlib
+from bisect import bisect_left, bisect_right
+import numpy as np
+from collections import defaultdict
+from xopen import xopen
+
+_GENE_ID = re.compile('gene_id "([^"]+)"')
+# 与step3.read_gtf一致
+_TABLE_ID = re.compile("gene_id \"([A-Za-z0-9_\.\-\:/\ ()+]+)\";")
+_TABLE_NAME = re.compile("gene_name \"([A-Za-z0-9_\.\-\:/\ ()+]+)\"")
+_MT = re.compile('^(MT|mt|Mt)-')
+MT_CONTIGS = ('chrM', 'MT', 'mt')
+BIOTYPE_KEYS = ('gene_type', 'gene_biotype')
+ANNOTATION_VERSION = 3
+
+
+def read_features(gtf, features=('exon',)):
+    '''
+    yield (feature, chrom, start, end, strand, gene_id) of gtf records, start is 0-based.
+    '''
+    with xopen(gtf) as fh:
+        for line in fh:
+            if line.startswith('#') or not line.strip():
+                continue
+            tmp = line.rstrip('\n').split('\t')
+            if tmp[2] not in features:
+                continue
+            m = _GENE_ID.search(tmp[8])
+            if not m:
+                continue
+            yield tmp[2], tmp[0], int(tmp[3]) - 1, int(tmp[4]), tmp[6], m.group(1)
+
+class Segments:
+    '''
+    intervals cut into non-overlapping segments at their boundaries.
+    bounds: sorted boundaries, labels[i]: id of the label set covering bounds[i]..bounds[i+1],
+    label set k is members[offsets[k]:offsets[k+1]], set 0 is empty.
+    '''
+    def __init__(self, bounds, labels, offsets, members):
+        self.bounds = bounds
+        self.labels = labels
+        self.offsets = offsets
+        self.members = members
+        self._bounds = None
+
+    @classmethod
+    def build(cls, intervals):
+        # intervals: (start, end, label)
+        events = defaultdict(list)
+        for start, end, label in intervals:
+            if end > start:
+                events[start].append((label, 1))
+                events[end].append((label, -1))
+        bounds = sorted(events)
+        sets, set_ids, labels = [()], {(): 0}, []
+        active = defaultdict(int)
+        for pos in bounds:
+            for label, d in events[pos]:
+                active[label] += d
+                if not active[label]:
+                    del active[label]
+            key = tuple(sorted(active))
+            if key not in set_ids:
+                set_ids[key] = len(sets)
+                sets.append(key)
+            labels.append(set_ids[key])
+        offsets = np.cumsum([0] + [len(_) for _ in sets])
+        members = np.array([_ for key in sets for _ in key], dtype=np.int64)
+        return cls(np.array(bounds, dtype=np.int64), np.array(labels, dtype=np.int64), offsets, members)
+
+    def _lists(self):
+        # 首次查询时转为list, 逐条read查询时比numpy标量运算快
+        self._bounds = self.bounds.tolist()
+        self._labels = self.labels.tolist()
+        members, offsets = self.members.tolist(), self.offsets.tolist()
+        self.sets = [tuple(members[offsets[k]:offsets[k + 1]]) for k in range(len(offsets) - 1)]
+
+    def _range(self, start, end):
+        # 与[start, end)重叠的segment, i<0表示start在第一个边界之前
+        if self._bounds is None:
+            self._lists()
+        return bisect_right(self._bounds, start) - 1, bisect_left(self._bounds, end)
+
+    def overlap(self, blocks):
+        '''
+        labels overlapping any of the blocks [(start, end)].
+        '''
+        out = set()
+        for start, end in blocks:
+            i, j = self._range(start, end)
+            for k in self._labels[max(i, 0):j]:
+                out.update(self.sets[k])
+        return out
+
+    def overlap_bases(self, blocks):
+        '''
+        {label: number of bases of the blocks in its intervals}.
+        '''
+        out = defaultdict(int)
+        for start, end in blocks:
+            i, j = self._range(start, end)
+            for k in range(max(i, 0), j):
+                if not self._labels[k]:
+                    continue
+                n = min(end, self._bounds[k + 1]) - max(start, self._bounds[k])
+                for label in self.sets[self._labels[k]]:
+                    out[label] += n
+        return out
+
+    def covers(self, blocks):
+        '''
+        whether every base of the blocks is in some interval.
+        '''
+        for start, end in blocks:
+            i, j = self._range(start, end)
+            if i < 0 or not all(self._labels[i:j]):
+                return False
+        return True
+
+class GeneIndex:
+    '''
+    exon and gene segments of each (chrom, strand), labels are gene indices of genes.
+    feature: gtf feature used as exons (exon or transcript).
+    '''
+    def __init__(self, genes, exons, spans):
+        self.genes = genes
+        self.exons = exons
+        self.spans = spans
+
+    @classmethod
+    def build(cls, records):
+        # records: (chrom, start, end, strand, gene_id), 基因区间取其外显子的范围
+        # 同一gene_id在多条染色体/链上(如PAR基因)时每条各取一个区间
+        genes, gene_ids = [], {}
+        exons, spans = defaultdict(list), {}
+        for chrom, start, end, strand, gene_id in records:
+            if gene_id not in gene_ids:
+                gene_ids[gene_id] = len(genes)
+                genes.append(gene_id)
+            g = gene_ids[gene_id]
+            exons[(chrom, strand)].append((start, end, g))
+            key = (g, chrom, strand)
+            if key in spans:
+                span = spans[key]
+                spans[key] = (min(start, span[0]), max(end, span[1]))
+            else:
+                spans[key] = (start, end)
+        gene_spans = defaultdict(list)
+        for (g, chrom, strand), (start, end) in spans.items():
+            gene_spans[(chrom, strand)].append((start, end, g))
+        return cls(
+            genes,
+            {k: Segments.build(v) for k, v in exons.items()},
+            {k: Segments.build(v) for k, v in gene_spans.items()}
+        )
+
+    @classmethod
+    def from_gtf(cls, gtf, feature='exon', genomeDir=None):
+        '''
+        load from the annotation cache of gtf if there is one, otherwise parse gtf.
+        '''
+        data = load_annotation(gtf, genomeDir, keys=(f'{feature}_',))
+        if data is not None:
+            return cls.from_arrays(data, feature)
+        return cls.build(_[1:] for _ in read_features(gtf, (feature,)))
+
+    def to_arrays(self, prefix):
+        out = {f'{prefix}_genes': np.array(self.genes)}
+        for name, segments in (('exons', self.exons), ('spans', self.spans)):
+            keys = sorted(segments)
+            out[f'{prefix}_{name}_keys'] = np.array([f'{c}\t{s}' for c, s in keys])
+            for attr in ('bounds', 'labels', 'offsets', 'members'):
+                arrays = [getattr(segments[k], attr) for k in keys]
+                out[f'{prefix}_{name}_{attr}'] = np.concatenate(arrays) if arrays else np.zeros(0, np.int64)
+                out[f'{prefix}_{name}_{attr}_n'] = np.array([_.shape[0] for _ in arrays], dtype=np.int64)
+        return out
+
+    @classmethod
+    def from_arrays(cls, data, prefix):
+        parts = []
+        for name in ('exons', 'spans'):
+            keys = [tuple(_.split('\t')) for _ in data[f'{prefix}_{name}_keys'].tolist()]
+            split = {}
+            for attr in ('bounds', 'labels', 'offsets', 'members'):
+                ends = np.cumsum(data[f'{prefix}_{name}_{attr}_n'])
+                split[attr] = np.split(data[f'{prefix}_{name}_{attr}'], ends[:-1]) if len(keys) else []
+            parts.append({k: Segments(*[split[attr][i] for attr in ('bounds', 'labels', 'offsets', 'members')])
+                          for i, k in enumerate(keys)})
+        return cls(data[f'{prefix}_genes'].tolist(), *parts)
+
+    def exon_genes(self, chrom, strand, blocks):
+        seg = self.exons.get((chrom, strand))
+        return seg.overlap(blocks) if seg else set()
+
+    def exon_bases(self, chrom, strand, blocks):
+        seg = self.exons.get((chrom, strand))
+        return seg.overlap_bases(blocks) if seg else {}
+
+    def in_exons(self, chrom, strand, blocks):
+        seg = self.exons.get((chrom, strand))
+        return seg.covers(blocks) if seg else False
+
+    def span_genes(self, chrom, strand, blocks):
+        seg = self.spans.get((chrom, strand))
+        return seg.overlap(blocks) if seg else set()
+
+
+def gtf_checksum(gtf) -> str:
+    md5 = hashlib.md5()
+    with open(gtf, 'rb') as fh:
+        for block in iter(lambda: fh.read(1 << 22), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+def annotation_path(gtf) -> str:
+    # gtf旁边的缓存, genes.gtf(.gz) -> genes.gtf.npz
+    return re.sub(r'\.gz$', '', gtf) + '.npz'
+
+def _attr(attributes, key):
+    m = re.search(f'{key} "([^"]*)"', attributes)
+    return m.group(1) if m else None
+
+def build_annotation(gtf) -> dict:
+    '''
+    parse gtf once into arrays:
+    table_id/table_name: features of the matrix (same as step3.read_gtf, MT- prefixed),
+    gene_id/gene_name/gene_chrom/gene_type/gene_mt: gene records, gene_type is the first of BIOTYPE_KEYS found,
+    gene_mt uses the MT rule of step3.read_gtf: column 2 (source) of the gene record in MT_CONTIGS,
+    so it marks the genes whose features get the MT- prefix (not gene_chrom).
+    exon_*/transcript_*: GeneIndex of exons and transcripts.
+    '''
+    table_id, table_name = [], []
+    gene_id, gene_name, gene_chrom, gene_type, gene_mt = [], [], [], [], []
+    biotype_key = None
+    records = {'exon': [], 'transcript': []}
+    with xopen(gtf) as fh:
+        for line in fh:
+            if not line: continue
+            if line.startswith('#'): continue
+            tmp = line.strip().split('\t')
+            if len(tmp) < 9:
+                continue
+            if tmp[2] in records:
+                m = _GENE_ID.search(tmp[8])
+                if m:
+                    records[tmp[2]].append((tmp[0], int(tmp[3]) - 1, int(tmp[4]), tmp[6], m.group(1)))
+                continue
+            if tmp[2] != 'gene':
+                continue
+            m = _GENE_ID.search(tmp[8])
+            if m:
+                gene_id.append(m.group(1))
+                gene_name.append(_attr(tmp[8], 'gene_name') or m.group(1))
+                gene_chrom.append(tmp[0])
+                gene_mt.append(tmp[1] in MT_CONTIGS)
+                if biotype_key is None:
+                    biotype_key = next((k for k in BIOTYPE_KEYS if f'{k} "' in tmp[8]), None)
+                gene_type.append((_attr(tmp[8], biotype_key) if biotype_key else None) or '')
+            if "gene_id" in tmp[-1]:
+                _id = _TABLE_ID.findall(tmp[-1])[0]
+                names = _TABLE_NAME.findall(tmp[-1])
+                _name = names[0] if names else _id
+                if tmp[1] in MT_CONTIGS:
+                    if not _MT.match(_id):
+                        _id = f'MT-{_id}'
+                        _name = f'MT-{_name}'
+                table_id.append(_id)
+                table_name.append(_name)
+    data = {
+        'version': np.array(ANNOTATION_VERSION),
+        'table_id': np.array(table_id, dtype=str), 'table_name': np.array(table_name, dtype=str),
+        'gene_id': np.array(gene_id, dtype=str), 'gene_name': np.array(gene_name, dtype=str),
+        'gene_chrom': np.array(gene_chrom, dtype=str), 'gene_type': np.array(gene_type, dtype=str),
+        'gene_mt': np.array(gene_mt, dtype=bool),
+        'biotype_key': np.array(biotype_key or ''),
+    }
+    for feature, recs in records.items():
+        data.update(GeneIndex.build(recs).to_arrays(feature))
+    return data
+
+def write_annotation(gtf, out=None) -> str:
+    '''
+    write the annotation cache of gtf (default: next to gtf), keyed by the checksum of gtf.
+    '''
+    out = out or annotation_path(gtf)
+    data = build_annotation(gtf)
+    stat = os.stat(gtf)
+    data.update({
+        'gtf_md5': np.array(gtf_checksum(gtf)),
+        'gtf_size': np.array(stat.st_size),
+        'gtf_mtime': np.array(stat.st_mtime_ns),
+    })
+    tmp = f'{out}.tmp.npz'
+    np.savez(tmp, **data)
+    os.replace(tmp, out)
+    return out
+
+def load_annotation(gtf, genomeDir=None, keys=None):
+    '''
+    the annotation cache of gtf (in genomeDir or next to gtf), None if there is no valid one.
+    the cache is used when size and mtime of gtf match, or its md5 matches.
+    keys: names or name prefixes of the arrays to load, default all. return a dict of arrays.
+    '''
+    candidates = [annotation_path(gtf)]
+    if genomeDir:
+        candidates.insert(0, os.path.join(genomeDir, 'annotation.npz'))
+    stat = os.stat(gtf)
+    checksum = None
+    for path in candidates:
+        if not os.path.exists(path):
+            continue
+        with np.load(path) as npz:
+            if int(npz['version']) != ANNOTATION_VERSION or int(npz['gtf_size']) != stat.st_size:
+                continue
+            if int(npz['gtf_mtime']) != stat.st_mtime_ns:
+                checksum = checksum or gtf_checksum(gtf)
+                if str(npz['gtf_md5']) != checksum:
+                    continue
+            return {k: npz[k] for k in npz.files if keys is None or k.startswith(tuple(keys))}
+    return None
@@ -0,0 +1,98 @@
+import struct
+import numpy as np
+from .fastq import gather_ranges, _positions
+
+# BAM中序列的4bit编码, 非IUPAC字符按N处理
+SEQ_CODE = np.full(256, 15, dtype=np.uint8)
+for _i, _c in enumerate(b'=ACMGRSVTWYHKDBN'):
+    SEQ_CODE[_c] = _i
+    SEQ_CODE[ord(chr(_c).lower())] = _i
+
+UNMAPPED = 4
+# refID pos l_read_name mapq bin n_cigar_op flag l_seq next_refID next_pos tlen
+_CORE = struct.Struct('<iiBBHHHiiii')
+CORE_DTYPE = np.dtype([('block_size', '<i4'), ('refID', '<i4'), ('pos', '<i4'), ('l_read_name', 'u1'),
+                       ('mapq', 'u1'), ('bin', '<u2'), ('n_cigar_op', '<u2'), ('flag', '<u2'),
+                       ('l_seq', '<i4'), ('next_refID', '<i4'), ('next_pos', '<i4'), ('tlen', '<i4')])
+# 未比对read的bin, reg2bin(-1, 0)
+UNMAPPED_BIN = 4680
+
+
+def bam_header(text: str='', references: list=[]) -> bytes:
+    '''
+    binary BAM header, references is a list of (name, length).
+    '''
+    text = text.encode()
+    out = [b'BAM\1', struct.pack('<i', len(text)), text, struct.pack('<i', len(references))]
+    for name, length in references:
+        name = name.encode() + b'\0'
+        out.append(struct.pack('<i', len(name)) + name + struct.pack('<i', length))
+    return b''.join(out)
+
+def unaligned_header(version: str) -> bytes:
+    return bam_header(f'@HD\tVN:1.6\tSO:unsorted\n@PG\tID:seekonetools\tPN:seekonetools\tVN:{version}\n')
+
+def pack_seq(seq: bytes) -> bytes:
+    codes = SEQ_CODE[np.frombuffer(seq, dtype=np.uint8)]
+    if codes.shape[0] % 2:
+        codes = np.append(codes, np.uint8(0))
+    return ((codes[0::2] << 4) | codes[1::2]).tobytes()
+
+def encode_unaligned(name: str, seq: str, qual: str, tags: list, phred: int=33) -> bytes:
+    '''
+    encode an unaligned single end read, tags is a list of (tag, str value) stored as Z.
+    '''
+    name = name.encode() + b'\0'
+    seq = seq.encode()
+    qual = bytes(_ - phred for _ in qual.encode())
+    aux = b''.join(t.encode() + b'Z' + v.encode() + b'\0' for t, v in tags)
+    core = _CORE.pack(-1, -1, len(name), 0, UNMAPPED_BIN, 0, UNMAPPED, len(seq), -1, -1, 0)
+    data = core + name + pack_seq(seq) + qual + aux
+    return struct.pack('<i', len(data)) + data
+
+def encode_unaligned_batch(src: np.ndarray, name: tuple, seq: tuple, qual: tuple, tags: list, phred: int=33) -> np.ndarray:
+    '''
+    encode_unaligned for a batch of reads, all fields are (starts, lengths) ranges of src.
+    tags is a list of (tag, [ranges]), the ranges of a tag are concatenated as its value.
+    return the records as one uint8 array.
+    '''
+    n = name[0].shape[0]
+    seq_len = np.asarray(seq[1], dtype=np.int64)
+    # 序列补齐为偶数长度后两两合并
+    packed_len = (seq_len + 1) // 2
+    padded = np.zeros(int(packed_len.sum()) * 2, dtype=np.uint8)
+    offsets = np.cumsum(packed_len * 2) - packed_len * 2
+    padded[np.repeat(offsets, seq_len) + _positions(seq_len)] = SEQ_CODE[gather_ranges(src, *seq)]
+    packed = (padded[0::2] << 4) | padded[1::2]
+    quals = gather_ranges(src, *qual) - np.uint8(phred)
+
+    tag_len = np.zeros(n, dtype=np.int64)
+    for _, ranges in tags:
+        tag_len += sum(np.asarray(r[1], dtype=np.int64) for r in ranges) + 4
+    core = np.zeros(n, dtype=CORE_DTYPE)
+    core['block_size'] = 32 + name[1] + 1 + packed_len + seq_len + tag_len
+    for k in ('refID', 'pos', 'next_refID', 'next_pos'):
+        core[k] = -1
+    core['l_read_name'] = name[1] + 1
+    core['bin'] = UNMAPPED_BIN
+    core['flag'] = UNMAPPED
+    core['l_seq'] = seq_len
+
+    consts = np.frombuffer(b'\0' + b''.join(t.encode() + b'Z' for t, _ in tags), dtype=np.uint8)
+    parts = [src, core.view(np.uint8), packed, quals, consts]
+    bases = np.cumsum([0] + [p.shape[0] for p in parts])
+    ones = np.ones(n, dtype=np.int64)
+    pieces = [
+        (bases[1] + np.arange(n) * CORE_DTYPE.itemsize, ones * CORE_DTYPE.itemsize),
+        name,
+        (np.full(n, bases[4]), ones),
+        (bases[2] + offsets // 2, packed_len),
+        (bases[3] + np.cumsum(seq_len) - seq_len, seq_len),
+    ]
+    for k, (_, ranges) in enumerate(tags):
+        pieces.append((np.full(n, bases[4] + 1 + 3 * k), ones * 3))
+        pieces += ranges
+        pieces.append((np.full(n, bases[4]), ones))
+    starts = np.stack([np.asarray(p[0], dtype=np.int64) for p in pieces], axis=1)
+    lengths = np.stack([np.asarray(p[1], dtype=np.int64) for p in pieces], axis=1)
+    return gather_ranges(np.concatenate(parts), starts, lengths)
@@ -0,0 +1,40 @@
+import gzip
+import zlib
+import struct
+
+# htslib的BGZF结束块
+BGZF_EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000')
+BGZF_BLOCK_SIZE = 0xff00
+_BGZF_MAX = 65536
+
+
+def bgzf_compress(data, level: int=6) -> bytes:
+    '''
+    compress data into BGZF blocks (without EOF block).
+    concatenated blocks are valid gzip and can be read by zcat and htslib.
+    '''
+    data = memoryview(data).cast('B')
+    out = []
+    for i in range(0, data.nbytes, BGZF_BLOCK_SIZE):
+        block = data[i:i + BGZF_BLOCK_SIZE]
+        c = zlib.compressobj(level, zlib.DEFLATED, -15)
+        cdata = c.compress(block) + c.flush()
+        if len(cdata) + 26 > _BGZF_MAX:
+            # 不可压缩的数据
+            c = zlib.compressobj(0, zlib.DEFLATED, -15)
+            cdata = c.compress(block) + c.flush()
+        out.append(struct.pack('<4BI2BH2BHH', 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+        out.append(cdata)
+        out.append(struct.pack('<II', zlib.crc32(block) & 0xffffffff, block.nbytes))
+    return b''.join(out)
+
+def gzip_compress(data, level: int=6) -> bytes:
+    # 单个gzip member, 多个member直接拼接即可
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+def compress_chunk(data, fmt: str='bgzf', level: int=6) -> bytes:
+    if fmt == 'bgzf':
+        return bgzf_compress(data, level)
+    elif fmt == 'gzip':
+        return gzip_compress(data, level)
+    raise ValueError(f'unknown compress format: {fmt}')
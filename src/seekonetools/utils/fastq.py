@@ -0,0 +1,162 @@
+import numpy as np
+
+# A=0 C=1 G=2 T=3, 其他碱基为4
+BASE_CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _c in enumerate(b'ACGT'):
+    BASE_CODE[_c] = _i
+
+
+GC_BASES = 'ATCGN'
+GC_CODE = np.full(256, len(GC_BASES), dtype=np.int64)
+for _i, _c in enumerate(GC_BASES.encode()):
+    GC_CODE[_c] = _i
+MAX_PHRED = 93
+
+
+def as_array(fh) -> np.ndarray:
+    # BytesIO/bytes/memoryview -> uint8数组, 尽量不复制
+    if hasattr(fh, 'getbuffer'):
+        data = fh.getbuffer()
+    elif hasattr(fh, 'read'):
+        data = fh.read()
+    else:
+        data = fh
+    return np.frombuffer(data, dtype=np.uint8)
+
+def parse_chunk(buf: np.ndarray) -> dict:
+    '''
+    split a fastq chunk into line offsets.
+    return start/length arrays of name(without @), sequence and qualities lines.
+    '''
+    nl = np.flatnonzero(buf == 10)
+    if buf.shape[0] and buf[-1] != 10:
+        nl = np.append(nl, buf.shape[0])
+    if nl.shape[0] % 4:
+        raise ValueError('fastq chunk is truncated')
+    starts = np.empty(nl.shape[0], dtype=np.int64)
+    starts[0:1] = 0
+    starts[1:] = nl[:-1] + 1
+    ends = nl.copy()
+    # windows line ending
+    cr = (ends > starts) & (buf[np.maximum(ends - 1, 0)] == 13)
+    ends[cr] -= 1
+    lengths = ends - starts
+    if starts.shape[0] and (buf[starts[0::4]] != 64).any():
+        raise ValueError('fastq record does not start with @')
+    return {
+        'name': (starts[0::4] + 1, lengths[0::4] - 1),
+        'sequence': (starts[1::4], lengths[1::4]),
+        'qualities': (starts[3::4], lengths[3::4]),
+    }
+
+def pad_matrix(buf: np.ndarray, starts: np.ndarray, lengths: np.ndarray, fill: int=0) -> np.ndarray:
+    # 按行取出变长序列, 不足最大长度的部分以fill填充
+    width = int(lengths.max()) if lengths.shape[0] else 0
+    cols = np.arange(width)
+    idx = starts[:, None] + cols
+    mask = cols < lengths[:, None]
+    mat = buf[np.minimum(idx, max(buf.shape[0] - 1, 0))] if buf.shape[0] else np.zeros(idx.shape, np.uint8)
+    mat = np.where(mask, mat, np.uint8(fill))
+    return mat
+
+def gather(mat: np.ndarray, starts: np.ndarray, n: int, fill: int=0) -> np.ndarray:
+    # 每行从starts开始取n列, 越界部分以fill填充
+    cols = starts[:, None] + np.arange(n)
+    inside = cols < mat.shape[1]
+    out = mat[np.arange(mat.shape[0])[:, None], np.minimum(cols, max(mat.shape[1] - 1, 0))] if mat.shape[1] else np.zeros(cols.shape, np.uint8)
+    return np.where(inside, out, np.uint8(fill))
+
+def pack_matrix(mat: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    '''
+    pack rows of a base matrix into uint64 keys (same encoding as whitelist.pack_seq).
+    only the first lengths[i] bases of row i are used, rows with non-ACGT bases get 0.
+    '''
+    codes = BASE_CODE[mat]
+    keys = np.ones(mat.shape[0], dtype=np.uint64)
+    valid = np.ones(mat.shape[0], dtype=bool)
+    for k in range(mat.shape[1]):
+        use = k < lengths
+        c = codes[:, k]
+        valid &= ~(use & (c > 3))
+        keys = np.where(use, (keys << np.uint64(2)) | c.astype(np.uint64), keys)
+    keys[~valid] = 0
+    return keys
+
+def _positions(lengths: np.ndarray) -> np.ndarray:
+    # 拼接序列中每个碱基在各自read中的位置
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return np.arange(int(lengths.sum()), dtype=np.int64) - offsets
+
+def base_matrix(buf: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    '''
+    position x base (GC_BASES) counts of concatenated sequences.
+    '''
+    width = int(np.max(lengths)) if len(lengths) else 0
+    pos = _positions(lengths)
+    code = GC_CODE[buf]
+    keep = code < len(GC_BASES)
+    counts = np.bincount(pos[keep] * len(GC_BASES) + code[keep], minlength=width * len(GC_BASES))
+    return counts.reshape(width, len(GC_BASES))
+
+def qual_matrix(buf: np.ndarray, lengths: np.ndarray, phred: int=33) -> np.ndarray:
+    '''
+    position x phred score (0..MAX_PHRED) counts of concatenated qualities.
+    '''
+    width = int(np.max(lengths)) if len(lengths) else 0
+    pos = _positions(lengths)
+    q = np.clip(buf.astype(np.int64) - phred, 0, MAX_PHRED)
+    counts = np.bincount(pos * (MAX_PHRED + 1) + q, minlength=width * (MAX_PHRED + 1))
+    return counts.reshape(width, MAX_PHRED + 1)
+
+def gather_ranges(src: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    # 按顺序拼接src[starts[i]:starts[i]+lengths[i]]
+    starts = np.asarray(starts, dtype=np.int64).ravel()
+    lengths = np.asarray(lengths, dtype=np.int64).ravel()
+    offsets = np.cumsum(lengths) - lengths
+    idx = np.arange(int(lengths.sum()), dtype=np.int64) - np.repeat(offsets - starts, lengths)
+    return src[idx]
+
+POLYA_NONE = -1
+POLYA_ALIGN = -2
+
+
+def scan_polya(buf: np.ndarray, starts: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    '''
+    poly-A tail scan of concatenated reads, same result as cutadapt BackAdapter('A'*15)
+    (error rate 0.1, min overlap 3). return the match start of each read,
+    POLYA_NONE for no match and POLYA_ALIGN for reads which still need the aligner.
+
+    a match with <10 adapter bases has no error and must end the read (read ends with AAA),
+    otherwise it has one error at most: the last 9 bases have >=8 A (partial match at 3' end)
+    or some 14-base window has >=13 A (full length match). reads with only the first case
+    end with a run of 3-7 A, which is the best match. reads shorter than 9 bases ending
+    with AAA are left to the aligner, a mismatch can give them a longer match there.
+    '''
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.asarray(lengths, dtype=np.int64)
+    ends = starts + lengths
+    cs = np.zeros(buf.shape[0] + 1, dtype=np.int64)
+    np.cumsum(buf == 65, out=cs[1:])
+
+    def tail(k):
+        # read末尾k个碱基是否都是A
+        return (lengths >= k) & (cs[ends] - cs[np.maximum(ends - k, starts)] == k)
+
+    align = (lengths >= 9) & (cs[ends] - cs[np.maximum(ends - 9, starts)] >= 8)
+    if buf.shape[0] >= 14:
+        window = np.zeros(buf.shape[0] - 12, dtype=np.int64)
+        np.cumsum(cs[14:] - cs[:-14] >= 13, out=window[1:])
+        last = np.clip(ends - 13, starts, buf.shape[0] - 13)
+        align |= (lengths >= 14) & (window[last] > window[np.minimum(starts, buf.shape[0] - 13)])
+    rstart = np.full(starts.shape[0], POLYA_NONE, dtype=np.int64)
+    for k in range(3, 8):
+        t = tail(k)
+        rstart[t] = lengths[t] - k
+    align |= (lengths < 9) & tail(3)
+    rstart[align] = POLYA_ALIGN
+    return rstart
+
+def maybe_polya(seq: str) -> bool:
+    # 单条read的粗筛, 返回False时一定没有polyA
+    return seq.endswith('AAA') or 'AAAA' in seq[-9:] or 'AAAAAAA' in seq
@@ -1,14 +1,25 @@
+import os
 import re
 import sys
 from subprocess import run
 from collections import defaultdict
 from xopen import xopen
+from .annotation import load_annotation, write_annotation
 
 
 def gtfstat(gtf, feature="gene", key='gene_type'):
     '''
     gtf summary
     '''
+    data = load_annotation(gtf, keys=('biotype_key', 'gene_type'))
+    if feature == 'gene' and data is not None and str(data['biotype_key']) == key:
+        # 使用注释缓存中的biotype
+        summary = defaultdict(int)
+        for t in data['gene_type'].tolist():
+            summary[t] += 1
+        for k, v in sorted(summary.items(), key = lambda x: x[1]):
+            sys.stdout.write(f'{k}\t{v}\n')
+        return
     with xopen(gtf) as fh:
         summary = defaultdict(int)
         for line in fh:
@@ -83,5 +94,6 @@ def mkref(fa, gtf, genomeDir, runThreadN=8, star_path='STAR',
             star_opt='--genomeSAindexNbases 14 --genomeChrBinNbits 18 --genomeSAsparseD 3 --limitGenomeGenerateRAM 17179869184'):
     cmd = (f'{star_path} --runMode genomeGenerate --runThreadN {runThreadN} --genomeDir {genomeDir} '
            f'--genomeFastaFiles {fa} --sjdbGTFfile {gtf} {star_opt} ')
-    run(cmd)
+    run(cmd, shell=True, check=True)
+    write_annotation(gtf, os.path.join(genomeDir, 'annotation.npz'))
 
@@ -0,0 +1,37 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import numpy as np
+from .compress import compress_chunk
+
+
+def mtx_header(shape: tuple, nnz: int) -> bytes:
+    # 与scipy.io.mmwrite写出的整数coo矩阵相同
+    return f'%%MatrixMarket matrix coordinate integer general\n%\n{shape[0]} {shape[1]} {nnz}\n'.encode()
+
+def mtx_lines(row, col, data) -> bytes:
+    # 1-based的"row col value"行
+    n = len(data)
+    flat = np.column_stack((np.asarray(row, dtype=np.int64) + 1,
+                            np.asarray(col, dtype=np.int64) + 1,
+                            np.asarray(data, dtype=np.int64))).ravel().tolist()
+    return ('%d %d %d\n' * n % tuple(flat)).encode()
+
+def write_mtx(path: str, row, col, data, shape: tuple, core: int=4, chunk: int=1 << 20, level: int=6) -> str:
+    '''
+    write a sparse integer matrix given as coo arrays (0-based, in the order to write)
+    to a gzip compressed Matrix Market file, with the same text as scipy.io.mmwrite.
+    chunks of entries are formatted in order and compressed in threads into gzip members.
+    '''
+    nnz = len(data)
+    with open(path, 'wb') as fh, ThreadPoolExecutor(max(core, 1)) as pool:
+        pending = deque([pool.submit(compress_chunk, mtx_header(shape, nnz), 'gzip', level)])
+        for start in range(0, nnz, chunk):
+            end = start + chunk
+            pending.append(pool.submit(compress_chunk, mtx_lines(row[start:end], col[start:end], data[start:end]),
+                                       'gzip', level))
+            # 限制待写出的chunk数
+            while len(pending) > 2 * core:
+                fh.write(pending.popleft().result())
+        while pending:
+            fh.write(pending.popleft().result())
+    return path
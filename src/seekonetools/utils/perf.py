@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import resource
+import threading
+from functools import wraps
+from inspect import signature
+from subprocess import Popen, CompletedProcess, CalledProcessError
+
+FIELDS = ['step', 'name', 'kind', 'status', 'wall_time', 'user_time', 'sys_time', 'max_rss',
+          'read_bytes', 'write_bytes', 'read_chars', 'write_chars']
+_IO_KEYS = {'read_bytes': 'read_bytes', 'write_bytes': 'write_bytes', 'rchar': 'read_chars', 'wchar': 'write_chars'}
+
+# 当前进程的记录, 以及正在运行的step(可嵌套)
+_records = []
+_stack = []
+
+
+def read_io(pid='self'):
+    '''
+    bytes read and written by a process from /proc/{pid}/io, reaped children are included.
+    read/write_bytes: storage io, read/write_chars: all reads and writes (page cache, pipes).
+    '''
+    io = dict.fromkeys(_IO_KEYS.values(), 0)
+    try:
+        with open(f'/proc/{pid}/io') as fh:
+            for line in fh:
+                k, v = line.split(':')
+                if k in _IO_KEYS:
+                    io[_IO_KEYS[k]] = int(v)
+    except OSError:
+        pass
+    return io
+
+def tree_rss(pid):
+    # 进程及其所有子进程的常驻内存
+    rss = 0
+    pids = [pid]
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as fh:
+                rss += int(fh.read().split()[1]) * resource.getpagesize()
+            for tid in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{tid}/children') as fh:
+                    pids.extend(int(_) for _ in fh.read().split())
+        except (OSError, ValueError):
+            continue
+    return rss
+
+class RssSampler(threading.Thread):
+    '''
+    sample the rss of a process tree every interval seconds, peak is the max sum.
+    '''
+    def __init__(self, pid=None, interval=0.5):
+        super().__init__(daemon=True)
+        self.pid = pid or os.getpid()
+        self.interval = interval
+        self.peak = 0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while True:
+            self.peak = max(self.peak, tree_rss(self.pid))
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+def _cpu():
+    s = resource.getrusage(resource.RUSAGE_SELF)
+    c = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return s.ru_utime + c.ru_utime, s.ru_stime + c.ru_stime
+
+def _record(**kw):
+    record = {k: kw.get(k) for k in FIELDS}
+    for k in ('wall_time', 'user_time', 'sys_time'):
+        if record[k] is not None:
+            record[k] = round(record[k], 3)
+    _records.append(record)
+    return record
+
+def step(name):
+    '''
+    decorator of a step function with samplename and outdir arguments:
+    wall time, cpu (children included), peak rss of the process tree and io of the step
+    are saved with the tools it ran to the performance of {samplename}_summary.json
+    and {samplename}_performance.tsv in outdir.
+    status is ok, failed (exception) or interrupted (KeyboardInterrupt), failed and
+    interrupted steps are saved too.
+    '''
+    def decorator(func):
+        sig = signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = sig.bind_partial(*args, **kwargs)
+            start = len(_records)
+            _stack.append(name)
+            sampler = RssSampler()
+            sampler.start()
+            t0, (u0, s0), io0 = time.time(), _cpu(), read_io()
+            status = 'failed'
+            try:
+                result = func(*args, **kwargs)
+                status = 'ok'
+                return result
+            except KeyboardInterrupt:
+                status = 'interrupted'
+                raise
+            finally:
+                _stack.pop()
+                peak = sampler.stop()
+                t1, (u1, s1), io1 = time.time(), _cpu(), read_io()
+                _record(step=name, name=name, kind='step', status=status, wall_time=t1 - t0, user_time=u1 - u0,
+                        sys_time=s1 - s0, max_rss=peak, **{k: io1[k] - io0[k] for k in io0})
+                try:
+                    save(bound.arguments['outdir'], bound.arguments['samplename'], _records[start:])
+                except OSError:
+                    # 失败的step可能还没有创建outdir, 不掩盖原来的异常
+                    if status == 'ok':
+                        raise
+        return wrapper
+    return decorator
+
+def popen(args, name=None, **kwargs):
+    # 与subprocess.Popen相同, 由wait统计资源
+    proc = Popen(args, **kwargs)
+    proc.perf_name = name or os.path.basename(str(args[0]))
+    proc.perf_start = time.time()
+    proc.perf_sampler = RssSampler(proc.pid)
+    proc.perf_sampler.start()
+    return proc
+
+def wait(proc):
+    '''
+    wait for a process started by popen and record its wall time, cpu, peak rss and io.
+    cpu comes from wait4 and includes the children the tool waited for, rss is sampled
+    from the process tree (ru_maxrss of a forked child starts from the rss of its parent).
+    return the returncode.
+    '''
+    rusage, io = None, {}
+    try:
+        if proc.returncode is None:
+            try:
+                # 先等待退出但不回收, 读取/proc/pid/io后再回收
+                os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+                io = read_io(proc.pid)
+                _, status, rusage = os.wait4(proc.pid, 0)
+                proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            except ChildProcessError:
+                proc.wait()
+    finally:
+        # 运行不到一次采样的进程没有rss
+        peak = proc.perf_sampler.stop() or None
+    # 已被poll回收的进程只有运行时间
+    _record(step=_stack[-1] if _stack else '', name=proc.perf_name, kind='tool',
+            status='ok' if proc.returncode == 0 else 'failed',
+            wall_time=time.time() - proc.perf_start,
+            user_time=rusage.ru_utime if rusage else None,
+            sys_time=rusage.ru_stime if rusage else None,
+            max_rss=peak, **io)
+    return proc.returncode
+
+def run(args, check=False, name=None, **kwargs):
+    '''
+    subprocess.run with resource accounting, name defaults to the basename of the program.
+    '''
+    with popen(args, name=name, **kwargs) as proc:
+        try:
+            wait(proc)
+        except BaseException:
+            proc.kill()
+            raise
+    if check and proc.returncode:
+        raise CalledProcessError(proc.returncode, args)
+    return CompletedProcess(args, proc.returncode)
+
+def save(outdir, samplename, records):
+    '''
+    replace the records of the same steps in {samplename}_summary.json (section performance)
+    and rewrite {samplename}_performance.tsv.
+    '''
+    summary_file = os.path.join(outdir, f'{samplename}_summary.json')
+    summary = {}
+    if os.path.exists(summary_file):
+        with open(summary_file) as fh:
+            summary = json.load(fh)
+    steps = {_['step'] for _ in records}
+    performance = [_ for _ in summary.get('performance', []) if _['step'] not in steps] + list(records)
+    summary['performance'] = performance
+    with open(summary_file, 'w') as fh:
+        json.dump(summary, fh, indent=4)
+    with open(os.path.join(outdir, f'{samplename}_performance.tsv'), 'w') as fh:
+        fh.write('\t'.join(FIELDS) + '\n')
+        for record in performance:
+            fh.write('\t'.join('' if record[k] is None else str(record[k]) for k in FIELDS) + '\n')
@@ -1,69 +1,355 @@
-import sys
-from multiprocessing import Pipe, Process, Queue
+import os
+import json
+import time
+import pickle
+from statistics import median
+from multiprocessing import Pipe, Process, Queue, Semaphore, Value, Event
 import multiprocessing.connection
 import io
+import queue
+import threading
+import traceback
 import dnaio
 from xopen import xopen
+from .compress import compress_chunk, BGZF_EOF
+
+
+class BufferReader(io.RawIOBase):
+    '''
+    read-only file object over a memoryview (e.g. a shared memory slot).
+    '''
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = self._buf[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def getbuffer(self):
+        return self._buf[self._pos:]
+
+
+class SlotWriter(io.RawIOBase):
+    '''
+    write into a preallocated memoryview, fall back to BytesIO when it is full.
+    '''
+    def __init__(self, buf):
+        self._buf = buf
+        self._pos = 0
+        self._overflow = None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        b = memoryview(b).cast('B')
+        n = b.nbytes
+        if self._overflow is None and self._pos + n <= len(self._buf):
+            self._buf[self._pos:self._pos + n] = b
+        else:
+            if self._overflow is None:
+                self._overflow = io.BytesIO()
+                self._overflow.write(self._buf[:self._pos])
+            self._overflow.write(b)
+        self._pos += n
+        return n
+
+    @property
+    def overflowed(self):
+        return self._overflow is not None
+
+    def tell(self):
+        return self._pos
+
+    def getvalue(self):
+        if self._overflow is not None:
+            return self._overflow.getvalue()
+        return bytes(self._buf[:self._pos])
+
+
+class SharedSlots:
+    '''
+    shared memory of one worker: one input slot (fq1 + fq2 chunk) and
+    a ring of output slots, only slot indices and sizes go through pipes.
+    '''
+    def __init__(self, buffer_size, n_out=1, n_slots=2):
+        from multiprocessing import shared_memory
+        self.buffer_size = buffer_size
+        self.out_size = 2 * buffer_size
+        self.n_out = n_out
+        self.n_slots = n_slots
+        self.input = shared_memory.SharedMemory(create=True, size=2 * buffer_size)
+        self.output = shared_memory.SharedMemory(create=True, size=n_slots * n_out * self.out_size)
+        # worker写之前acquire, 主进程写出后release
+        self.free = Semaphore(n_slots)
+
+    def input_views(self, sizes):
+        buf = self.input.buf
+        return [buf[0:sizes[0]], buf[self.buffer_size:self.buffer_size + sizes[1]]]
+
+    def write_input(self, chunk1, chunk2):
+        buf = self.input.buf
+        n1, n2 = len(chunk1), len(chunk2)
+        buf[0:n1] = chunk1
+        buf[self.buffer_size:self.buffer_size + n2] = chunk2
+        return n1, n2
+
+    def output_views(self, slot):
+        buf = self.output.buf
+        start = slot * self.n_out * self.out_size
+        return [buf[start + i * self.out_size:start + (i + 1) * self.out_size] for i in range(self.n_out)]
+
+    def close(self):
+        for shm in (self.input, self.output):
+            shm.close()
+            shm.unlink()
+
+
+def open_fastq(file, threads=None):
+    '''
+    threads: None, let xopen decide; 0, decompress in this process (ISA-L if installed);
+             >0, decompress with an external igzip/pigz process.
+    '''
+    if threads == 0 and file.endswith('.gz'):
+        try:
+            from isal import igzip
+            return igzip.open(file, 'rb')
+        except ImportError:
+            pass
+    if threads is None:
+        return xopen(file, 'rb')
+    return xopen(file, 'rb', threads=threads)
+
+def skip_bytes(fh, n, block=1024**2):
+    # 解压后的数据只能顺序读取
+    while n > 0:
+        data = fh.read(min(n, block))
+        if not data:
+            raise EOFError(f'{fh.name} is shorter than the checkpoint')
+        n -= len(data)
+
+def read_lane(file1, file2, buffer_size, chunks, threads=None, skip=(0, 0)):
+    # 在线程中解压一个lane, chunk放入有界队列, 结束时放入None
+    try:
+        with open_fastq(file1, threads) as f1:
+            with open_fastq(file2, threads) as f2:
+                skip_bytes(f1, skip[0])
+                skip_bytes(f2, skip[1])
+                for (chunk1, chunk2) in dnaio.read_paired_chunks(f1, f2, buffer_size):
+                    # read_paired_chunks会复用缓冲区
+                    chunks.put((bytes(chunk1), bytes(chunk2)))
+        chunks.put(None)
+    except Exception as e:
+        chunks.put(e)
+
 
 class Reader(Process):
-    def __init__(self, file1, file2, connections, queue, buffer_size):
+    '''
+    lanes: number of fq1/fq2 pairs decompressed concurrently,
+           chunks are still sent in the order of the input files.
+    threads: decompress threads of each file, see open_fastq.
+    prefetch: chunks buffered for each lane.
+    begin: (chunk_index, lane, (offset1, offset2)), resume from the uncompressed offsets of a lane.
+    chunks: if given, (chunk_index, lane, (offset1, length1), (offset2, length2)) of each chunk is put into it.
+    tuner: if given, tuner.group consecutive chunks of buffer_size are sent as one chunk.
+    window: if given, a semaphore acquired for every chunk and released when it is written.
+    '''
+    def __init__(self, file1, file2, connections, queue, buffer_size, slots=None,
+                 lanes=1, threads=None, prefetch=1, begin=None, chunks=None, tuner=None, window=None):
         super().__init__()
         self.file1 = file1
         self.file2 = file2
         self.connections = connections
         self.queue = queue
         self.buffer_size = buffer_size
+        self.slots = slots
+        self.lanes = max(lanes, 1)
+        self.threads = threads
+        self.prefetch = prefetch
+        self.begin = begin or (0, 0, (0, 0))
+        self.chunks = chunks
+        self.tuner = tuner
+        self.window = window
+
+    def _start_lane(self, index, skip=(0, 0)):
+        chunks = queue.Queue(self.prefetch)
+        t = threading.Thread(target=read_lane, daemon=True,
+                             args=(self.file1[index], self.file2[index], self.buffer_size, chunks, self.threads, skip))
+        t.start()
+        return chunks
+
+    def _chunks(self):
+        # 同时解压lanes个lane, 按顺序依次取出
+        n = min(len(self.file1), len(self.file2))
+        first, skip = self.begin[1], self.begin[2]
+        lanes = {i: self._start_lane(i, skip if i == first else (0, 0))
+                 for i in range(first, min(first + self.lanes, n))}
+        for i in range(first, n):
+            chunks = lanes.pop(i)
+            offsets = list(skip) if i == first else [0, 0]
+            while True:
+                t = time.perf_counter()
+                item = chunks.get()
+                if self.tuner:
+                    self.tuner.wait_input.value += time.perf_counter() - t
+                if item is None:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+                yield i, offsets, item
+                offsets = [offsets[0] + len(item[0]), offsets[1] + len(item[1])]
+            if i + self.lanes < n:
+                lanes[i + self.lanes] = self._start_lane(i + self.lanes)
+
+    def _grouped(self):
+        # 同一lane中连续的chunk按tuner.group合并发送
+        pending = []
+
+        def join():
+            lane, offsets, _ = pending[0]
+            if len(pending) == 1:
+                return pending[0]
+            return lane, offsets, tuple(b''.join(c[i] for _, _, c in pending) for i in range(2))
+
+        for lane, offsets, item in self._chunks():
+            if pending and pending[0][0] != lane:
+                yield join()
+                pending = []
+            pending.append((lane, offsets, item))
+            if len(pending) >= (self.tuner.group.value if self.tuner else 1):
+                yield join()
+                pending = []
+        if pending:
+            yield join()
 
     def run(self):
         try:
-            chunk_index = 0
-            for file1, file2 in zip(self.file1, self.file2):
-                with xopen(file1, 'rb') as f1:
-                    with xopen(file2, 'rb') as f2:
-                        for (chunk1, chunk2) in dnaio.read_paired_chunks(f1, f2, self.buffer_size):
-                            worker_index = self.queue.get()
-                            pipe = self.connections[worker_index]
-                            pipe.send(chunk_index)
-                            pipe.send_bytes(chunk1)
-                            pipe.send_bytes(chunk2)
-                            chunk_index += 1
+            chunk_index = self.begin[0]
+            for lane, offsets, (chunk1, chunk2) in self._grouped():
+                if self.chunks is not None:
+                    self.chunks.put((chunk_index, lane, (offsets[0], len(chunk1)), (offsets[1], len(chunk2))))
+                if self.window:
+                    # 等待的chunk太多时暂停读取
+                    self.window.acquire()
+                t = time.perf_counter()
+                worker_index = self.queue.get()
+                if self.tuner:
+                    self.tuner.wait_worker.value += time.perf_counter() - t
+                pipe = self.connections[worker_index]
+                pipe.send(chunk_index)
+                if self.slots:
+                    pipe.send(self.slots[worker_index].write_input(chunk1, chunk2))
+                else:
+                    pipe.send_bytes(chunk1)
+                    pipe.send_bytes(chunk2)
+                chunk_index += 1
+            if self.tuner:
+                # 唤醒暂停的worker, 让它们也能收到结束信号
+                self.tuner.finished.set()
             for _ in range(len(self.connections)):
                 worker_index = self.queue.get()
                 self.connections[worker_index].send(-1)
         except Exception as e:
+            if self.tuner:
+                self.tuner.finished.set()
+            tb_str = traceback.format_exc()
             for worker_index in range(len(self.connections)):
                 self.connections[worker_index].send(-2)
+                self.connections[worker_index].send(tb_str)
             raise e
 
 class Writer:
-    def __init__(self, file1, file2=None):
+    '''
+    compress: None, compress in this process with xopen;
+              bgzf/gzip, chunks are already compressed by workers and only appended.
+    header: written before the first chunk of each file (e.g. a BAM header).
+    start: append to existing files from this chunk index (compressed chunks only).
+    ordered: False, chunks are written as they arrive.
+    opener: open the output files with opener(file, mode=...) (e.g. a named pipe).
+    tee: also write file1 to this file, compressed by xopen.
+    flushed chunks and the end offsets of the files are kept in written.
+    '''
+    def __init__(self, file1, file2=None, compress=None, header=None, start=0, ordered=True,
+                 opener=None, tee=None):
         self._file1 = file1
-        self._fh1 = xopen(self._file1, mode='wb')
         self._file2 = file2
+        self._compress = compress
+        self._tee = xopen(tee, mode='wb') if tee else None
+        _open = opener or (open if compress else xopen)
+        mode = 'ab' if start else 'wb'
+        self._fh1 = _open(self._file1, mode=mode)
         if self._file2:
-            self._fh2 = xopen(self._file2, mode='wb')
+            self._fh2 = _open(self._file2, mode=mode)
+        self.written = []
+        if header and not start:
+            if compress:
+                header = compress_chunk(header, compress)
+            self._fh1.write(header)
+            if self._file2:
+                self._fh2.write(header)
         self._chunks = dict()
-        self._current_index = 0
+        self._current_index = start
+        self._ordered = ordered
+
+    def _emit(self, data):
+        self._fh1.write(data[0])
+        if self._file2:
+            self._fh2.write(data[1])
+        if self._tee:
+            self._tee.write(data[0])
 
     def write(self, data, index):
+        if not self._ordered:
+            self._emit(data)
+            self.written.append((index, self.tell() if self._compress else None))
+            return
+        if index != self._current_index:
+            # 缓存乱序到达的chunk, data可能是共享内存的视图
+            data = [bytes(_) for _ in data]
         self._chunks[index] = data
         while self._current_index in self._chunks:
-            self._fh1.write(self._chunks[self._current_index][0])
-            if self._file2:
-                self._fh2.write(self._chunks[self._current_index][1])
+            self._emit(self._chunks[self._current_index])
             del self._chunks[self._current_index]
+            self.written.append((self._current_index, self.tell() if self._compress else None))
             self._current_index += 1
 
+    def tell(self):
+        return [fh.tell() for fh in self._handles()]
+
+    def flush(self):
+        for fh in self._handles():
+            fh.flush()
+
+    def _handles(self):
+        return [self._fh1, self._fh2] if self._file2 else [self._fh1]
+
     def wrote_everything(self):
         return not self._chunks
 
     def close(self):
+        if self._compress == 'bgzf':
+            self._fh1.write(BGZF_EOF)
+            if self._file2:
+                self._fh2.write(BGZF_EOF)
         self._fh1.close()
         if self._file2:
             self._fh2.close()
+        if self._tee:
+            self._tee.close()
 
 class Worker(Process):
-    def __init__(self, id_, read_pipe, write_pipe, need_work_queue, func, paired_out=False):
+    '''
+    after each chunk the stat returned by func and the seconds spent in func are sent.
+    tuner: if given, workers with id_ >= tuner.active stop taking chunks.
+    '''
+    def __init__(self, id_, read_pipe, write_pipe, need_work_queue, func, paired_out=False, slots=None,
+                 compress=None, compresslevel=6, tuner=None):
         super().__init__()
         self._id = id_
         self.read_pipe = read_pipe
@@ -71,40 +357,254 @@ class Worker(Process):
         self.need_work_queue = need_work_queue
         self.func = func
         self.paired_out = paired_out
+        self.slots = slots
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.tuner = tuner
+
+    def _wait_active(self):
+        if not self.tuner:
+            return
+        while self._id >= self.tuner.active.value and not self.tuner.finished.is_set():
+            self.tuner.finished.wait(0.05)
+
+    def _output(self, tmp):
+        # 在worker中压缩, 主进程只需追加写入
+        if self.compress:
+            return compress_chunk(tmp.getbuffer(), self.compress, self.compresslevel)
+        return tmp.getvalue()
 
     def run(self):
         try:
+            n = 0
             while True:
+                self._wait_active()
                 self.need_work_queue.put(self._id)
                 chunk_index = self.read_pipe.recv()
                 if chunk_index == -1:
                     break
                 elif chunk_index == -2:
-                    e, tb_str = self.read_pipe.recv()
-                    raise e
+                    tb_str = self.read_pipe.recv()
+                    raise RuntimeError(f'reader failed:\n{tb_str}')
+                if self.slots:
+                    self._run_shared(chunk_index, n)
+                    n += 1
+                    continue
                 data = self.read_pipe.recv_bytes()
                 input = io.BytesIO(data)
                 data = self.read_pipe.recv_bytes()
                 input2 = io.BytesIO(data)
                 tmp = io.BytesIO()
+                t = time.perf_counter()
                 if self.paired_out:
                     tmp2 = io.BytesIO()
                     _ = self.func(fq1=input, fq2=input2, fq_out=tmp, fq_out2=tmp2)
                 else:
                     _ = self.func(fq1=input, fq2=input2, fq_out=tmp)
+                elapsed = time.perf_counter() - t
                 self.write_pipe.send(chunk_index)
-                self.write_pipe.send_bytes(tmp.getvalue())
+                self.write_pipe.send_bytes(self._output(tmp))
                 if self.paired_out:
-                    self.write_pipe.send_bytes(tmp2.getvalue())
+                    self.write_pipe.send_bytes(self._output(tmp2))
                 self.write_pipe.send(_)
+                self.write_pipe.send(elapsed)
             self.write_pipe.send(-1)
         except Exception as e:
             self.write_pipe.send(-2)
+            self.write_pipe.send(traceback.format_exc())
             raise e
 
+    def _run_shared(self, chunk_index, n):
+        # 直接解析共享内存中的输入, 结果写入输出slot
+        input, input2 = [BufferReader(_) for _ in self.slots.input_views(self.read_pipe.recv())]
+        self.slots.free.acquire()
+        slot = n % self.slots.n_slots
+        outputs = [SlotWriter(_) for _ in self.slots.output_views(slot)]
+        if self.compress:
+            # 先写入本地缓存, 压缩后的数据再放入slot
+            tmp = [io.BytesIO() for _ in outputs]
+        else:
+            tmp = outputs
+        t = time.perf_counter()
+        if self.paired_out:
+            _ = self.func(fq1=input, fq2=input2, fq_out=tmp[0], fq_out2=tmp[1])
+        else:
+            _ = self.func(fq1=input, fq2=input2, fq_out=tmp[0])
+        elapsed = time.perf_counter() - t
+        del input, input2
+        if self.compress:
+            for o, t in zip(outputs, tmp):
+                o.write(self._output(t))
+            del tmp
+        self.write_pipe.send(chunk_index)
+        self.write_pipe.send((slot, [None if o.overflowed else o.tell() for o in outputs]))
+        for o in outputs:
+            if o.overflowed:
+                self.write_pipe.send_bytes(o.getvalue())
+        self.write_pipe.send(_)
+        self.write_pipe.send(elapsed)
+
+
+def parse_size(size) -> int:
+    # 16G, 512M, 1024 -> bytes
+    units = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+    size = str(size).strip().upper().rstrip('B')
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+def total_memory() -> int:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+
+def rss(pid) -> int:
+    # 常驻内存, 非linux时返回0
+    try:
+        with open(f'/proc/{pid}/statm') as fh:
+            return int(fh.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+class Tuner:
+    '''
+    adaptive chunk size and worker count of a Pipeline.
+
+    chunks are read in pieces of base_size, group pieces are sent as one chunk (1..max_group),
+    and only the first active workers take chunks (1..core).
+    after every few chunks, the median time of a chunk in the workers and the time the reader
+    waited for input or for an idle worker are used to change group and active:
+    short chunks are grouped up, long chunks split; workers are added while the reader waits for them
+    and removed while it waits for input.
+    memory (in flight chunks estimated from the sizes, and the measured rss of all processes)
+    is kept under max_mem.
+    '''
+    # 每个worker中chunk大小的倍数: 输入, 输出, numpy中间数组
+    WORKER_FACTOR = 8
+    LATENCY = (1.0, 5.0)
+
+    def __init__(self, max_mem, core, base_size, max_group, lanes=1, prefetch=1):
+        self.max_mem = max_mem
+        self.core = core
+        self.base_size = base_size
+        self.max_group = max(max_group, 1)
+        self.lanes = lanes
+        self.prefetch = prefetch
+        self.active = Value('i', core, lock=False)
+        self.group = Value('i', 1, lock=False)
+        self.finished = Event()
+        self.wait_input = Value('d', 0.0, lock=False)
+        self.wait_worker = Value('d', 0.0, lock=False)
+        self.wait_writer = 0.0
+        self.pids = []
+        self.baseline = 0
+        self.peak_rss = 0
+        self.history = []
+        self._samples = []
+        self._chunks = 0
+        self._last = None
+        # 初始设置: 从最大值开始, 直到估计的内存不超过上限
+        group, active = max(self.max_group // 2, 1), core
+        while self.estimate(group, active) > max_mem and (group > 1 or active > 1):
+            if group > 1:
+                group //= 2
+            else:
+                active -= 1
+        self.group.value, self.active.value = group, active
+
+    def estimate(self, group, active):
+        chunk = group * self.base_size
+        in_flight = chunk * (self.WORKER_FACTOR * active + 2 * self.lanes * (self.prefetch + 1) + active)
+        return in_flight + self.baseline * (active + 2)
+
+    def rss(self):
+        return sum(rss(_) for _ in [os.getpid()] + self.pids)
+
+    def start(self, pids):
+        self.pids = list(pids)
+        self._last = (time.perf_counter(), 0.0, 0.0, 0.0)
+
+    def chunk_done(self, elapsed):
+        self._chunks += 1
+        self._samples.append(elapsed)
+        if len(self._samples) < max(self.active.value, 2):
+            return
+        now = time.perf_counter()
+        t0, wi0, ww0, wr0 = self._last
+        span = max(now - t0, 1e-6)
+        wait_input = (self.wait_input.value - wi0) / span
+        wait_worker = (self.wait_worker.value - ww0) / span
+        wait_writer = (self.wait_writer - wr0) / span
+        self._last = (now, self.wait_input.value, self.wait_worker.value, self.wait_writer)
+        latency = median(self._samples)
+        self._samples = []
+
+        used = self.rss()
+        self.peak_rss = max(self.peak_rss, used)
+        group, active = self.group.value, self.active.value
+        if not self.baseline and used:
+            # 每个进程除chunk外的内存(白名单索引等)
+            self.baseline = max(used - self.estimate(group, active), 0) // (len(self.pids) + 1)
+        if used > 0.9 * self.max_mem or self.estimate(group, active) > self.max_mem:
+            if group > 1:
+                group //= 2
+            elif active > 1:
+                active -= 1
+        else:
+            if latency < self.LATENCY[0] and group < self.max_group \
+                    and self.estimate(min(group * 2, self.max_group), active) <= self.max_mem:
+                group = min(group * 2, self.max_group)
+            elif latency > self.LATENCY[1] and group > 1:
+                group //= 2
+            # reader在等worker且主进程有空闲时增加worker, reader在等输入时减少
+            if wait_worker > 0.5 and wait_writer > 0.1 and active < self.core \
+                    and self.estimate(group, active + 1) <= self.max_mem:
+                active += 1
+            elif wait_input > 0.5 and active > 1:
+                active -= 1
+        if (group, active) != (self.group.value, self.active.value):
+            self.history.append({'chunk': self._chunks, 'chunk_size': group * self.base_size, 'workers': active,
+                                 'latency': round(latency, 3), 'rss': used})
+        self.group.value, self.active.value = group, active
+
+    @property
+    def settings(self):
+        return {
+            'chunk_size': self.group.value * self.base_size,
+            'workers': self.active.value,
+            'max_workers': self.core,
+            'max_mem': self.max_mem,
+            'peak_rss': self.peak_rss,
+            'reader_wait_input': round(self.wait_input.value, 3),
+            'reader_wait_worker': round(self.wait_worker.value, 3),
+            'writer_wait': round(self.wait_writer, 3),
+            'history': self.history,
+        }
+
 
 class Pipeline:
-    def __init__(self, func, fq1, fq2, fqout1, core, stat=None, fqout2=None, buffer_size=40 * 1024**2):
+    '''
+    transport: pipe, chunks are sent through pipes;
+               shm, chunks stay in per-worker shared memory slots.
+    compress: bgzf/gzip, workers compress their own chunks (blocks or members) at compresslevel;
+              None, the main process compresses with xopen.
+    lanes, read_threads: see Reader.
+    header: see Writer.
+    manifest: jsonl of written chunks (chunk_index, lane, input offsets, output byte ranges and stat),
+              with checkpoint the merged stat is saved after every chunk (compressed chunks only).
+    resume: continue from the checkpoint, the outputs are truncated to the last saved chunk.
+    ordered: True, chunks are written in input order, at most window chunks (default 2 * core)
+             are read ahead of the last written one;
+             False, chunks are written as they finish, no checkpoint/resume.
+    opener, tee: see Writer.
+    autotune: chunk size (base_size..buffer_size) and number of busy workers (1..core) are tuned
+              while running and memory is kept under max_mem (default 80% of the physical memory),
+              see Tuner, the final settings are in self.tuner.settings.
+    '''
+    def __init__(self, func, fq1, fq2, fqout1, core, stat=None, fqout2=None, buffer_size=40 * 1024**2,
+                 transport='pipe', compress=None, compresslevel=6, lanes=1, read_threads=None,
+                 header=None, manifest=None, checkpoint=None, resume=False,
+                 autotune=False, max_mem=None, base_size=4 * 1024**2, ordered=True, window=None,
+                 opener=None, tee=None):
         self.n_workers = core
         self.fq1 = fq1
         self.fq2 = fq2
@@ -117,49 +617,208 @@ class Pipeline:
         if self.fqout2:
             self.paired_out = True
         self.stat = stat
+        self.transport = transport
+        self.compress = compress
+        self.compresslevel = compresslevel
+        self.lanes = lanes
+        self.read_threads = read_threads
+        self.header = header
+        self.manifest = manifest
+        self.checkpoint = checkpoint
+        self.resume = resume
+        if (manifest or resume) and not compress:
+            raise ValueError('manifest and resume need bgzf/gzip compressed chunks')
+        if (checkpoint or resume) and not ordered:
+            raise ValueError('checkpoint and resume need ordered output')
+        self.ordered = ordered
+        self.window = window or 2 * core
+        self.opener = opener
+        self.tee = tee
+        self._reader = None
+        self.workers = []
+        self.tuner = None
+        self.read_size = buffer_size
+        if autotune:
+            base_size = min(base_size, buffer_size)
+            self.tuner = Tuner(max_mem or int(total_memory() * 0.8), core, base_size,
+                               buffer_size // base_size, lanes)
+            # 最大的chunk也不能超过内存上限, 共享内存按最大chunk分配
+            while self.tuner.max_group > 1 and self.tuner.estimate(self.tuner.max_group, 1) > self.tuner.max_mem:
+                self.tuner.max_group //= 2
+            self.tuner.group.value = min(self.tuner.group.value, self.tuner.max_group)
+            self.buffer_size = self.tuner.max_group * base_size
+            self.read_size = base_size
+
+    def _outputs(self):
+        return [self.fqout1, self.fqout2] if self.fqout2 else [self.fqout1]
+
+    def _restore(self):
+        # 从checkpoint恢复: 截断输出和manifest, 返回Reader的起点
+        with open(self.checkpoint, 'rb') as fh:
+            ck = pickle.load(fh)
+        if ck['fq1'] != list(self.fq1) or ck['fq2'] != list(self.fq2):
+            raise ValueError(f'{self.checkpoint} was made from other input files')
+        for f, end in zip(self._outputs(), ck['output']):
+            if os.path.getsize(f) < end:
+                raise ValueError(f'{f} is shorter than {self.checkpoint}')
+            os.truncate(f, end)
+        if self.manifest:
+            lines = []
+            if os.path.exists(self.manifest):
+                with open(self.manifest) as fh:
+                    lines = fh.readlines()[:ck['chunks']]
+            with open(self.manifest, 'w') as fh:
+                fh.writelines(lines)
+        self.stat.data = ck['stat']
+        return ck['chunks'], ck['lane'], tuple(ck['input'])
+
+    def _save(self, chunk_index, lane, input, output):
+        tmp = f'{self.checkpoint}.tmp'
+        with open(tmp, 'wb') as fh:
+            pickle.dump({
+                'fq1': list(self.fq1), 'fq2': list(self.fq2),
+                'chunks': chunk_index + 1, 'lane': lane, 'input': input,
+                'output': output, 'stat': self.stat.data
+            }, fh)
+        os.replace(tmp, self.checkpoint)
+
+    def _commit(self, pending):
+        # 按chunk顺序合并stat, 写出后记录manifest和checkpoint
+        if not self.writer.written:
+            return
+        for chunk_index, ends in self.writer.written:
+            if self._window:
+                self._window.release()
+            _stat = pending.pop(chunk_index)
+            self.stat.update(**_stat)
+            if not self.manifest:
+                continue
+            while chunk_index not in self._chunk_info:
+                info = self._chunk_queue.get()
+                self._chunk_info[info[0]] = info
+            _, lane, in1, in2 = self._chunk_info.pop(chunk_index)
+            record = {
+                'chunk_index': chunk_index, 'lane': lane, 'input': [in1, in2],
+                'output': [[a, b] for a, b in zip(self._ends, ends)],
+                'stat': {k: dict(v) for k, v in _stat.items() if isinstance(v, dict)}
+            }
+            self._manifest_fh.write(json.dumps(record) + '\n')
+            self._ends = ends
+        self.writer.written.clear()
+        if self.checkpoint:
+            # 先保证输出和manifest写入, 再更新checkpoint
+            self.writer.flush()
+            self._manifest_fh.flush()
+            self._save(chunk_index, lane, [in1[0] + in1[1], in2[0] + in2[1]], ends)
 
     def run(self):
+        slots = None
+        if self.transport == 'shm':
+            slots = [SharedSlots(self.buffer_size, n_out=2 if self.paired_out else 1)
+                     for _ in range(self.n_workers)]
+        try:
+            self._run(slots)
+        except BaseException:
+            self._terminate()
+            raise
+        finally:
+            if slots:
+                for _ in slots:
+                    _.close()
+
+    def _terminate(self):
+        # 出错时结束所有子进程
+        for p in [self._reader] + self.workers:
+            if p is not None and p.is_alive():
+                p.terminate()
+                p.join()
+
+    def _run(self, slots):
         # start reader process
         reader_connections = [Pipe(duplex=False) for _ in range(self.n_workers)]
         _pipes, _conn = zip(*reader_connections)
-        _reader_process = Reader(self.fq1, self.fq2, _conn, self.need_work_queue, self.buffer_size)
+        start = None
+        if self.resume and self.checkpoint and os.path.exists(self.checkpoint):
+            start = self._restore()
+        self._chunk_queue = Queue() if self.manifest else None
+        self._chunk_info = {}
+        self._window = Semaphore(self.window) if self.ordered else None
+        _reader_process = Reader(self.fq1, self.fq2, _conn, self.need_work_queue, self.read_size, slots,
+                                 lanes=self.lanes, threads=self.read_threads,
+                                 begin=start, chunks=self._chunk_queue, tuner=self.tuner,
+                                 window=self._window)
         _reader_process.daemon = True
         _reader_process.start()
+        self._reader = _reader_process
 
         # start worker processes
         self.workers = []
         self.connections = []
-        self.writer = Writer(self.fqout1, self.fqout2)
+        worker_slots = {}
         for index in range(self.n_workers):
             conn_r, conn_w = Pipe(duplex=False)
             self.connections.append(conn_r)
             worker = Worker(index, _pipes[index], conn_w, self.need_work_queue,
-                            self.func, self.paired_out)
+                            self.func, self.paired_out, slots[index] if slots else None,
+                            self.compress, self.compresslevel, self.tuner)
             worker.daemon = True
             worker.start()
             self.workers.append(worker)
+            if slots:
+                worker_slots[conn_r] = slots[index]
+        if self.tuner:
+            self.tuner.start([_reader_process.pid] + [w.pid for w in self.workers])
+
+        # 子进程启动后再打开输出, 避免子进程继承文件描述符(如命名管道)
+        self.writer = Writer(self.fqout1, self.fqout2, self.compress, self.header, start[0] if start else 0,
+                             self.ordered, self.opener, self.tee)
+        self._ends = self.writer.tell() if self.manifest else None
+        if self.manifest:
+            self._manifest_fh = open(self.manifest, 'a' if start else 'w')
+        pending = {}
 
         # write output
         while self.connections:
+            t = time.perf_counter()
             ready_connections = multiprocessing.connection.wait(self.connections)
+            if self.tuner:
+                self.tuner.wait_writer += time.perf_counter() - t
             for connection in ready_connections:
                 chunk_index = connection.recv()
                 if chunk_index == -1:
                     self.connections.remove(connection)
                     continue
                 elif chunk_index == -2:
-                    sys.stderr.write('err!!!\n')
-                
-                if self.paired_out:
+                    raise RuntimeError(f'worker failed:\n{connection.recv()}')
+
+                if slots:
+                    _slots = worker_slots[connection]
+                    slot, sizes = connection.recv()
+                    views = _slots.output_views(slot)
+                    data = [connection.recv_bytes() if n is None else v[:n] for v, n in zip(views, sizes)]
+                    pending[chunk_index] = connection.recv()
+                    elapsed = connection.recv()
+                    self.writer.write(data, chunk_index)
+                    del views, data
+                    _slots.free.release()
+                elif self.paired_out:
                     data1 = connection.recv_bytes()
                     data2 = connection.recv_bytes()
+                    pending[chunk_index] = connection.recv()
+                    elapsed = connection.recv()
                     self.writer.write([data1, data2], chunk_index)
                 else:
                     data1 = connection.recv_bytes()
+                    pending[chunk_index] = connection.recv()
+                    elapsed = connection.recv()
                     self.writer.write([data1,], chunk_index)
-                _stat = connection.recv()
-                self.stat.update(**_stat)
+                self._commit(pending)
+                if self.tuner:
+                    self.tuner.chunk_done(elapsed)
         assert self.writer.wrote_everything()
+        self.writer.close()
+        if self.manifest:
+            self._manifest_fh.close()
         for w in self.workers:
             w.join()
         _reader_process.join()
@@ -0,0 +1,154 @@
+import os
+import json
+import numpy as np
+from xopen import xopen
+
+VERSION = 1
+
+
+def _table_file(name):
+    return name == 'meta.json' or name.endswith('.bin') or name.endswith('.dict.npy')
+
+def remove_table(path):
+    '''
+    remove a table dir written by TableWriter, raise OSError if it has other files.
+    '''
+    if not os.path.exists(path):
+        return
+    for name in os.listdir(path):
+        if _table_file(name):
+            os.remove(os.path.join(path, name))
+    os.rmdir(path)
+
+class TableWriter:
+    '''
+    write a table to a dir, one file per column: {name}.bin with little-endian integers.
+    str columns are dictionary encoded, {name}.bin has uint32 codes and {name}.dict.npy
+    the values in code order (order of first appearance). meta.json is written by close.
+    columns: [(name, 'str' or an integer dtype)].
+    the table is written to {path}.tmp and replaces path on close, an existing path
+    may only hold table files.
+    '''
+    def __init__(self, path, columns, buffer=1 << 20):
+        if os.path.exists(path) and not all(_table_file(_) for _ in os.listdir(path)):
+            raise FileExistsError(f'{path} is not a table dir')
+        self.path = path
+        self.tmp = f'{path}.tmp'
+        remove_table(self.tmp)
+        os.makedirs(self.tmp)
+        self.columns = columns
+        self.dtypes = [np.dtype('<u4') if kind == 'str' else np.dtype(kind).newbyteorder('<') for _, kind in columns]
+        self.dicts = [{} if kind == 'str' else None for _, kind in columns]
+        self.buffers = [[] for _ in columns]
+        self.fhs = [open(os.path.join(self.tmp, f'{name}.bin'), 'wb') for name, _ in columns]
+        self.buffer = buffer
+        self.rows = 0
+
+    def append(self, *row):
+        for v, d, b in zip(row, self.dicts, self.buffers):
+            if d is not None:
+                code = d.get(v)
+                if code is None:
+                    code = d[v] = len(d)
+                v = code
+            b.append(v)
+        if len(self.buffers[0]) >= self.buffer:
+            self.flush()
+
+    def flush(self):
+        self.rows += len(self.buffers[0])
+        for b, fh, dtype in zip(self.buffers, self.fhs, self.dtypes):
+            np.asarray(b, dtype=dtype).tofile(fh)
+            b.clear()
+
+    def extend(self, path):
+        # 追加另一个表, 按本表的字典重新编码
+        self.flush()
+        table = Table(path)
+        for (name, _), d, fh, dtype in zip(self.columns, self.dicts, self.fhs, self.dtypes):
+            codes = table.column(name)
+            if d is not None:
+                remap = np.empty(len(table.dict(name)), dtype=dtype)
+                for i, v in enumerate(table.values(name)):
+                    code = d.get(v)
+                    if code is None:
+                        code = d[v] = len(d)
+                    remap[i] = code
+                codes = remap[codes]
+            np.asarray(codes, dtype=dtype).tofile(fh)
+        self.rows += table.rows
+
+    def close(self):
+        self.flush()
+        for fh in self.fhs:
+            fh.close()
+        for (name, _), d in zip(self.columns, self.dicts):
+            if d is not None:
+                np.save(os.path.join(self.tmp, f'{name}.dict.npy'), np.array([_.encode() for _ in d], dtype=bytes))
+        meta = {
+            'version': VERSION,
+            'rows': self.rows,
+            'columns': [[name, 'str' if d is not None else dtype.str] for (name, _), d, dtype
+                        in zip(self.columns, self.dicts, self.dtypes)]
+        }
+        with open(os.path.join(self.tmp, 'meta.json'), 'w') as fh:
+            json.dump(meta, fh, indent=4)
+        remove_table(self.path)
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        # 出错时丢弃未写完的表
+        for fh in self.fhs:
+            fh.close()
+        remove_table(self.tmp)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class Table:
+    '''
+    a table written by TableWriter, columns are memory mapped.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fh:
+            meta = json.load(fh)
+        self.rows = meta['rows']
+        self.names = [name for name, _ in meta['columns']]
+        self.kinds = dict(meta['columns'])
+
+    def column(self, name):
+        # str列返回编码
+        dtype = '<u4' if self.kinds[name] == 'str' else self.kinds[name]
+        if not self.rows:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, f'{name}.bin'), dtype=dtype, mode='r', shape=(self.rows,))
+
+    def dict(self, name):
+        # 按编码顺序的bytes数组
+        return np.load(os.path.join(self.path, f'{name}.dict.npy'))
+
+    def values(self, name):
+        return [_.decode() for _ in self.dict(name)]
+
+def export_table(path, out, chunk=1 << 20):
+    '''
+    write a table as tab separated text with a header, gzip compressed for .gz.
+    '''
+    table = Table(path)
+    values = {name: table.values(name) for name in table.names if table.kinds[name] == 'str'}
+    with xopen(out, 'w') as fh:
+        fh.write('\t'.join(table.names) + '\n')
+        for start in range(0, table.rows, chunk):
+            cols = []
+            for name in table.names:
+                codes = table.column(name)[start:start + chunk].tolist()
+                cols.append([values[name][_] for _ in codes] if name in values else map(str, codes))
+            fh.write(''.join('\t'.join(row) + '\n' for row in zip(*cols)))
+    return out
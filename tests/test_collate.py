@@ -0,0 +1,97 @@
+import os
+import gzip
+import zlib
+import struct
+import random
+import pysam
+import pytest
+from seekonetools.rna.collate import read_shard, name_key, bam_parts, bam_range
+
+
+def _records(n, seed):
+    rng = random.Random(seed)
+    records = []
+    for i in range(n):
+        barcode = ''.join(rng.choice('ACGT') for _ in range(3))
+        qname = f'{barcode}_UMI_{rng.randint(1, 200)}'
+        # 同一read的多条比对, XT不同以检查顺序
+        for j in range(rng.choice([1, 1, 2, 3])):
+            records.append((barcode, 'UMI', qname, f'G{i}.{j}', rng.choice([255, 3])))
+    return records
+
+def _write(tmp_path, records, parts):
+    paths = []
+    for k in range(parts):
+        path = str(tmp_path / f'shard_0000.{k:05d}.tsv')
+        with open(path, 'w') as fh:
+            for record in records[k::parts]:
+                fh.write('\t'.join(map(str, record)) + '\n')
+        paths.append(path)
+    return paths
+
+@pytest.mark.parametrize('chunk', [1, 7, 100, 10000])
+def test_read_shard(tmp_path, chunk):
+    records = _records(500, chunk)
+    paths = _write(tmp_path, records, 3)
+    in_order = [r for k in range(3) for r in records[k::3]]
+    expected = sorted(in_order, key=lambda x: (x[0], name_key(x[2])))
+    assert list(read_shard(paths, chunk)) == expected
+    # 排序用的临时文件已删除
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(_) for _ in paths)
+
+def test_name_key():
+    names = ['r10', 'r9', 'ra', 'r1x', 'r']
+    assert sorted(names, key=name_key) == ['r', 'r1x', 'r9', 'r10', 'ra']
+
+
+def _rebgzf(src, dst, size):
+    # 按固定长度重新切分BGZF block, 记录会跨越block(htslib写出的bam不会)
+    data = gzip.decompress(open(src, 'rb').read())
+    with open(dst, 'wb') as fh:
+        for i in range(0, len(data), size):
+            chunk = data[i:i + size]
+            z = zlib.compressobj(6, zlib.DEFLATED, -15)
+            cdata = z.compress(chunk) + z.flush()
+            fh.write(b'\x1f\x8b\x08\x04' + b'\x00' * 4 + b'\x00\xff\x06\x00BC\x02\x00')
+            fh.write(struct.pack('<H', len(cdata) + 25) + cdata)
+            fh.write(struct.pack('<II', zlib.crc32(chunk), len(chunk)))
+        fh.write(bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000'))
+
+@pytest.fixture(scope='module')
+def grouped_bam(tmp_path_factory):
+    tmp_path = tmp_path_factory.mktemp('bam')
+    rng = random.Random(0)
+    header = {'HD': {'VN': '1.6', 'SO': 'unsorted'}, 'SQ': [{'SN': 'chr1', 'LN': 100000}]}
+    bam = str(tmp_path / 'grouped.bam')
+    with pysam.AlignmentFile(bam, 'wb', header=header) as fh:
+        for b in range(300):
+            barcode = ''.join(rng.choice('ACGT') for _ in range(12))
+            for i in range(rng.choice([1, 5, 50, 200])):
+                r = pysam.AlignedSegment(fh.header)
+                r.query_name = f'{barcode}_UMI_{i}'
+                r.reference_id = 0
+                r.reference_start = rng.randrange(99000)
+                r.cigarstring = '90M'
+                r.query_sequence = ''.join(rng.choice('ACGT') for _ in range(90))
+                r.set_tag('CB', barcode)
+                fh.write(r)
+    rebgzf = str(tmp_path / 'rebgzf.bam')
+    _rebgzf(bam, rebgzf, 10007)
+    return bam, rebgzf
+
+@pytest.mark.parametrize('which', [0, 1])
+@pytest.mark.parametrize('parts', [1, 7, 40])
+def test_bam_parts(grouped_bam, which, parts):
+    bam = grouped_bam[which]
+    with pysam.AlignmentFile(bam) as fh:
+        expected = [r.query_name for r in fh]
+    ranges = bam_parts(bam, parts)
+    assert len(ranges) > min(parts - 1, 1)
+    names, groups = [], []
+    for start, end in ranges:
+        part = [r.query_name for r in bam_range(bam, start, end)]
+        names += part
+        groups.append({_.split('_')[0] for _ in part})
+    assert names == expected
+    # barcode不跨越两个range
+    assert sum(len(_) for _ in groups) == len(set.union(*groups))
@@ -0,0 +1,61 @@
+import random
+import numpy as np
+import pytest
+from cutadapt import adapters
+from seekonetools.utils.fastq import scan_polya, maybe_polya, POLYA_ALIGN, POLYA_NONE
+
+SAMPLE = [
+    'GCTTCAGGTCCTAGGATCAGTTCAAGGCTAAAAAAAAAAAAAAAAAAAAAAAAAAAAA',
+    'TTGACCATGCAGGTTCAAAAAAAAAAAAAGAAAAAAAAAAAAAACTGACGT',
+    'ACGTTGCAGATCGGAAGAGCACACGTCTGAACTCCAGTCACAAAA',
+    'CAGTTCAAGGCTTTGGACCATAAAGCAATTGAAA',
+    'GGGCCCATTAGACAAAAAAAAAAAAAAAGG',
+    'AAAAAAAA', 'AAAAAAA', 'AAAA', 'AAA', 'AA', 'A', 'CAAA', 'AAAAACAA', 'AACAAAA',
+    'ACGTACGT', 'NNNNAAAAAN',
+]
+
+
+def _cutadapt(reads):
+    polyA_filter = adapters.BackAdapter(sequence='A' * 15)
+    result = []
+    for seq in reads:
+        match = polyA_filter.match_to(seq)
+        result.append(match.rstart if match else POLYA_NONE)
+    return result
+
+def _scan(reads):
+    # 与step1.process_barcode_batch相同: 先整体扫描, 再对POLYA_ALIGN调用cutadapt
+    buf = np.frombuffer(''.join(reads).encode(), dtype=np.uint8)
+    lengths = np.array([len(_) for _ in reads], dtype=np.int64)
+    starts = np.cumsum(lengths) - lengths
+    rstart = scan_polya(buf, starts, lengths)
+    polyA_filter = adapters.BackAdapter(sequence='A' * 15)
+    for j in np.flatnonzero(rstart == POLYA_ALIGN):
+        match = polyA_filter.match_to(reads[j])
+        rstart[j] = match.rstart if match else POLYA_NONE
+    return rstart.tolist()
+
+def _fuzz(n, seed):
+    rng = random.Random(seed)
+    reads = []
+    for _ in range(n):
+        length = rng.choice([1, 2, 3, 5, 8, 9, 10, 13, 14, 15, 20, 50, 100])
+        p = rng.choice([0.25, 0.7, 0.9, 0.97])
+        reads.append(''.join('A' if rng.random() < p else rng.choice('CGTN') for _ in range(length)))
+    return reads
+
+
+@pytest.mark.parametrize('reads', [SAMPLE, _fuzz(20000, 1), _fuzz(20000, 2)])
+def test_scan_polya(reads):
+    assert _scan(reads) == _cutadapt(reads)
+
+@pytest.mark.parametrize('reads', [SAMPLE, _fuzz(20000, 3)])
+def test_maybe_polya(reads):
+    # maybe_polya为False的read一定没有polyA
+    for seq, rstart in zip(reads, _cutadapt(reads)):
+        if not maybe_polya(seq):
+            assert rstart == POLYA_NONE, seq
+
+def test_short_reads():
+    assert _scan(['AAAAAAAA', 'CAAAAAAA']) == _cutadapt(['AAAAAAAA', 'CAAAAAAA'])
+    assert _cutadapt(['AAAAAAAA']) == [0]
@@ -0,0 +1,78 @@
+import re
+import pysam
+import pytest
+from seekonetools.rna.rnaseq_qc import rnaseq_qc
+
+GTF = [
+    ('chr1', 101, 200, '+', 'G1'), ('chr1', 301, 400, '+', 'G1'),
+    ('chr1', 381, 500, '+', 'G3'),
+    ('chr1', 1001, 1100, '-', 'G2'),
+    # PAR基因: 同一gene_id位于chrX和chrY
+    ('chrX', 101, 200, '+', 'PARG'), ('chrY', 5001, 5100, '+', 'PARG'),
+]
+# (chrom, 0-based pos, cigar, reverse, NH, secondary)
+READS = [
+    ('chr1', 119, '50M', False, 1, False),        # G1 exonic
+    ('chr1', 119, '50M', False, 2, False),        # 多比对, 不分类
+    ('chr1', 150, '50M100N50M', False, 1, False), # G1 剪接, exonic
+    ('chr1', 179, '50M', False, 1, False),        # G1 exonic, overlapping exon
+    ('chr1', 249, '50M', False, 1, False),        # G1 intronic
+    ('chr1', 385, '10M', False, 1, False),        # G1/G3 ambiguous, exonic
+    ('chr1', 1019, '50M', True, 1, False),        # G2 exonic
+    ('chr1', 1019, '50M', False, 1, False),       # 反义链, intergenic
+    ('chr1', 4999, '50M', False, 1, False),       # intergenic
+    ('chr1', 4999, '50M', False, 2, True),        # secondary
+    ('chrX', 119, '50M', False, 1, False),        # PARG exonic
+    ('chrY', 1000, '50M', False, 1, False),       # PARG两个区间之间, intergenic
+    ('chrY', 5019, '50M', False, 1, False),       # PARG exonic
+]
+EXPECTED = {
+    'reads aligned': 12, 'total alignments': 13, 'secondary alignments': 1,
+    'non-unique alignments': 2, 'aligned to genes': 6, 'ambiguous alignments': 1,
+    'no feature assigned': 4, 'not aligned': 1,
+    'exonic': 7, 'intronic': 1, 'intergenic': 3, 'overlapping exon': 1,
+}
+
+
+def _write(tmp_path):
+    gtf = tmp_path / 'genes.gtf'
+    with open(gtf, 'w') as fh:
+        for chrom, start, end, strand, gene in GTF:
+            fh.write(f'{chrom}\ttest\texon\t{start}\t{end}\t.\t{strand}\t.\tgene_id "{gene}"; transcript_id "{gene}.1";\n')
+    header = {'HD': {'VN': '1.6', 'SO': 'coordinate'},
+              'SQ': [{'SN': _, 'LN': 10000} for _ in ('chr1', 'chrX', 'chrY')]}
+    bam = str(tmp_path / 'sorted.bam')
+    with pysam.AlignmentFile(bam, 'wb', header=header) as fh:
+        for i, (chrom, pos, cigar, reverse, nh, secondary) in enumerate(READS):
+            read = pysam.AlignedSegment(fh.header)
+            read.query_name = f'r{i}'
+            read.reference_name = chrom
+            read.reference_start = pos
+            read.cigarstring = cigar
+            read.query_sequence = 'A' * read.query_alignment_length
+            read.flag = 16 * reverse + 256 * secondary
+            read.mapping_quality = 255 if nh == 1 else 3
+            read.set_tag('NH', nh)
+            fh.write(read)
+        read = pysam.AlignedSegment(fh.header)
+        read.query_name = 'unmapped'
+        read.query_sequence = 'A' * 50
+        read.flag = 4
+        fh.write(read)
+    return bam, str(gtf)
+
+def _parse(path):
+    with open(path) as fh:
+        return {k: int(v.replace(',', '')) for k, v in re.findall(r'^\s+(.+?) = ([\d,]+)', fh.read(), re.M)}
+
+def test_rnaseq_qc(tmp_path):
+    bam, gtf = _write(tmp_path)
+    counts = _parse(rnaseq_qc(bam, gtf, str(tmp_path), core=1))
+    assert {k: counts[k] for k in EXPECTED} == EXPECTED
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_strand(tmp_path, reverse):
+    # --sc5p时read方向取反: 只有正向比对到G2(负链)的read算作exonic
+    bam, gtf = _write(tmp_path)
+    counts = _parse(rnaseq_qc(bam, gtf, str(tmp_path), SC5P=reverse, core=1))
+    assert counts['exonic'] == (1 if reverse else 7)
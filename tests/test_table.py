@@ -0,0 +1,59 @@
+import os
+import pytest
+from seekonetools.utils.table import TableWriter, Table, export_table
+
+COLUMNS = [('cellID', 'str'), ('geneID', 'str'), ('UMINum', 'u4')]
+
+
+def _write(path, rows):
+    with TableWriter(path, COLUMNS, buffer=2) as writer:
+        for row in rows:
+            writer.append(*row)
+
+def test_roundtrip(tmp_path):
+    rows = [('AAAC', 'G1', 3), ('AAAC', 'G2', 1), ('CCCA', 'G1', 7)]
+    path = str(tmp_path / 'counts')
+    _write(path, rows)
+    table = Table(path)
+    assert table.rows == 3
+    assert table.values('cellID') == ['AAAC', 'CCCA']
+    assert table.column('UMINum').tolist() == [3, 1, 7]
+    export_table(path, str(tmp_path / 'counts.xls'))
+    with open(tmp_path / 'counts.xls') as fh:
+        assert fh.read() == 'cellID\tgeneID\tUMINum\n' + ''.join('\t'.join(map(str, _)) + '\n' for _ in rows)
+
+def test_extend(tmp_path):
+    a, b, c = (str(tmp_path / _) for _ in 'abc')
+    _write(a, [('AAAC', 'G2', 1)])
+    _write(b, [('CCCA', 'G1', 2), ('CCCA', 'G2', 5)])
+    with TableWriter(c, COLUMNS) as writer:
+        writer.extend(a)
+        writer.extend(b)
+    table = Table(c)
+    assert table.values('geneID') == ['G2', 'G1']
+    assert table.column('geneID').tolist() == [0, 1, 0]
+
+def test_rewrite(tmp_path):
+    path = str(tmp_path / 'counts')
+    _write(path, [('AAAC', 'G1', 3)])
+    _write(path, [('CCCA', 'G1', 1), ('CCCA', 'G2', 1)])
+    assert Table(path).rows == 2
+    assert not os.path.exists(path + '.tmp')
+
+def test_failed_write_keeps_table(tmp_path):
+    path = str(tmp_path / 'counts')
+    _write(path, [('AAAC', 'G1', 3)])
+    with pytest.raises(RuntimeError):
+        with TableWriter(path, COLUMNS, buffer=1) as writer:
+            writer.append('CCCA', 'G1', 1)
+            raise RuntimeError()
+    assert Table(path).values('cellID') == ['AAAC']
+    assert not os.path.exists(path + '.tmp')
+
+def test_other_files(tmp_path):
+    os.makedirs(tmp_path / 'out' / 'sub')
+    with open(tmp_path / 'out' / 'notes.txt', 'w') as fh:
+        fh.write('x')
+    with pytest.raises(FileExistsError):
+        TableWriter(str(tmp_path / 'out'), COLUMNS)
+    assert os.path.exists(tmp_path / 'out' / 'notes.txt')
@@ -0,0 +1,62 @@
+import os
+import random
+import numpy as np
+import pytest
+from seekonetools.rna.helper import build_dict, correct_seq, correct_seq_index
+from seekonetools.rna.helper import generate_mismatch_sequence, generate_indel_sequence
+from seekonetools.rna.whitelist import load_index, _save_index
+
+# 互为1错配/1缺失的序列, 其邻居有多个纠错目标; 含重复行
+WHITELIST = ['ACGTACGTAC', 'ACGTACGTAA', 'ACGTACGTCC', 'CGTACGTACA', 'TTTTGGGGCC',
+             'TTTTGGGGCA', 'GTACGTACAA', 'ACGTACGTAA', 'CCCCCCCCCC']
+
+
+def _queries(whitelist, n, seed):
+    rng = random.Random(seed)
+    queries = set(whitelist)
+    for s in whitelist:
+        queries.update(generate_mismatch_sequence(s))
+        queries.update(generate_indel_sequence(s))
+    queries.update(''.join(rng.choice('ACGT') for _ in range(10)) for _ in range(n))
+    queries.update(('ACGTACGTAN', 'ACGTACGT', ''))
+    return sorted(queries)
+
+@pytest.fixture
+def whitelist(tmp_path):
+    path = tmp_path / 'whitelist.txt'
+    path.write_text('\n'.join(WHITELIST) + '\n')
+    return str(path)
+
+@pytest.mark.parametrize('err,indel', [(1, 1), (1, 0), (0, 1)])
+def test_engines_agree(whitelist, tmp_path, err, indel):
+    d = build_dict(whitelist, err, indel)
+    table = load_index(whitelist, err, indel, str(tmp_path / 'cache'), 'table')
+    seed = load_index(whitelist, err, indel, str(tmp_path / 'cache'), 'seed')
+    for q in _queries(WHITELIST, 2000, err * 2 + indel):
+        expected = correct_seq(q, d['perfect'], d['indel'], d['mis'])
+        assert correct_seq_index(q, table) == expected, q
+        assert correct_seq_index(q, seed) == expected, q
+
+def test_ambiguous(whitelist, tmp_path):
+    # ACGTACGTAG与ACGTACGTAC、ACGTACGTAA均为1错配, 取白名单中最后出现的ACGTACGTAA
+    d = build_dict(whitelist, 1, 1)
+    assert correct_seq('ACGTACGTAG', d['perfect'], d['indel'], d['mis']) == (3, 0, 'ACGTACGTAA')
+    for engine in ('table', 'seed'):
+        index = load_index(whitelist, 1, 1, str(tmp_path / 'cache'), engine)
+        assert correct_seq_index('ACGTACGTAG', index) == (3, 0, 'ACGTACGTAA')
+
+def test_save_index(tmp_path):
+    # 目标已由其他进程生成时沿用, 其他错误抛出
+    path = tmp_path / 'index'
+    _save_index({'a': np.zeros(1)}, str(path))
+    _save_index({'a': np.ones(1)}, str(path))
+    assert np.load(path / 'a.npy').tolist() == [0]
+    blocked = tmp_path / 'blocked'
+    blocked.write_text('')
+    with pytest.raises(OSError):
+        _save_index({'a': np.zeros(1)}, str(blocked))
+    assert sorted(os.listdir(tmp_path)) == ['blocked', 'index']
+
+def test_bad_whitelist(tmp_path):
+    with pytest.raises(ValueError, match='used as the sequence itself'):
+        load_index(str(tmp_path / 'missing.txt'), 1, 0, str(tmp_path / 'cache'))